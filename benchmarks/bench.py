@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+""" Benchmarks for warcit and warcit-converter.
+
+Generates synthetic corpora (deterministic for a given --scale) in a work
+directory, then times WARCIT.run() or FileConverter.convert_all() for each
+case, in a separate process so that the peak RSS of each case is measured
+on its own. Runs fully offline, conversions use 'cp'.
+
+Usage::
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --scale 0.1 --cases tiny_html_filename,deep_zip
+    python benchmarks/bench.py --compare old-results.json --output new-results.json
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+import platform
+import logging
+
+from argparse import ArgumentParser, SUPPRESS
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  #pragma: no cover
+    resource = None
+
+
+URL_PREFIX = 'http://example.com/'
+
+MB = 1024.0 * 1024.0
+
+WORDS = ('archive web page record replay crawl capture document image video '
+         'collection access preservation format header index revisit '
+         'données archivé été naïve').split(' ')
+
+CONVERT_RULES = """
+rules:
+  - &copy
+    name: copy
+    ext: copy
+    command: 'cp {input} {output}'
+    mime: application/octet-stream
+
+file_types:
+  - ext: '.flv'
+    conversion_rules:
+      - *copy
+"""
+
+
+# ============================================================================
+class Corpora(object):
+    """ Synthetic inputs, written once to the work dir and reused
+    for the same scale
+    """
+    def __init__(self, work_dir, scale=1.0):
+        self.work_dir = work_dir
+        self.scale = scale
+        self.root = os.path.join(work_dir, 'corpora')
+        self.manifest_file = os.path.join(self.root, 'corpora.json')
+
+    def scaled(self, count, minimum=1):
+        return max(int(count * self.scale), minimum)
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def load(self):
+        try:
+            with open(self.manifest_file, 'rt') as fh:
+                manifest = json.load(fh)
+
+            if manifest['scale'] == self.scale:
+                return manifest['corpora']
+        except Exception:
+            pass
+
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+
+        os.makedirs(self.root)
+
+        corpora = OrderedDict()
+        corpora['tiny_html'] = self.make_tiny_html(self.path('tiny_html'), self.scaled(5000))
+        corpora['huge_binaries'] = self.make_huge_binaries(self.path('huge_binaries'),
+                                                           3, self.scaled(64 * 1024 * 1024))
+        corpora['deep_zip'] = self.make_deep_zip(self.path('deep.zip'), self.scaled(2000), depth=16)
+        corpora['mapfile'] = self.make_mapfile(self.path('mapfile'), self.scaled(200),
+                                               self.scaled(100000))
+        corpora['patterns'] = self.make_patterns(self.path('patterns.json'), 200)
+        corpora['media'] = self.make_media(self.path('media'), self.scaled(50))
+
+        with open(self.manifest_file, 'wt') as fh:
+            json.dump({'scale': self.scale, 'corpora': corpora}, fh, indent=2)
+
+        return corpora
+
+    def random_html(self, rng, size):
+        words = []
+        total = 0
+        while total < size:
+            word = rng.choice(WORDS)
+            words.append(word)
+            total += len(word) + 1
+
+        return ('<html><head><title>{0}</title></head><body><p>{1}</p></body></html>'.format(
+                words[0], ' '.join(words))).encode('utf-8')
+
+    def make_tiny_html(self, root, count):
+        rng = random.Random(1)
+        size = 0
+        for i in range(count):
+            dirname = os.path.join(root, 'dir{0:02d}'.format(i % 50), 'sub{0:02d}'.format(i % 7))
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            ext = '.html' if i % 10 else '.css'
+            data = self.random_html(rng, rng.randint(200, 4000))
+            with open(os.path.join(dirname, 'page{0}{1}'.format(i, ext)), 'wb') as fh:
+                fh.write(data)
+
+            size += len(data)
+
+        return {'path': root, 'files': count, 'bytes': size}
+
+    def make_huge_binaries(self, root, count, file_size):
+        os.makedirs(root)
+        rng = random.Random(2)
+
+        # incompressible block, repeated with a varying prefix
+        block_size = 1024 * 1024
+        block = bytearray(rng.getrandbits(8) for i in range(block_size))
+
+        for i in range(count):
+            with open(os.path.join(root, 'binary{0}.bin'.format(i)), 'wb') as fh:
+                written = 0
+                n = 0
+                while written < file_size:
+                    chunk = bytes(bytearray([n % 256, i])) + bytes(block[:min(block_size, file_size - written) - 2])
+                    fh.write(chunk)
+                    written += len(chunk)
+                    n += 1
+
+        return {'path': root, 'files': count, 'bytes': count * file_size}
+
+    def make_deep_zip(self, filename, count, depth):
+        rng = random.Random(3)
+        size = 0
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as zp:
+            for i in range(count):
+                parts = ['level{0}'.format(d) for d in range(i % depth + 1)]
+                name = '/'.join(['site'] + parts + ['file{0}.html'.format(i)])
+                data = self.random_html(rng, rng.randint(200, 4000))
+                zp.writestr(name, data)
+                size += len(data)
+
+        return {'path': filename + '/site/', 'files': count, 'bytes': size}
+
+    def make_mapfile(self, root, file_count, row_count):
+        corpus = self.make_tiny_html(os.path.join(root, 'files'), file_count)
+
+        mapfile = os.path.join(root, 'mapfile.csv')
+        with open(mapfile, 'wt') as fh:
+            fh.write('file,URL,timestamp\n')
+
+            # rows for files not in the corpus first, so that each lookup scans the rows
+            for i in range(row_count - file_count):
+                fh.write('missing/page{0}.html,http://example.com/missing/{0},20190101000000\n'.format(i))
+
+            for i in range(file_count):
+                ext = '.html' if i % 10 else '.css'
+                fh.write('sub{0:02d}/page{1}{2},http://example.com/mapped/{1},20190101000000\n'.format(
+                         i % 7, i, ext))
+
+        corpus['mapfile'] = mapfile
+        corpus['rows'] = row_count
+        return corpus
+
+    def make_patterns(self, filename, count):
+        exclude = ['*/dir{0:02d}/sub0[0-3]/*'.format(i) for i in range(0, 50, 5)]
+        exclude += ['*/nomatch{0}/*.html'.format(i) for i in range(count)]
+        include = ['*/dir0{0}/*.css'.format(i) for i in range(10)]
+
+        patterns = {'exclude': ','.join(exclude), 'include': ','.join(include)}
+        with open(filename, 'wt') as fh:
+            json.dump(patterns, fh)
+
+        return {'path': filename, 'patterns': len(exclude) + len(include)}
+
+    def make_media(self, root, count):
+        rng = random.Random(4)
+        os.makedirs(root)
+
+        size = 0
+        transclusions = ['transclusions:']
+        for i in range(count):
+            data = bytes(bytearray(rng.getrandbits(8) for n in range(rng.randint(10000, 100000))))
+            with open(os.path.join(root, 'video{0}.flv'.format(i)), 'wb') as fh:
+                fh.write(data)
+
+            size += len(data)
+            transclusions.append('  {0}media/video{1}.flv:'.format(URL_PREFIX, i))
+            transclusions.append('    - url: {0}page{1}.html'.format(URL_PREFIX, i))
+            transclusions.append('      timestamp: 20190102030000')
+
+        rules_file = os.path.join(self.root, 'rules.yaml')
+        with open(rules_file, 'wt') as fh:
+            fh.write(CONVERT_RULES)
+
+        transclusions_file = os.path.join(self.root, 'transclusions.yaml')
+        with open(transclusions_file, 'wt') as fh:
+            fh.write('\n'.join(transclusions) + '\n')
+
+        return {'path': root, 'files': count, 'bytes': size,
+                'rules': rules_file, 'transclusions': transclusions_file}
+
+
+# ============================================================================
+def warcit_case(corpus, **kwargs):
+    return {'tool': 'warcit', 'corpus': corpus, 'kwargs': kwargs}
+
+
+def converter_case(corpus, **kwargs):
+    return {'tool': 'converter', 'corpus': corpus, 'kwargs': kwargs}
+
+
+CASES = OrderedDict([
+    ('tiny_html_filename', warcit_case('tiny_html', use_magic='filename')),
+    ('tiny_html_no_gzip', warcit_case('tiny_html', use_magic='filename', gzip=False)),
+    ('tiny_html_magic', warcit_case('tiny_html', use_magic='magic')),
+    ('tiny_html_cchardet', warcit_case('tiny_html', use_magic='filename', charset='cchardet')),
+    ('huge_binaries', warcit_case('huge_binaries', use_magic='filename')),
+    ('huge_binaries_no_gzip', warcit_case('huge_binaries', use_magic='filename', gzip=False)),
+    ('deep_zip', warcit_case('deep_zip', use_magic='filename')),
+    ('mapfile', warcit_case('mapfile', use_magic='filename')),
+    ('patterns', warcit_case('tiny_html', use_magic='filename', patterns=True)),
+    ('converter', converter_case('media')),
+    ('conversions_transclusions', warcit_case('media', use_magic='filename', conversions=True,
+                                              transclusions=True)),
+    ('convert_inline', warcit_case('media', use_magic='filename', convert=True)),
+])
+
+
+# ============================================================================
+def peak_rss():
+    """ Peak resident set size of this process, in bytes
+    """
+    if not resource:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_case(name, work_dir, corpora):
+    """ Run a single case in this process, returning its timing
+    """
+    case = CASES[name]
+    corpus = corpora[case['corpus']]
+    kwargs = dict(case['kwargs'])
+
+    out_dir = os.path.join(work_dir, 'out', name)
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+
+    os.makedirs(out_dir)
+
+    if case['tool'] == 'converter':
+        from warcit.converter import FileConverter
+
+        tool = FileConverter(rules_filename=corpus['rules'],
+                             inputs=[corpus['path']],
+                             url_prefix=URL_PREFIX,
+                             output_dir=out_dir)
+        run = tool.convert_all
+
+    else:
+        from warcit.warcit import WARCIT
+
+        if kwargs.get('use_magic') == 'magic':
+            import magic
+
+        if case['corpus'] == 'mapfile':
+            kwargs['mapfile'] = corpus['mapfile']
+
+        if kwargs.pop('patterns', False):
+            with open(corpora['patterns']['path'], 'rt') as fh:
+                kwargs.update(json.load(fh))
+
+        if kwargs.pop('conversions', False):
+            # conversion outputs and results are prepared untimed
+            from warcit.converter import FileConverter
+            conv_dir = os.path.join(out_dir, 'conversions')
+            FileConverter(rules_filename=corpus['rules'],
+                          inputs=[corpus['path']],
+                          url_prefix=URL_PREFIX,
+                          output_dir=conv_dir).convert_all()
+
+            kwargs['conversions'] = os.path.join(conv_dir, 'warcit-conversion-results.yaml')
+
+        if kwargs.pop('transclusions', False):
+            kwargs['transclusions'] = corpus['transclusions']
+
+        if kwargs.get('convert'):
+            kwargs['convert_rules'] = corpus['rules']
+
+        tool = WARCIT(URL_PREFIX, [corpus['path']],
+                      name=os.path.join(out_dir, name),
+                      mode='wb',
+                      args=['warcit'],
+                      **kwargs)
+        run = tool.run
+
+    start_rss = peak_rss()
+    start = time.time()
+    res = run()
+    duration = time.time() - start
+
+    if res:
+        raise Exception('Case {0} failed with exit code {1}'.format(name, res))
+
+    output_size = 0
+    for dirpath, dirnames, filenames in os.walk(out_dir):
+        output_size += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+
+    files = corpus.get('files', 0)
+    size = corpus.get('bytes', 0)
+
+    return OrderedDict([('time', round(duration, 4)),
+                        ('files', files),
+                        ('bytes', size),
+                        ('files_per_sec', round(files / duration, 2)),
+                        ('mb_per_sec', round(size / MB / duration, 2)),
+                        ('output_bytes', output_size),
+                        ('start_rss', start_rss),
+                        ('peak_rss', peak_rss()),
+                       ])
+
+
+def run_case_process(name, work_dir, scale):
+    """ Run a case in a new process, so that its peak RSS is its own
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-case', name,
+           '--work-dir', work_dir, '--scale', str(scale)]
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+
+    if proc.returncode != 0:
+        return {'error': err.decode('utf-8', 'replace').strip().split('\n')[-1]}
+
+    return json.loads(out.decode('utf-8'), object_pairs_hook=OrderedDict)
+
+
+def run_all(work_dir, scale, names, repeat=1):
+    results = OrderedDict()
+    for name in names:
+        best = None
+        for i in range(repeat):
+            result = run_case_process(name, work_dir, scale)
+            if 'error' in result:
+                best = result
+                break
+
+            if not best or result['time'] < best['time']:
+                best = result
+
+        results[name] = best
+        print_result(name, best)
+
+    return results
+
+
+def print_result(name, result, stream=None):
+    stream = stream or sys.stderr
+    if 'error' in result:
+        stream.write('{0:28} error: {1}\n'.format(name, result['error']))
+        return
+
+    rss = result['peak_rss']
+    stream.write('{0:28} {1:8.3f}s {2:10.1f} files/s {3:8.2f} MB/s {4:>10} peak RSS\n'.format(
+                 name, result['time'], result['files_per_sec'], result['mb_per_sec'],
+                 '{0:.1f}MB'.format(rss / MB) if rss else '-'))
+
+
+def compare(old_results, results, stream=None):
+    stream = stream or sys.stderr
+    stream.write('\n{0:28} {1:>10} {2:>10} {3:>10}\n'.format('case', 'old', 'new', 'change'))
+    for name, result in results.items():
+        old = old_results['cases'].get(name)
+        if not old or 'error' in old or 'error' in result:
+            continue
+
+        stream.write('{0:28} {1:9.3f}s {2:9.3f}s {3:+9.1f}%\n'.format(
+                     name, old['time'], result['time'],
+                     (result['time'] - old['time']) * 100.0 / old['time']))
+
+
+# ============================================================================
+def main(args=None):
+    parser = ArgumentParser(description='warcit benchmarks')
+
+    parser.add_argument('--work-dir',
+                        help='Directory for generated corpora and outputs. Default is a new temp dir, removed after the run.')
+
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Scale the number and size of the generated inputs. Default is 1.0')
+
+    parser.add_argument('--cases',
+                        help='Comma separated list of cases to run, of: ' + ', '.join(CASES))
+
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Run each case this many times, keeping the fastest. Default is 1')
+
+    parser.add_argument('--output',
+                        help='Write results JSON to this file, instead of stdout')
+
+    parser.add_argument('--compare',
+                        help='Results JSON from a previous run to compare times with')
+
+    parser.add_argument('--run-case', help=SUPPRESS)
+
+    r = parser.parse_args(args=args)
+
+    logging.disable(logging.CRITICAL)
+
+    work_dir = r.work_dir or tempfile.mkdtemp(prefix='warcit-bench-')
+    corpora = Corpora(work_dir, r.scale).load()
+
+    if r.run_case:
+        print(json.dumps(run_case(r.run_case, work_dir, corpora)))
+        return 0
+
+    names = r.cases.split(',') if r.cases else list(CASES)
+    for name in names:
+        if name not in CASES:
+            parser.error('Unknown case: ' + name)
+
+    try:
+        results = run_all(work_dir, r.scale, names, r.repeat)
+    finally:
+        if not r.work_dir:
+            shutil.rmtree(work_dir)
+
+    from warcit.base import get_version
+
+    report = OrderedDict([('warcit', (get_version() % dict(prog='')).strip()),
+                          ('python', platform.python_version()),
+                          ('platform', platform.platform()),
+                          ('scale', r.scale),
+                          ('corpora', corpora),
+                          ('cases', results)])
+
+    if r.compare:
+        with open(r.compare, 'rt') as fh:
+            compare(json.load(fh), results)
+
+    if r.output:
+        with open(r.output, 'wt') as fh:
+            json.dump(report, fh, indent=2)
+            fh.write('\n')
+    else:
+        print(json.dumps(report, indent=2))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
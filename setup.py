@@ -37,6 +37,9 @@ setup(
         'cchardet',
         'pyyaml',
         ],
+    extras_require={
+        'zstd': ['zstandard'],
+        },
     zip_safe=True,
     package_data={
         'warcit': ['*.yaml']
@@ -45,6 +48,7 @@ setup(
         [console_scripts]
         warcit = warcit.warcit:main
         warcit-converter = warcit.converter:main
+        warcit-verify = warcit.verify:main
     """,
     cmdclass={'test': PyTest},
     test_suite='',
@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks', 'bench.py')
+
+
+# ============================================================================
+@pytest.mark.skipif(os.name == 'nt', reason='uses cp for conversions')
+def test_bench_smoke(tmpdir):
+    output = os.path.join(str(tmpdir), 'results.json')
+    work_dir = os.path.join(str(tmpdir), 'work')
+
+    subprocess.check_call([sys.executable, BENCH, '--scale', '0.01', '--work-dir', work_dir,
+                           '--cases', 'tiny_html_filename,deep_zip,mapfile,converter',
+                           '--output', output])
+
+    with open(output) as fh:
+        results = json.load(fh)
+
+    assert results['scale'] == 0.01
+    assert list(results['cases']) == ['tiny_html_filename', 'deep_zip', 'mapfile', 'converter']
+
+    for name, result in results['cases'].items():
+        assert 'error' not in result, name
+        assert result['files'] > 0
+        assert result['files_per_sec'] > 0
+        assert result['output_bytes'] > 0
+
+    assert results['corpora']['tiny_html']['files'] == 50
@@ -0,0 +1,430 @@
+import shutil
+import tempfile
+import os
+import yaml
+import json
+import time
+import pytest
+
+from warcit.converter import main as converter_main, FileTypeIndex
+from warcit.warcit import main as warcit_main
+from warcio import ArchiveIterator
+
+
+RULES = """
+rules:
+  - &copy
+    name: copy
+    ext: copy
+    command: 'cp {input} {output}'
+    mime: text/plain
+
+file_types:
+  - ext: '.txt'
+    conversion_rules:
+      - *copy
+"""
+
+
+# ============================================================================
+@pytest.mark.skipif(os.name == 'nt', reason='uses cp for conversions')
+class TestConverter(object):
+    @classmethod
+    def setup_class(cls):
+        cls.root_dir = os.path.realpath(tempfile.mkdtemp())
+        cls.orig_cwd = os.getcwd()
+        os.chdir(cls.root_dir)
+
+        cls.source_dir = os.path.join(cls.root_dir, 'source')
+        os.makedirs(os.path.join(cls.source_dir, 'docs'))
+
+        for name in ('a.txt', 'b.txt', 'c.bin'):
+            with open(os.path.join(cls.source_dir, 'docs', name), 'wt') as fh:
+                fh.write('Some Text ' + name)
+
+        cls.rules_file = os.path.join(cls.root_dir, 'rules.yaml')
+        with open(cls.rules_file, 'wt') as fh:
+            fh.write(RULES)
+
+        cls.output_dir = os.path.join(cls.root_dir, 'conversions')
+        cls.results_file = os.path.join(cls.output_dir, 'warcit-conversion-results.yaml')
+
+    @classmethod
+    def teardown_class(cls):
+        os.chdir(cls.orig_cwd)
+        shutil.rmtree(cls.root_dir)
+
+    def output_path(self, name):
+        return os.path.join(self.output_dir, os.path.basename(self.root_dir), 'source', 'docs', name)
+
+    def load_results(self):
+        with open(self.results_file) as fh:
+            return yaml.safe_load(fh.read())['conversions']
+
+    def convert(self, *args):
+        converter_main(['-v', '--rules', self.rules_file, '--output-dir', self.output_dir] +
+                       list(args) + ['http://www.example.com/', self.source_dir])
+
+    def test_convert(self, caplog):
+        self.convert()
+
+        assert os.path.isfile(self.output_path('a.txt.copy'))
+        assert os.path.isfile(self.output_path('b.txt.copy'))
+        assert not os.path.isfile(self.output_path('c.bin.copy'))
+
+        results = self.load_results()
+        result = results['http://www.example.com/docs/a.txt'][0]
+        assert result['success'] == True
+        assert result['url'] == 'http://www.example.com/docs/a.txt.copy'
+        assert result['source_size'] == result['output_size'] == len('Some Text a.txt')
+
+    def test_convert_up_to_date(self, caplog):
+        self.convert()
+
+        assert 'Up-to-date, skipping: ' + self.output_path('a.txt.copy') in caplog.text
+        assert 'Up-to-date, skipping: ' + self.output_path('b.txt.copy') in caplog.text
+
+        # results carried forward
+        results = self.load_results()
+        assert results['http://www.example.com/docs/a.txt'][0]['success'] == True
+        assert len(results['http://www.example.com/docs/a.txt']) == 1
+
+    def test_convert_stale_output(self, caplog):
+        # partial output, size no longer matches results
+        with open(self.output_path('a.txt.copy'), 'wt') as fh:
+            fh.write('Some')
+
+        self.convert()
+
+        assert 'Up-to-date, skipping: ' + self.output_path('a.txt.copy') not in caplog.text
+        assert 'Up-to-date, skipping: ' + self.output_path('b.txt.copy') in caplog.text
+
+        with open(self.output_path('a.txt.copy'), 'rt') as fh:
+            assert fh.read() == 'Some Text a.txt'
+
+    def test_convert_check_digest(self, caplog):
+        self.convert('--check-digest')
+
+        # no digest recorded previously, recorded for the up-to-date outputs
+        assert 'Up-to-date, skipping: ' + self.output_path('a.txt.copy') in caplog.text
+        assert self.load_results()['http://www.example.com/docs/a.txt'][0]['source_digest'].startswith('sha1:')
+
+        # same size and time, different content
+        source = os.path.join(self.source_dir, 'docs', 'a.txt')
+        stats = os.stat(source)
+        with open(source, 'wt') as fh:
+            fh.write('Same Text a.txt')
+
+        os.utime(source, (stats.st_atime, stats.st_mtime))
+
+        caplog.clear()
+        self.convert('--check-digest')
+        assert 'Up-to-date, skipping: ' + self.output_path('a.txt.copy') not in caplog.text
+        assert 'Up-to-date, skipping: ' + self.output_path('b.txt.copy') in caplog.text
+
+        with open(self.output_path('a.txt.copy'), 'rt') as fh:
+            assert fh.read() == 'Same Text a.txt'
+
+        caplog.clear()
+        self.convert('--check-digest')
+        assert 'Up-to-date, skipping: ' + self.output_path('a.txt.copy') in caplog.text
+
+    def test_convert_changed_command(self, caplog):
+        rules_file = os.path.join(self.root_dir, 'rules-changed.yaml')
+        with open(rules_file, 'wt') as fh:
+            fh.write(RULES.replace("'cp {input} {output}'", "'cp -p {input} {output}'"))
+
+        converter_main(['-v', '--rules', rules_file, '--output-dir', self.output_dir,
+                        'http://www.example.com/', self.source_dir])
+
+        assert 'Up-to-date' not in caplog.text
+        assert self.load_results()['http://www.example.com/docs/a.txt'][0]['metadata']['command'] == 'cp -p {input} {output}'
+
+        # back to the original command
+        caplog.clear()
+        self.convert()
+        assert 'Up-to-date' not in caplog.text
+
+    def test_convert_force(self, caplog):
+        self.convert('--force')
+
+        assert 'Up-to-date' not in caplog.text
+        assert '*** Running Command' in caplog.text
+
+    def test_convert_plan(self, caplog):
+        plan_file = os.path.join(self.root_dir, 'plan.yaml')
+
+        # add stale output
+        os.remove(self.output_path('b.txt.copy'))
+
+        self.convert('--plan', plan_file)
+
+        assert 'Plan: 1 conversions (1 up-to-date) for 2 inputs' in caplog.text
+
+        with open(plan_file) as fh:
+            plan = yaml.safe_load(fh.read())
+
+        assert plan['totals']['inputs'] == 2
+        assert plan['totals']['conversions'] == 1
+        assert plan['totals']['up_to_date'] == 1
+        assert plan['totals']['unestimated'] == 0
+        assert plan['rules']['copy']['throughput'] > 0
+
+        inputs = dict((entry['url'], entry) for entry in plan['inputs'])
+        conv = inputs['http://www.example.com/docs/b.txt']['conversions'][0]
+        assert conv['name'] == 'copy'
+        assert conv['output'] == self.output_path('b.txt.copy')
+        assert conv['up_to_date'] == False
+        assert conv['estimated_seconds'] >= 0
+
+        assert inputs['http://www.example.com/docs/a.txt']['conversions'][0]['up_to_date'] == True
+
+        # dry run only
+        assert not os.path.isfile(self.output_path('b.txt.copy'))
+
+    def test_convert_profile(self, capsys):
+        import pstats
+        profile_file = os.path.join(self.root_dir, 'converter.prof')
+
+        self.convert('--force', '--profile', profile_file, '--profile-limit', '1')
+
+        out, err = capsys.readouterr()
+        assert 'Ordered by: cumulative time' in err
+
+        stats = pstats.Stats(profile_file)
+        functions = [func for filename, line, func in stats.stats]
+        assert 'convert_file' in functions
+
+
+# ============================================================================
+def test_file_type_index():
+    file_types = [{'ext': '.flv', 'name': 'flv'},
+                  {'regex': r'.*/videos/.*', 'name': 'videos'},
+                  {'ext': '.tar.gz', 'name': 'tar'},
+                  {'regex': r'.*\.(mp4|m4v)$', 'name': 'mp4'},
+                  {'ext': '.mov', 'regex': r'.*\.qt$', 'name': 'qt'},
+                 ]
+
+    index = FileTypeIndex(file_types)
+    assert index.combined_regex
+
+    def names(url):
+        return [file_type['name'] for file_type in index.match(url)]
+
+    assert names('http://example.com/a.flv') == ['flv']
+    assert names('http://example.com/videos/a.flv') == ['flv', 'videos']
+    assert names('http://example.com/videos/a.mp4') == ['videos', 'mp4']
+    assert names('http://example.com/a.m4v') == ['mp4']
+    assert names('http://example.com/a.tar.gz') == ['tar']
+    assert names('http://example.com/a.mov') == ['qt']
+    assert names('http://example.com/a.qt') == ['qt']
+    assert names('http://example.com/a.html') == []
+
+
+def test_file_type_index_backref_fallback():
+    index = FileTypeIndex([{'regex': r'.*/(\w+)/\1\.rm$'},
+                           {'ext': '.rm'}])
+
+    assert index.combined_regex is None
+    assert len(index.match('http://example.com/a/a.rm')) == 2
+    assert len(index.match('http://example.com/a/b.rm')) == 1
+
+
+TRANSCLUSIONS = """
+transclusions:
+  http://www.example.com/a.txt:
+    - url: http://www.example.com/page.html
+      timestamp: 20190103020000
+"""
+
+INLINE_RULES = """
+rules:
+  - &copy
+    name: copy
+    ext: copy
+    command: 'cp {input} {output}'
+    mime: text/plain
+
+  - &cat
+    name: cat
+    ext: cat
+    command: 'cat {input}'
+    stdout: true
+    mime: text/plain
+
+  - &fail
+    name: fail
+    ext: fail
+    command: 'false'
+    mime: text/plain
+
+file_types:
+  - ext: '.txt'
+    conversion_rules:
+      - *copy
+      - *cat
+      - *fail
+"""
+
+
+# ============================================================================
+@pytest.mark.skipif(os.name == 'nt', reason='uses cp and cat for conversions')
+def test_inline_conversions(tmpdir, caplog, capsys):
+    source_dir = os.path.join(str(tmpdir), 'source')
+    os.makedirs(source_dir)
+    with open(os.path.join(source_dir, 'a.txt'), 'wt') as fh:
+        fh.write('Some Text')
+
+    rules_file = os.path.join(str(tmpdir), 'rules.yaml')
+    with open(rules_file, 'wt') as fh:
+        fh.write(INLINE_RULES)
+
+    transclusions_file = os.path.join(str(tmpdir), 'transclusions.yaml')
+    with open(transclusions_file, 'wt') as fh:
+        fh.write(TRANSCLUSIONS)
+
+    warc_file = os.path.join(str(tmpdir), 'inline.warc.gz')
+
+    res = warcit_main(['-v', '-n', warc_file, '--convert', '--convert-rules', rules_file,
+                       '--transclusions', transclusions_file,
+                       '--spool-size', '4', 'http://www.example.com/', source_dir])
+    assert res == 0
+
+    assert 'Skipping unsuccessful conversion: http://www.example.com/a.txt -> fail' in caplog.text
+
+    records = []
+    with open(warc_file, 'rb') as fh:
+        for record in ArchiveIterator(fh):
+            if record.rec_type != 'warcinfo':
+                records.append((record.rec_type,
+                                record.rec_headers['WARC-Target-URI'],
+                                record.content_stream().read()))
+
+    assert records[:3] == [('resource', 'http://www.example.com/a.txt', b'Some Text'),
+                           ('conversion', 'http://www.example.com/a.txt.copy', b'Some Text'),
+                           ('conversion', 'http://www.example.com/a.txt.cat', b'Some Text'),
+                          ]
+
+    assert records[3][1] == 'urn:embeds:http://www.example.com/page.html'
+    metadata = json.loads(records[3][2].decode('utf-8'))
+    assert [format_['ext'] for format_ in metadata['formats']] == ['copy', 'cat', 'txt']
+
+    # no intermediates left behind
+    assert os.listdir(source_dir) == ['a.txt']
+    assert not os.path.isdir(os.path.join(str(tmpdir), 'conversions'))
+
+
+# ============================================================================
+@pytest.mark.skipif(os.name == 'nt', reason='uses cp for conversions')
+def test_inline_conversions_mapfile(tmpdir):
+    source_dir = os.path.join(str(tmpdir), 'source')
+    os.makedirs(source_dir)
+    with open(os.path.join(source_dir, 'a.txt'), 'wt') as fh:
+        fh.write('Some Text')
+
+    rules_file = os.path.join(str(tmpdir), 'rules.yaml')
+    with open(rules_file, 'wt') as fh:
+        fh.write(RULES)
+
+    mapfile = os.path.join(str(tmpdir), 'mapfile.csv')
+    with open(mapfile, 'wt') as fh:
+        fh.write('file,URL\nsource/a.txt,http://www.example.com/mapped.txt\n')
+
+    warc_file = os.path.join(str(tmpdir), 'mapfile.warc.gz')
+
+    res = warcit_main(['-q', '-n', warc_file, '--convert', '--convert-rules', rules_file,
+                       '--mapfile', mapfile, 'http://www.example.com/', source_dir])
+    assert res == 0
+
+    with open(warc_file, 'rb') as fh:
+        records = [(record.rec_type, record.rec_headers['WARC-Target-URI'])
+                   for record in ArchiveIterator(fh) if record.rec_type != 'warcinfo']
+
+    assert records == [('resource', 'http://www.example.com/mapped.txt'),
+                       ('conversion', 'http://www.example.com/mapped.txt.copy')]
+
+
+LIMITS_RULES = """
+limits:
+  timeout: 60
+
+rules:
+  - &slow
+    name: slow
+    ext: slow
+    command: 'sleep 10'
+    timeout: 0.5
+
+  - &big
+    name: big
+    ext: big
+    command: 'cp {input} {output}'
+    max_output_bytes: 4
+    nice: 5
+
+file_types:
+  - ext: '.txt'
+    conversion_rules:
+      - *slow
+      - *big
+"""
+
+
+# ============================================================================
+@pytest.mark.skipif(os.name == 'nt', reason='uses sleep and cp for conversions')
+def test_conversion_limits(tmpdir, caplog):
+    source_dir = os.path.join(str(tmpdir), 'source')
+    os.makedirs(source_dir)
+    with open(os.path.join(source_dir, 'a.txt'), 'wt') as fh:
+        fh.write('Some Text')
+
+    rules_file = os.path.join(str(tmpdir), 'rules.yaml')
+    with open(rules_file, 'wt') as fh:
+        fh.write(LIMITS_RULES)
+
+    output_dir = os.path.join(str(tmpdir), 'conversions')
+
+    start = time.time()
+    converter_main(['-v', '--rules', rules_file, '--output-dir', output_dir,
+                    '--max-load', '10000', 'http://www.example.com/', source_dir])
+
+    assert time.time() - start < 5
+
+    with open(os.path.join(output_dir, 'warcit-conversion-results.yaml')) as fh:
+        results = yaml.safe_load(fh.read())['conversions']['http://www.example.com/a.txt']
+
+    assert results[0]['success'] == False
+    assert results[0]['error'] == 'timeout after 0.5 seconds'
+
+    assert results[1]['success'] == False
+    assert results[1]['error'] == 'output exceeded 4 bytes'
+    assert not os.path.isfile(results[1]['output'])
+
+    assert 'Conversion failed: ' in caplog.text
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='rlimits only applied on posix')
+def test_conversion_rlimit_above_hard_limit(monkeypatch):
+    import resource
+    from warcit.converter import ConversionRunner
+
+    # preexec runs in the forked child, which sees the patched module
+    monkeypatch.setattr(resource, 'getrlimit', lambda limit: (100, 100))
+
+    runner = ConversionRunner()
+    spool = tempfile.TemporaryFile()
+    res, error = runner.run(['sh', '-c', 'ulimit -t'], {'max_cpu_time': 10 ** 9}, spool=spool)
+
+    assert res == 0
+    assert error is None
+    spool.seek(0)
+    assert spool.read().strip() == b'100'
+
+    def setrlimit(limit, value):
+        raise ValueError('not allowed to raise maximum limit')
+
+    monkeypatch.setattr(resource, 'setrlimit', setrlimit)
+
+    res, error = runner.run(['true'], {'max_cpu_time': 10})
+    assert res is None
+    assert error.startswith('command failed: ')
@@ -0,0 +1,183 @@
+import os
+import json
+import threading
+import pytest
+
+from collections import Counter
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:  #pragma: no cover
+    pytest.skip('python 3 only', allow_module_level=True)
+
+from warcit.warcit import main
+from warcio import ArchiveIterator
+
+
+# ============================================================================
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInTikaHandler(BaseHTTPRequestHandler):
+    """ Stand-in for the Tika server type detection and metadata endpoints
+    """
+    protocol_version = 'HTTP/1.1'
+
+    requests = Counter()
+    filenames = set()
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.requests['GET ' + self.path] += 1
+        self.send_body('Apache Tika 1.0-standin', 'text/plain')
+
+    def do_PUT(self):
+        self.requests['PUT ' + self.path] += 1
+        self.filenames.add(self.headers.get('Content-Disposition'))
+        data = self.rfile.read(int(self.headers['Content-Length']))
+
+        if data.startswith(b'<'):
+            mime = 'text/html'
+        else:
+            mime = 'application/octet-stream'
+
+        if self.path == '/detect/stream':
+            self.send_body(mime, 'text/plain')
+
+        elif self.path == '/meta':
+            assert self.headers['Accept'] == 'application/json'
+            metadata = {'Content-Type': mime + '; charset=UTF-8',
+                        'Content-Encoding': 'UTF-8'}
+            self.send_body(json.dumps(metadata), 'application/json')
+
+        else:
+            self.send_error(404)
+
+
+# ============================================================================
+@pytest.fixture
+def tika_server():
+    StandInTikaHandler.requests.clear()
+    StandInTikaHandler.filenames.clear()
+    server = ThreadingHTTPServer(('localhost', 0), StandInTikaHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    yield 'http://localhost:{0}'.format(server.server_address[1])
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def source_dir(tmpdir):
+    source_dir = os.path.join(str(tmpdir), 'source')
+    os.makedirs(source_dir)
+
+    for name, data in [('a.html', b'<html>A</html>'),
+                       ('b.html', b'<html>A</html>'),
+                       ('c.txt', b'<html>C</html>'),
+                       ('d.bin', b'\x00\x01\x02\x03'),
+                       ('e.dat', b'\x00\x01\x02\x03'),
+                      ]:
+        with open(os.path.join(source_dir, name), 'wb') as fh:
+            fh.write(data)
+
+    return source_dir
+
+
+def read_content_types(filename):
+    content_types = {}
+    with open(filename, 'rb') as fh:
+        for record in ArchiveIterator(fh):
+            if record.rec_type == 'resource':
+                content_types[record.rec_headers['WARC-Target-URI']] = record.rec_headers['Content-Type']
+
+    return content_types
+
+
+# ============================================================================
+def test_tika_type_and_charset(tika_server, source_dir, tmpdir):
+    warc = os.path.join(str(tmpdir), 'tika.warc.gz')
+    res = main(['-q', '-n', warc, '--use-magic', 'tika', '--charset', 'tika', '--tika-server', tika_server,
+                '--tika-workers', '2', 'http://example.com/', source_dir])
+    assert res == 0
+
+    content_types = read_content_types(warc)
+
+    assert content_types == {'http://example.com/a.html': 'text/html; charset=UTF-8',
+                             'http://example.com/b.html': 'text/html; charset=UTF-8',
+                             'http://example.com/c.txt': 'text/html; charset=UTF-8',
+                             'http://example.com/d.bin': 'application/octet-stream',
+                             'http://example.com/e.dat': 'application/octet-stream',
+                            }
+
+    # only one request per unique content and extension, metadata only for text,
+    # and only metadata for text by filename
+    requests = StandInTikaHandler.requests
+    assert requests['PUT /detect/stream'] == 2
+    assert requests['PUT /meta'] == 2
+
+    # a.html or b.html, whichever is sent first
+    filenames = set('attachment; filename="{0}"'.format(name) for name in ('c.txt', 'd.bin', 'e.dat'))
+    assert len(StandInTikaHandler.filenames) == 4
+    assert filenames < StandInTikaHandler.filenames
+
+
+def test_tika_zip(tika_server, source_dir, tmpdir):
+    import zipfile
+    zip_filename = os.path.join(str(tmpdir), 'source.zip')
+    with zipfile.ZipFile(zip_filename, 'w') as zp:
+        for name in sorted(os.listdir(source_dir)):
+            zp.write(os.path.join(source_dir, name), name)
+
+    warc = os.path.join(str(tmpdir), 'tika.warc.gz')
+    res = main(['-q', '-n', warc, '--use-magic', 'tika', '--charset', 'tika', '--tika-server', tika_server,
+                '--tika-workers', '2', 'http://example.com/', zip_filename])
+    assert res == 0
+
+    content_types = read_content_types(warc)
+    assert len(content_types) == 5
+    assert content_types['http://example.com/c.txt'] == 'text/html; charset=UTF-8'
+    assert content_types['http://example.com/e.dat'] == 'application/octet-stream'
+
+
+def test_tika_charset_only(tika_server, source_dir, tmpdir):
+    warc = os.path.join(str(tmpdir), 'tika.warc.gz')
+    res = main(['-q', '-n', warc, '--charset', 'tika', '--tika-server', tika_server,
+                'http://example.com/', source_dir])
+    assert res == 0
+
+    content_types = read_content_types(warc)
+
+    assert content_types['http://example.com/a.html'] == 'text/html; charset=UTF-8'
+    assert content_types['http://example.com/c.txt'] == 'text/plain; charset=UTF-8'
+    assert content_types['http://example.com/d.bin'] == 'application/octet-stream'
+
+    # no type detection, metadata only for text files by filename
+    # (e.dat has no known extension, defaulting to text/html)
+    requests = StandInTikaHandler.requests
+    assert requests['PUT /detect/stream'] == 0
+    assert requests['PUT /meta'] == 3
+
+
+def test_tika_not_available(source_dir, tmpdir, caplog):
+    warc = os.path.join(str(tmpdir), 'tika.warc.gz')
+    res = main(['-q', '-n', warc, '--use-magic', 'tika', '--tika-server', 'http://localhost:1',
+                'http://example.com/', source_dir])
+    assert res == 1
+
+    assert 'Apache Tika server not available at http://localhost:1' in caplog.text
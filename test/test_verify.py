@@ -0,0 +1,141 @@
+import os
+import zipfile
+import pytest
+
+from warcit.warcit import main
+from warcit.verify import main as verify_main, load_index_ranges, _hash_sources
+
+
+# ============================================================================
+class TestVerify(object):
+    @pytest.fixture
+    def test_dir(self, tmpdir):
+        test_root = os.path.dirname(os.path.realpath(__file__))
+        self.zip_filename = os.path.join(test_root, 'www.iana.org.zip')
+
+        with zipfile.ZipFile(self.zip_filename) as zp:
+            zp.extractall(str(tmpdir))
+
+        self.warc = str(tmpdir / 'iana.warc.gz')
+        self.log = str(tmpdir / 'iana.jsonl')
+        return str(tmpdir / 'www.iana.org')
+
+    def make_warc(self, *args):
+        res = main(['-q', '-n', self.warc, '--log', self.log, '--log-format', 'jsonl'] + list(args))
+        assert res == 0
+
+    def test_verify_index(self, test_dir, capsys):
+        self.make_warc('http://www.iana.org/', test_dir)
+
+        assert len(load_index_ranges(self.log, self.warc)) == 24
+
+        res = verify_main(['-q', '--index', self.log, '--workers', '2', self.warc, test_dir])
+        out, err = capsys.readouterr()
+
+        assert res == 0
+        assert out == 'Verified 24 records from 22 source files: 0 mismatched, 0 missing, 0 extra\n'
+
+    def test_verify_sequential(self, test_dir, capsys):
+        self.make_warc('http://www.iana.org/', test_dir, self.zip_filename)
+
+        # warcinfo is not in the log
+        res = verify_main(['-q', '--workers', '2', self.warc, test_dir, self.zip_filename])
+        out, err = capsys.readouterr()
+
+        assert res == 0
+        assert out == 'Verified 49 records from 44 source files: 0 mismatched, 0 missing, 0 extra\n'
+
+    def test_verify_changed_sources(self, test_dir, capsys):
+        self.make_warc('http://www.iana.org/', test_dir)
+
+        with open(os.path.join(test_dir, 'index.html'), 'ab') as fh:
+            fh.write(b'<!-- changed -->')
+
+        os.remove(os.path.join(test_dir, 'about', 'index.html'))
+
+        with open(os.path.join(test_dir, 'new.html'), 'wb') as fh:
+            fh.write(b'<html></html>')
+
+        res = verify_main(['-q', '--index', self.log, '--workers', '2', self.warc, test_dir])
+        out, err = capsys.readouterr()
+        lines = out.strip().split('\n')
+
+        assert res == 1
+        assert lines[-1] == 'Verified 24 records from 22 source files: 1 mismatched, 1 missing, 1 extra'
+        assert sorted(line.split(' ', 1)[0] for line in lines[:-1]) == ['EXTRA', 'MISMATCH', 'MISSING']
+        assert 'MISMATCH http://www.iana.org/index.html: WARC sha1:' in out
+        assert 'MISSING ' + os.path.join(test_dir, 'new.html') in out
+        assert 'EXTRA http://www.iana.org/about/index.html: source ' in out
+
+    def test_verify_corrupt_record(self, test_dir, capsys):
+        self.make_warc('--no-gzip', '-n', self.warc[:-3], 'http://www.iana.org/', test_dir)
+
+        with open(self.warc[:-3], 'r+b') as fh:
+            data = fh.read()
+            fh.seek(data.index(b'<html'))
+            fh.write(b'<HTML')
+
+        res = verify_main(['-q', '--index', self.log, self.warc[:-3]])
+        out, err = capsys.readouterr()
+
+        assert res == 1
+        assert out.count('MISMATCH') == 1
+        assert 'WARC record digest sha1:' in out
+
+    def test_verify_zstd(self, test_dir, capsys):
+        pytest.importorskip('zstandard')
+
+        self.make_warc('--zstd', '--zstd-dict', 'http://www.iana.org/', test_dir)
+
+        warc = self.warc[:-3] + '.zst'
+        for args in (['--index', self.log], []):
+            res = verify_main(['-q'] + args + [warc, test_dir])
+            out, err = capsys.readouterr()
+
+            assert res == 0
+            assert ' 0 mismatched, 0 missing, 0 extra' in out
+
+    def test_verify_base_dir(self, test_dir, capsys, monkeypatch):
+        base_dir = os.path.dirname(test_dir)
+        monkeypatch.chdir(base_dir)
+        self.make_warc('http://www.iana.org/', 'www.iana.org')
+
+        # relative sources resolved against the current directory by default
+        monkeypatch.chdir(os.path.dirname(os.path.realpath(__file__)))
+        res = verify_main(['-q', self.warc, test_dir])
+        out, err = capsys.readouterr()
+
+        assert res == 1
+        assert ' 0 mismatched, 22 missing, 22 extra' in out
+
+        res = verify_main(['-q', '--base-dir', base_dir, self.warc, test_dir])
+        out, err = capsys.readouterr()
+
+        # read sequentially, including the warcinfo record
+        assert res == 0
+        assert out == 'Verified 25 records from 22 source files: 0 mismatched, 0 missing, 0 extra\n'
+
+    def test_hash_sources_zip_opened_once(self, test_dir, monkeypatch):
+        opened = []
+        orig_zipfile = zipfile.ZipFile
+
+        def counting_zipfile(filename, *args, **kwargs):
+            opened.append(filename)
+            return orig_zipfile(filename, *args, **kwargs)
+
+        monkeypatch.setattr(zipfile, 'ZipFile', counting_zipfile)
+
+        with orig_zipfile(self.zip_filename) as zp:
+            members = [zinfo.filename for zinfo in zp.infolist() if not zinfo.filename.endswith('/')]
+
+        sources = [(self.zip_filename + '/' + member, 'sha1') for member in members]
+        sources.append((self.zip_filename + '/www.iana.org/no-such-member', 'sha1'))
+        sources.append((os.path.join(test_dir, 'index.html'), 'sha1'))
+
+        results = dict((filename, digest) for filename, algorithm, digest in _hash_sources(sources))
+
+        assert opened == [self.zip_filename]
+        assert len(results) == len(members) + 2
+        assert results[self.zip_filename + '/www.iana.org/no-such-member'] is None
+        assert results[self.zip_filename + '/www.iana.org/index.html'] == results[os.path.join(test_dir, 'index.html')]
+        assert results[self.zip_filename + '/www.iana.org/index.html'].startswith('sha1:')
@@ -105,6 +105,150 @@ class TestWarcIt(object):
         assert '"warc-target-uri": "http://www.iana.org/index.html", "content-type": "text/html; charset=windows-1258"' in out
         assert '"warc-target-uri": "http://www.iana.org/_css/2015.1/print.css", "content-type": "text/css; charset=utf-8"' in out
 
+    def test_warcit_detect_workers(self, capsys):
+        res = main(['-q', '-o', '-n', 'test3', '--charset', 'cchardet', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        warcio_main(['index', '-f', 'warc-target-uri,content-type', 'test3.warc.gz'])
+        inline_out, err = capsys.readouterr()
+
+        res = main(['-q', '-o', '-n', 'test3', '--charset', 'cchardet', '--detect-workers', '2',
+                    'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        warcio_main(['index', '-f', 'warc-target-uri,content-type', 'test3.warc.gz'])
+        pool_out, err = capsys.readouterr()
+
+        assert 'charset=' in pool_out
+        assert sorted(pool_out.split('\n')) == sorted(inline_out.split('\n'))
+
+    def test_warcit_detect_workers_zip(self, capsys, monkeypatch, tmpdir):
+        import warcit.detect
+        # zip members larger than this are spooled to a temp file for the workers
+        monkeypatch.setattr(warcit.detect, 'SPOOL_SIZE', 1024)
+        monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+
+        zip_prefix = self.zip_filename + '/www.iana.org/'
+
+        res = main(['-q', '-o', '-n', 'test3', '--charset', 'cchardet', 'http://www.iana.org/', zip_prefix])
+        assert res == 0
+
+        warcio_main(['index', '-f', 'warc-target-uri,content-type', 'test3.warc.gz'])
+        inline_out, err = capsys.readouterr()
+
+        res = main(['-q', '-o', '-n', 'test3', '--charset', 'cchardet', '--detect-workers', '2',
+                    'http://www.iana.org/', zip_prefix])
+        assert res == 0
+
+        warcio_main(['index', '-f', 'warc-target-uri,content-type', 'test3.warc.gz'])
+        pool_out, err = capsys.readouterr()
+
+        assert 'charset=' in pool_out
+        assert sorted(pool_out.split('\n')) == sorted(inline_out.split('\n'))
+
+        assert os.listdir(str(tmpdir)) == []
+
+    def test_warcit_stats(self):
+        res = main(['-q', '-o', '-n', 'test3', '--stats', 'stats.json', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        with open('stats.json', 'rt') as fh:
+            stats = json.load(fh)
+
+        stages = stats['stages']
+        assert stages['iter_inputs']['count'] == 22
+        assert stages['write_record']['count'] == 22
+        assert stages['index_revisit']['count'] == 2
+        assert stages['write_record']['bytes'] > 0
+
+        assert sum(stats['file_time_histogram'].values()) == 22
+        assert len(stats['slowest_files']) == 20
+        assert stats['slowest_files'][0]['time'] >= stats['slowest_files'][-1]['time']
+
+    def test_warcit_progress(self, capsys):
+        res = main(['-q', '-o', '-n', 'test3', '--progress', '--progress-interval', '0',
+                    'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        out, err = capsys.readouterr()
+        lines = err.strip().split('\n')
+
+        # one report per file, and a final report
+        assert len(lines) == 23
+        assert lines[0].startswith('1/22 files, ')
+        assert lines[-1].startswith('22/22 files, 2.7/2.7 MB, ')
+        assert 'MB/s in' in lines[-1]
+        assert lines[-1].endswith('ETA 0:00:00')
+
+    def test_warcit_profile(self, capsys):
+        import pstats
+        res = main(['-q', '-o', '-n', 'test3', '--profile', 'warcit.prof', '--profile-limit', '5',
+                    'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        out, err = capsys.readouterr()
+        assert 'Ordered by: cumulative time' in err
+
+        # only first 5 files profiled
+        stats = pstats.Stats('warcit.prof')
+        make_record = [value for key, value in stats.stats.items() if key[2] == 'make_record']
+        assert make_record[0][0] == 5
+
+    @pytest.mark.skipif(os.name == 'nt', reason='no SIGPROF')
+    def test_warcit_profile_sample(self, capsys):
+        res = main(['-q', '-o', '-n', 'test3', '--profile', 'warcit.folded', '--profile-mode', 'sample',
+                    'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        out, err = capsys.readouterr()
+        assert 'samples' in err
+
+        with open('warcit.folded') as fh:
+            for line in fh:
+                stack, count = line.rsplit(' ', 1)
+                assert int(count) > 0
+                assert ';' in stack
+
+    def test_warcit_log_csv(self):
+        res = main(['-q', '-o', '-n', 'test3', '--log', 'log.csv', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        with open('log.csv') as fh:
+            lines = fh.read().strip().split('\n')
+
+        assert lines[0].strip() == 'file,Record-Type,URL,timestamp,Content-Type,mime,charset'
+        assert len(lines) == 25
+
+    def test_warcit_log_jsonl(self):
+        res = main(['-q', '-o', '-n', 'test3', '--log', 'log.jsonl', '--log-format', 'jsonl',
+                    '--log-buffer-size', '1024', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        with open('log.jsonl') as fh:
+            rows = [json.loads(line) for line in fh]
+
+        assert len(rows) == 24
+        assert set(row['Record-Type'] for row in rows) == set(['resource', 'revisit'])
+
+        # offsets and lengths match the records in the WARC
+        with open('test3.warc.gz', 'rb') as fh:
+            it = ArchiveIterator(fh)
+            records = {}
+            for record in it:
+                if record.rec_type != 'warcinfo':
+                    record.content_stream().read()
+                    records[record.rec_headers['WARC-Target-URI']] = (it.get_record_offset(),
+                                                                      it.get_record_length(),
+                                                                      record.rec_headers.get('WARC-Payload-Digest'))
+
+        for row in rows:
+            assert row['warc'] == 'test3.warc.gz'
+            assert (row['offset'], row['length'], row['digest']) == records[row['URL']]
+            assert row['time'] >= 0
+
+            if row['Record-Type'] == 'resource':
+                assert row['bytes_read'] == os.path.getsize(row['file'])
+
     def test_warcit_use_charset_custom(self, capsys):
         res = main(['-q', '-o', '-n', 'test3', '--charset', 'custom', 'http://www.iana.org/', self.test_dir])
         assert res == 0
@@ -159,6 +303,356 @@ class TestWarcIt(object):
         assert 'www.iana.org.zip/www.iana.org/index.html"' in caplog.text
         assert os.path.isfile(os.path.join(self.root_dir, 'www.iana.org.warc.gz'))
 
+    def test_warcit_zip_digests(self, monkeypatch, capsys):
+        from warcit.base import ZipFileInfo
+        opens = []
+        orig_open = ZipFileInfo.open
+
+        def open_(file_info):
+            opens.append(file_info.internal_filename)
+            return orig_open(file_info)
+
+        monkeypatch.setattr(ZipFileInfo, 'open', open_)
+
+        res = main(['-q', '-o', '-n', 'test-zip', '--zip-spool-size', '10000',
+                    'http://www.iana.org/', self.zip_filename + '/www.iana.org/'])
+        assert res == 0
+
+        # members read once if small, twice if larger than spool size
+        with zipfile.ZipFile(self.zip_filename) as zp:
+            sizes = dict((zinfo.filename, zinfo.file_size) for zinfo in zp.infolist())
+
+        for name in set(opens):
+            assert opens.count(name) == (2 if sizes[name] > 10000 else 1)
+
+        assert any(sizes[name] > 10000 for name in opens)
+
+        res = main(['-q', '-o', '-n', 'test-dir', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        # same digests as from local files
+        warcio_main(['index', '-f', 'warc-target-uri,warc-payload-digest,warc-block-digest', 'test-zip.warc.gz'])
+        zip_out, err = capsys.readouterr()
+
+        warcio_main(['index', '-f', 'warc-target-uri,warc-payload-digest,warc-block-digest', 'test-dir.warc.gz'])
+        dir_out, err = capsys.readouterr()
+
+        zip_lines = sorted(line for line in zip_out.split('\n') if 'warc-target-uri' in line)
+        dir_lines = sorted(line for line in dir_out.split('\n') if 'warc-target-uri' in line)
+        assert len(zip_lines) == 24
+        assert zip_lines == dir_lines
+
+    @pytest.mark.parametrize('zstd_args', [[], ['--zstd-dict', '--zstd-level', '10', '--zstd-threads', '2']])
+    def test_warcit_zstd(self, zstd_args):
+        zstandard = pytest.importorskip('zstandard')
+        from warcit.zstdwriter import read_dictionary_frame
+
+        res = main(['-q', '-o', '-n', 'test-zstd', '--zstd', '--log', 'zstd.jsonl', '--log-format', 'jsonl'] +
+                   zstd_args + ['http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        with open('zstd.jsonl') as fh:
+            rows = [json.loads(line) for line in fh]
+
+        with open('test-zstd.warc.zst', 'rb') as fh:
+            dict_data = read_dictionary_frame(fh)
+            assert (dict_data is not None) == ('--zstd-dict' in zstd_args)
+
+            # each record is its own frame
+            for row in rows:
+                assert row['warc'] == 'test-zstd.warc.zst'
+                fh.seek(row['offset'])
+                decomp = zstandard.ZstdDecompressor(dict_data=dict_data).decompressobj()
+                data = decomp.decompress(fh.read(row['length']))
+                assert decomp.eof
+
+                record = next(ArchiveIterator(BytesIO(data)))
+                assert record.rec_headers['WARC-Target-URI'] == row['URL']
+
+    def test_warcit_zstd_dict_zip(self):
+        pytest.importorskip('zstandard')
+        from warcit.zstdwriter import read_dictionary_frame
+
+        res = main(['-q', '-o', '-n', 'test-zstd-zip', '--zstd', '--zstd-dict',
+                    'http://www.iana.org/', self.zip_filename + '/www.iana.org/'])
+        assert res == 0
+
+        with open('test-zstd-zip.warc.zst', 'rb') as fh:
+            assert read_dictionary_frame(fh) is not None
+
+    def test_warcit_stdout(self, capfdbinary):
+        res = main(['-q', '-n', '-', '--log', 'stdout.jsonl', '--log-format', 'jsonl',
+                    'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        out, err = capfdbinary.readouterr()
+
+        with open('stdout.jsonl') as fh:
+            rows = [json.loads(line) for line in fh]
+
+        # offsets counted while writing to stdout
+        it = ArchiveIterator(BytesIO(out))
+        records = {}
+        for record in it:
+            record.content_stream().read()
+            records[record.rec_headers.get('WARC-Target-URI')] = (it.get_record_offset(), it.get_record_length())
+
+        assert len(records) == 25
+        for row in rows:
+            assert row['warc'] == '-'
+            assert (row['offset'], row['length']) == records[row['URL']]
+
+        assert not os.path.isfile('-.warc.gz')
+
+    def test_warcit_stdout_no_append(self, capsys):
+        with pytest.raises(SystemExit):
+            main(['-q', '--stdout', '-a', 'http://www.iana.org/', self.test_dir])
+
+        out, err = capsys.readouterr()
+        assert '--append can not be used when writing to stdout' in err
+
+    @pytest.mark.parametrize('sort_inputs', ['inode', 'extent'])
+    def test_warcit_sort_inputs(self, sort_inputs):
+        res = main(['-q', '-o', '-n', 'test_sorted', '--sort-inputs', sort_inputs, '--sort-batch-size', '5',
+                    '--index-files', '', 'http://www.iana.org/', self.test_dir, self.zip_filename])
+        assert res == 0
+
+        with open('test_sorted.warc.gz', 'rb') as fh:
+            records = ArchiveIterator(fh)
+            warcinfo = next(records)
+            assert b'input-order: ' + sort_inputs.encode('utf-8') + b', batches of 5' in warcinfo.content_stream().read()
+
+            sources = [record.rec_headers['WARC-Source-URI'][len('file://'):] for record in records]
+
+        local = [source for source in sources if source.startswith(self.test_dir)]
+        assert len(local) == 22
+
+        # same files, in batches of 5 sorted by inode (or extent)
+        expected = []
+        for root, dirs, files in os.walk(self.test_dir):
+            expected.extend(os.path.join(root, name) for name in files)
+
+        assert sorted(local) == sorted(expected)
+        if sort_inputs == 'inode':
+            for i in range(0, len(local), 5):
+                inodes = [os.stat(filename).st_ino for filename in local[i:i + 5]]
+                assert inodes == sorted(inodes)
+
+        # zip members in order of their position in the zip file
+        members = [source[len(self.zip_filename) + 1:] for source in sources[len(local):]]
+        with zipfile.ZipFile(self.zip_filename) as zp:
+            offsets = dict((zinfo.filename, zinfo.header_offset) for zinfo in zp.infolist())
+
+        assert len(members) == 22
+        assert [offsets[name] for name in members] == sorted(offsets[name] for name in members)
+
+    def test_warcit_mmap(self):
+        def load_records(name):
+            with open(name, 'rb') as fh:
+                return [(record.rec_headers['WARC-Target-URI'],
+                         record.rec_headers['WARC-Payload-Digest'],
+                         record.rec_headers['WARC-Block-Digest'],
+                         record.content_stream().read())
+                        for record in ArchiveIterator(fh) if record.rec_type == 'resource']
+
+        res = main(['-q', '-o', '-n', 'test_read', '--mmap-size', '0', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        res = main(['-q', '-o', '-n', 'test_mmap', '--mmap-size', '1', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        records = load_records('test_mmap.warc.gz')
+        assert len(records) == 22
+        assert records == load_records('test_read.warc.gz')
+
+    def test_warcit_plan(self, capsys):
+        res = main(['-q', '-n', 'test_plan', '--plan', '--exclude', '*.js', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        # nothing written
+        assert not os.path.exists('test_plan.warc.gz')
+
+        out, err = capsys.readouterr()
+        lines = out.split('\n')
+        assert lines[0] == 'Plan for test_plan.warc.gz'
+        assert lines[1].startswith('  Files:       20 (')
+        assert lines[1].endswith(' MB), 2 excluded')
+        assert lines[2] == '  Records:     22 (20 resource, 2 revisit) + warcinfo'
+        assert lines[3].endswith(', from 20 sampled files')
+        assert lines[4] == '  WARC files:  1'
+
+        breakdown = dict((line.split()[0], line.split()[1:]) for line in lines[7:] if line)
+        assert breakdown['.html'][0] == '2'
+        assert breakdown['.css'][0] == '2'
+        assert '.js' not in breakdown
+
+        estimate = float(lines[3].split()[2])
+
+        res = main(['-q', '-n', 'test_plan', '--exclude', '*.js', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        actual = os.path.getsize('test_plan.warc.gz') / (1024.0 * 1024.0)
+        assert actual / 2 < estimate < actual * 2
+
+    def test_warcit_plan_mapfile_zstd(self):
+        from warcit.warcit import WARCIT
+        from warcit.plan import Planner
+
+        with open('plan_mapfile.csv', 'wt') as fh:
+            fh.write('file,Content-Type\n')
+            fh.write('www.iana.org/index.html,application/x-test; charset=utf-8\n')
+
+        planner = Planner(WARCIT('http://www.iana.org/', [self.test_dir], mapfile='plan_mapfile.csv'),
+                          stream=BytesIO())
+        planner.warcit.load_mapfile()
+        planner.scan()
+
+        assert planner.groups[('.html', 'application/x-test')] == [1, os.path.getsize(os.path.join(self.test_dir, 'index.html'))]
+        assert planner.groups[('.html', 'text/html')][0] == 1
+
+        res = main(['-q', '-n', 'test_plan', '--plan', '--mapfile', 'plan_mapfile.csv', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        pytest.importorskip('zstandard')
+
+        # record overhead of a zstd frame, not a gzip member
+        overhead = Planner(WARCIT('http://www.iana.org/', [], zstd=True)).get_record_overhead()
+        gzip_overhead = Planner(WARCIT('http://www.iana.org/', [])).get_record_overhead()
+        assert overhead != gzip_overhead
+
+    def test_warcit_output_sync(self):
+        res = main(['-q', '-o', '-n', 'test_sync', '--buffer-size', '65536', '--preallocate', '1',
+                    '--sync-every', '0', '--stats', 'stats.json', '--log', 'test_sync.jsonl', '--log-format', 'jsonl',
+                    'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        with open('stats.json', 'rt') as fh:
+            stages = json.load(fh)['stages']
+
+        # synced after each file
+        assert stages['output_sync']['count'] == 22
+        assert stages['output_write']['bytes'] == stages['output_sync']['bytes']
+        assert stages['output_write']['max'] <= stages['output_write']['time']
+
+        # preallocated space truncated
+        size = os.path.getsize('test_sync.warc.gz')
+        assert size == stages['output_write']['bytes']
+
+        with open('test_sync.jsonl', 'rt') as fh:
+            last = json.loads(fh.read().strip().split('\n')[-1])
+
+        assert last['offset'] + last['length'] == size
+
+        with open('test_sync.warc.gz', 'rb') as fh:
+            assert len(list(ArchiveIterator(fh))) == 25
+
+    def test_warcit_preallocate_append(self, capsys):
+        with pytest.raises(SystemExit):
+            main(['-q', '-a', '--preallocate', '1', 'http://www.iana.org/', self.test_dir])
+
+        assert '--preallocate can not be used with --append' in capsys.readouterr().err
+
+    def test_warcit_from_list_csv(self, capsys, caplog):
+        with open('list.csv', 'wt') as fh:
+            fh.write('file,URL,timestamp,Content-Type\n')
+            fh.write('{0},http://example.com/,20100102030405,text/plain; charset=utf-8\n'.format(
+                     os.path.join(self.test_dir, 'index.html')))
+            fh.write('{0},,,\n'.format(os.path.join(self.test_dir, 'robots.txt')))
+            fh.write('{0},,,\n'.format(os.path.join(self.test_dir, 'no-such-file')))
+            fh.write('{0},,,\n'.format(self.zip_filename))
+
+        res = main(['-o', '-n', 'test_list', '--from-list', 'list.csv', '--list-root', self.test_dir,
+                    'http://www.iana.org/'])
+        assert res == 0
+
+        assert 'Reading input list with header row, columns: file, URL, timestamp, Content-Type' in caplog.text
+        assert 'not a valid file' in caplog.text
+        assert 'www.iana.org.zip" not in the list root' in caplog.text
+        assert 'Wrote 2 resources to test_list.warc.gz' in caplog.text
+
+        warcio_main(['index', '-f', 'warc-target-uri,warc-date,content-type', 'test_list.warc.gz'])
+        out, err = capsys.readouterr()
+
+        assert '"warc-target-uri": "http://example.com/", "warc-date": "2010-01-02T03:04:05Z", "content-type": "text/plain; charset=utf-8"' in out
+        assert '"warc-target-uri": "http://www.iana.org/robots.txt"' in out
+        assert self.test_dir.strip('/') not in out
+
+    def test_warcit_from_list_unknown_column(self, capsys, monkeypatch):
+        from io import StringIO
+
+        with open('list.csv', 'wt') as fh:
+            fh.write('file,URL,mime\n')
+            fh.write('{0},http://example.com/,text/html\n'.format(os.path.join(self.test_dir, 'index.html')))
+
+        with pytest.raises(SystemExit):
+            main(['-q', '-o', '-n', 'test_list', '--from-list', 'list.csv', 'http://www.iana.org/'])
+
+        assert 'Unknown column "mime" in input list' in capsys.readouterr().err
+
+        # only read once writing, from stdin
+        with open('list.csv', 'rt') as fh:
+            monkeypatch.setattr(sys, 'stdin', StringIO(fh.read()))
+
+        with pytest.raises(SystemExit) as exc:
+            main(['-q', '-o', '-n', 'test_list', '--from-list', '-', 'http://www.iana.org/'])
+
+        assert exc.value.code == 1
+
+    def test_warcit_from_list_plain(self, capsys, caplog):
+        # a first file named "file" is a path, not a header row
+        with open('file', 'wt') as fh:
+            fh.write('Some Text')
+
+        with open('list.txt', 'wt') as fh:
+            fh.write('file\n')
+            fh.write('{0}\n'.format(os.path.join(self.test_dir, 'robots.txt')))
+
+        res = main(['-o', '-n', 'test_list', '--from-list', 'list.txt', 'http://example.com/'])
+        assert res == 0
+
+        assert 'header row' not in caplog.text
+        assert 'Wrote 2 resources to test_list.warc.gz' in caplog.text
+
+        warcio_main(['index', '-f', 'warc-target-uri', 'test_list.warc.gz'])
+        out, err = capsys.readouterr()
+
+        assert '"warc-target-uri": "http://example.com/file"' in out
+
+    def test_warcit_from_list_stdin(self, monkeypatch, capsys):
+        from io import StringIO
+
+        paths = []
+        for root, dirs, files in os.walk(self.test_dir):
+            paths.extend(os.path.relpath(os.path.join(root, name)) for name in files)
+
+        monkeypatch.setattr(sys, 'stdin', StringIO('\n'.join(paths) + '\n'))
+
+        res = main(['-q', '-o', '-n', 'test_list', '--from-list', '-', '--list-root', 'www.iana.org',
+                    'http://www.iana.org/'])
+        assert res == 0
+
+        warcio_main(['index', '-f', 'warc-type,warc-target-uri', 'test_list.warc.gz'])
+        list_out, err = capsys.readouterr()
+
+        assert list_out.count('"warc-type": "resource"') == 22
+        assert '"warc-type": "resource", "warc-target-uri": "http://www.iana.org/about/index.html"' in list_out
+        assert '"warc-type": "revisit", "warc-target-uri": "http://www.iana.org/about/"' in list_out
+
+        # same URLs as for the directory
+        res = main(['-q', '-o', '-n', 'test_list', 'http://www.iana.org/', self.test_dir])
+        assert res == 0
+
+        warcio_main(['index', '-f', 'warc-type,warc-target-uri', 'test_list.warc.gz'])
+        dir_out, err = capsys.readouterr()
+
+        assert sorted(list_out.split('\n')) == sorted(dir_out.split('\n'))
+
+    def test_warcit_no_inputs(self, capsys):
+        with pytest.raises(SystemExit):
+            main(['-q', 'http://www.iana.org/'])
+
+        assert 'no inputs given' in capsys.readouterr().err
+
     def test_warcit_no_such_zip_prefix(self, caplog):
         res = main(['-o', '-v', 'http://www.iana.org/', self.zip_filename + '/www.example.com/'])
         assert res == 0
@@ -325,3 +819,389 @@ transclusions:
 
         formats = ['png', 'webm', 'mp4', 'mkv', 'flv']
         assert [format_['ext'] for format_ in metadata['formats']] == formats
+
+
+# ============================================================================
+def test_detection_pool_cache(tmpdir):
+    from warcit.detect import DetectionPool
+    from warcit.base import PrefixedFileInfo
+
+    file_infos = []
+    for name in ('a.html', 'b.html', 'c.png'):
+        filename = os.path.join(str(tmpdir), name)
+        with open(filename, 'wb') as fh:
+            fh.write('<html>Détecté</html>'.encode('utf-8'))
+
+        file_infos.append(PrefixedFileInfo('http://example.com/', name, filename))
+
+    def guess_type(file_info):
+        return 'image/png' if file_info.url.endswith('.png') else 'text/html'
+
+    pool = DetectionPool(detect_charset=True, guess_type=guess_type, max_workers=1)
+    try:
+        results = []
+        for file_info in file_infos:
+            pool.submit(file_info)
+            results.append(pool.get_results(file_info))
+
+    finally:
+        pool.close()
+
+    assert results[0]['charset'].lower() == 'utf-8'
+    assert results[1]['charset'].lower() == 'utf-8'
+    assert 'charset' not in results[2]
+
+    assert pool.misses == 1
+    assert pool.hits == 1
+
+
+STARTUP_LAZY = ['yaml', 'cchardet', 'magic', 'tika', 'pkg_resources', 'mimetypes',
+                'concurrent.futures', 'http.client', 'zipfile', 'zstandard']
+
+
+# warcio's package always imports warcio.warcwriter, so only the warcit
+# writer modules can be checked for the tools that don't write WARCs
+@pytest.mark.parametrize('module, lazy', [
+    ('warcit.warcit', STARTUP_LAZY),
+    ('warcit.converter', STARTUP_LAZY + ['warcit.warcit', 'warcit.api']),
+    ('warcit.verify', STARTUP_LAZY + ['warcit.warcit', 'warcit.api']),
+])
+def test_startup_imports(module, lazy):
+    import subprocess
+    code = '''
+import sys
+import {0}
+print(','.join(name for name in {1!r} if name in sys.modules))
+'''.format(module, lazy)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.decode('utf-8').strip() == ''
+
+
+def test_package_lazy_exports():
+    import subprocess
+
+    # no runpy warning about warcit.warcit being imported by the package
+    output = subprocess.check_output([sys.executable, '-W', 'error::RuntimeWarning',
+                                      '-m', 'warcit.warcit', '-V'])
+    assert output.decode('utf-8').startswith('warcit.py ')
+
+    import warcit
+    from warcit.api import write_warc
+    assert warcit.write_warc is write_warc
+    with pytest.raises(AttributeError):
+        warcit.no_such_name
+
+
+def test_version(capsys):
+    with pytest.raises(SystemExit) as exc:
+        main(['-V'])
+
+    from warcit.base import get_version
+    assert exc.value.code == 0
+    assert capsys.readouterr().out.split(' ')[-1] == get_version().split(' ')[-1] + '\n'
+
+
+def test_digest_manifest(tmpdir, caplog):
+    import hashlib
+    bag_dir = os.path.join(str(tmpdir), 'bag')
+    os.makedirs(os.path.join(bag_dir, 'data'))
+
+    lines = []
+    for name in ('a.html', 'b.html', 'c.txt'):
+        data = ('Some Text ' + name).encode('utf-8')
+        with open(os.path.join(bag_dir, 'data', name), 'wb') as fh:
+            fh.write(data)
+
+        lines.append('{0}  data/{1}\n'.format(hashlib.sha256(data).hexdigest(), name))
+
+    manifest = os.path.join(bag_dir, 'manifest-sha256.txt')
+    with open(manifest, 'wt') as fh:
+        fh.write(''.join(lines))
+
+    warc = os.path.join(str(tmpdir), 'bag.warc.gz')
+    res = main(['-q', '-n', warc, '--digest-manifest', manifest, '--verify-rate', '0.5',
+                'http://example.com/', os.path.join(bag_dir, 'data')])
+    assert res == 0
+
+    with open(warc, 'rb') as fh:
+        for record in ArchiveIterator(fh):
+            if record.rec_type == 'resource':
+                digest = record.rec_headers['WARC-Payload-Digest']
+                assert digest.startswith('sha256:')
+                assert record.rec_headers['WARC-Block-Digest'] == digest
+
+    # stale manifest: a changed file is detected when verified
+    with open(os.path.join(bag_dir, 'data', 'b.html'), 'wb') as fh:
+        fh.write(b'Changed')
+
+    os.utime(os.path.join(bag_dir, 'data', 'b.html'), (0, 0))
+
+    res = main(['-q', '-o', '-n', warc, '--digest-manifest', manifest, '--verify-rate', '1',
+                'http://example.com/', os.path.join(bag_dir, 'data')])
+    assert res == 1
+    assert 'Digest manifest mismatch' in caplog.text
+
+
+def test_to_warc_digest():
+    from warcit.manifest import to_warc_digest
+    assert to_warc_digest('sha1', '358ccf9d29ba62e12d5b518381dbb3f8ddc36b6b') == 'sha1:GWGM7HJJXJROCLK3KGBYDW5T7DO4G23L'
+
+    with pytest.raises(ValueError):
+        to_warc_digest('sha256', '358ccf9d29ba62e12d5b518381dbb3f8ddc36b6b')
+
+
+def test_write_warc_api(tmpdir):
+    import datetime
+    from warcit import write_warc, StreamFileInfo
+
+    filename = os.path.join(str(tmpdir), 'c.txt')
+    with open(filename, 'wb') as fh:
+        fh.write(b'Some Text')
+
+    inputs = iter([StreamFileInfo('http://example.com/a.html', BytesIO(b'<html>A</html>'), 14, 'a.html',
+                                  datetime.datetime(2020, 1, 2)),
+                   filename,
+                   StreamFileInfo('http://example.com/b/index.html', BytesIO(b'<html>B</html>'), 14, 'b/index.html')])
+
+    # output without tell(), offsets are counted
+    class Output(object):
+        def __init__(self):
+            self.buff = BytesIO()
+
+        def write(self, data):
+            self.buff.write(data)
+
+        def flush(self):
+            pass
+
+    output = Output()
+    results = list(write_warc(inputs, output, 'http://example.com/', index_files='index.html'))
+
+    assert [(url, info['Record-Type']) for url, info, offset in results] == [
+        ('http://example.com/a.html', 'resource'),
+        ('http://example.com/c.txt', 'resource'),
+        ('http://example.com/b/index.html', 'resource'),
+        ('http://example.com/b/', 'revisit'),
+    ]
+
+    assert results[0][1]['timestamp'] == '2020-01-02T00:00:00Z'
+    assert results[1][1]['file'] == filename
+
+    it = ArchiveIterator(BytesIO(output.buff.getvalue()))
+    offsets = {}
+    for record in it:
+        if record.rec_type == 'warcinfo':
+            assert record.rec_headers['WARC-Filename'] == 'warcit.warc.gz'
+        else:
+            offsets[record.rec_headers['WARC-Target-URI']] = it.get_record_offset()
+
+    for url, info, offset in results:
+        assert offsets[url] == offset == info['offset']
+
+
+def test_warcinfo_cmdline(capfdbinary):
+    args = ['-q', '-n', '-', 'http://example.com/', __file__]
+    argv = list(sys.argv)
+
+    assert main(args) == 0
+    assert sys.argv == argv
+    assert args[0] == '-q'
+
+    out, err = capfdbinary.readouterr()
+    record = next(ArchiveIterator(BytesIO(out)))
+    assert record.rec_type == 'warcinfo'
+    assert b'cmdline: warcit -q -n - http://example.com/ ' in record.content_stream().read()
+
+
+def test_open_mapped(tmpdir, monkeypatch):
+    from warcit.base import FileInfo, MappedFile
+
+    filename = str(tmpdir / 'data.bin')
+    with open(filename, 'wb') as fh:
+        fh.write(b'0123456789' * 100)
+
+    file_info = FileInfo('http://example.com/data.bin', filename)
+
+    with file_info.open_mapped(1000) as fh:
+        assert isinstance(fh, MappedFile)
+        assert bytes(fh.read(5)) == b'01234'
+        assert fh.tell() == 5
+        fh.seek(-3, 2)
+        assert bytes(fh.read(10)) == b'789'
+        assert bytes(fh.read(10)) == b''
+        fh.seek(0)
+        data = fh.read()
+        assert len(data) == 1000
+
+    # slice still referenced after close
+    assert bytes(data[:3]) == b'012'
+
+    # below the size, or disabled
+    with file_info.open_mapped(1001) as fh:
+        assert not isinstance(fh, MappedFile)
+
+    with file_info.open_mapped(0) as fh:
+        assert not isinstance(fh, MappedFile)
+
+    # regular file if mapping fails
+    import mmap
+    def fail(*args, **kwargs):
+        raise mmap.error('not supported')
+
+    monkeypatch.setattr(mmap, 'mmap', fail)
+    with file_info.open_mapped(1) as fh:
+        assert not isinstance(fh, MappedFile)
+        assert fh.read(5) == b'01234'
+
+
+def make_many_files(root, count):
+    for i in range(count):
+        dirname = os.path.join(root, 'dir{0}'.format(i // 100))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with open(os.path.join(dirname, 'file{0}.html'.format(i)), 'wb') as fh:
+            fh.write('<html>{0}</html>'.format(i).encode('utf-8'))
+
+
+def test_file_info_slots(tmpdir):
+    from warcit.base import FileInfo, PrefixedFileInfo, ZipFileInfo, StreamFileInfo
+    from warcit.converter import InlineConversionInfo
+
+    filename = str(tmpdir / 'a.html')
+    with open(filename, 'wb') as fh:
+        fh.write(b'<html></html>')
+
+    zip_filename = str(tmpdir / 'a.zip')
+    with zipfile.ZipFile(zip_filename, 'w') as zp:
+        zp.write(filename, 'a.html')
+
+    with zipfile.ZipFile(zip_filename) as zp:
+        file_infos = [FileInfo('http://example.com/a.html', filename),
+                      PrefixedFileInfo('http://example.com/', 'a.html', filename),
+                      ZipFileInfo('http://example.com/', zp, zp.infolist()[0], ''),
+                      StreamFileInfo('http://example.com/a.html', BytesIO(b'<html></html>'), 13, filename),
+                      InlineConversionInfo('http://example.com/a.html.txt', BytesIO(b''), 0, filename),
+                     ]
+
+    for file_info in file_infos:
+        assert not hasattr(file_info, '__dict__')
+
+
+def test_flat_memory(tmpdir):
+    import tracemalloc
+    from warcit.api import write_warc
+    from warcit.base import PrefixedFileInfo
+
+    def peak_memory(count):
+        root = str(tmpdir / 'files{0}'.format(count))
+        make_many_files(root, count)
+
+        logfile = str(tmpdir / 'log{0}.csv'.format(count))
+        with open(os.devnull, 'wb') as out:
+            tracemalloc.start()
+            try:
+                for result in write_warc([root], out, 'http://example.com/', logfile=logfile):
+                    pass
+
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    # first run includes lazy imports
+    peak_memory(100)
+
+    small = peak_memory(500)
+    large = peak_memory(4000)
+
+    assert large < small * 1.25
+
+    # mapfile results are dropped once written, even if the file info is kept
+    mapfile = str(tmpdir / 'mapfile.csv')
+    with open(mapfile, 'wt') as fh:
+        fh.write('file,timestamp\n')
+        for i in range(10):
+            fh.write('file{0}.html,20190103020000\n'.format(i))
+
+    root = str(tmpdir / 'files100')
+    file_infos = [PrefixedFileInfo('http://example.com/', 'file{0}.html'.format(i),
+                                   os.path.join(root, 'dir0', 'file{0}.html'.format(i)))
+                  for i in range(10)]
+
+    with open(os.devnull, 'wb') as out:
+        results = list(write_warc(file_infos, out, 'http://example.com/', mapfile=mapfile))
+
+    assert len(results) == 10
+    assert [file_info.mapfile_results for file_info in file_infos] == [None] * 10
+
+
+def test_mapfile_memory(tmpdir):
+    import tracemalloc
+    from warcit.warcit import WARCIT
+
+    def mapfile_memory(count):
+        mapfile = str(tmpdir / 'mapfile{0}.csv'.format(count))
+        with open(mapfile, 'wt') as fh:
+            fh.write('file,URL\n')
+            for i in range(count):
+                fh.write('dir{0}/file{1}.html,http://example.com/mapped/file{1}.html\n'.format(i // 100, i))
+
+        warcit = WARCIT('http://example.com/', [], mapfile=mapfile)
+        tracemalloc.start()
+        try:
+            assert warcit.load_mapfile()
+            return tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    # the file and URL strings of a row are about 150 bytes, a dict
+    # per row would add about 200 more
+    per_row = (mapfile_memory(11000) - mapfile_memory(1000)) / 10000.0
+    assert per_row < 150 + 120
+
+
+def test_sort_batch_memory(tmpdir):
+    import tracemalloc
+    from warcit.base import BaseTool
+
+    def batch_memory(count):
+        root = str(tmpdir / 'files{0}'.format(count))
+        make_many_files(root, count)
+
+        # all file infos held in one batch
+        tool = BaseTool('http://example.com/', [root], sort_inputs='inode', sort_batch_size=count)
+
+        values_size = 0
+        tracemalloc.start()
+        try:
+            for file_info in tool.iter_inputs():
+                values_size += sum(sys.getsizeof(value) for value in (file_info, file_info.url, file_info.full_filename,
+                                                                      file_info.root_dir, file_info.modified_dt))
+
+            return tracemalloc.get_traced_memory()[1], values_size
+        finally:
+            tracemalloc.stop()
+
+    small, small_values = batch_memory(1000)
+    large, large_values = batch_memory(5000)
+
+    # apart from the sort keys, little more than the file infos (without a
+    # __dict__) and their values
+    assert (large - small) < (large_values - small_values) * 1.45
+
+
+def test_run_closes_on_error(tmpdir, monkeypatch):
+    from warcit.warcit import WARCIT
+
+    def iter_records(self, output):
+        raise IOError('write failed')
+
+    closed = []
+    monkeypatch.setattr(WARCIT, 'iter_records', iter_records)
+    monkeypatch.setattr(WARCIT, 'close', lambda self: closed.append(True) or 0)
+
+    warcit = WARCIT('http://example.com/', [], name=str(tmpdir / 'test'))
+    with pytest.raises(IOError):
+        warcit.run()
+
+    assert closed == [True]
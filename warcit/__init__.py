@@ -0,0 +1,24 @@
+import sys
+
+
+# exported lazily, so that importing any warcit module doesn't load the writer
+_EXPORTS = {
+    'write_warc': 'warcit.api',
+    'WARCITError': 'warcit.api',
+    'FileInfo': 'warcit.base',
+    'StreamFileInfo': 'warcit.base',
+}
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module 'warcit' has no attribute '{0}'".format(name))
+
+    import importlib
+    return getattr(importlib.import_module(_EXPORTS[name]), name)
+
+
+# no module __getattr__ before python 3.7
+if sys.version_info < (3, 7):  # pragma: no cover
+    from warcit.api import write_warc, WARCITError
+    from warcit.base import FileInfo, StreamFileInfo
@@ -0,0 +1,33 @@
+from __future__ import absolute_import
+
+from warcit.warcit import WARCIT
+
+
+# ============================================================================
+class WARCITError(Exception):
+    pass
+
+
+# ============================================================================
+def write_warc(inputs, output, url_prefix='', **kwargs):
+    """ Write a WARC of inputs to output, any binary file-like object,
+    yielding a (url, record info, offset) tuple for each record as it is written.
+
+    ``inputs`` is an iterable of paths (files, directories or zip files, as on
+    the command line) and/or FileInfo objects, eg. a StreamFileInfo for
+    content in memory. The other keyword arguments are as for WARCIT, eg.
+    ``gzip``, ``fixed_dt``, ``use_magic`` or ``charset``.
+
+    The record info is a dict with the same fields as the jsonl log.
+    The output is not closed.
+    """
+    warcit = WARCIT(url_prefix, inputs, **kwargs)
+    if not warcit.load():
+        raise WARCITError('Could not load everything needed to write the WARC, see log for details')
+
+    try:
+        for result in warcit.iter_records(output):
+            yield result
+
+    finally:
+        warcit.close()
@@ -1,14 +1,47 @@
 import os
 import sys
 import datetime
-import zipfile
+import itertools
 import logging
 
+from warcit.stats import timer
+
+from io import BytesIO
+from argparse import Action, SUPPRESS
+
+
+BUFF_SIZE = 65536
+
+# columns of a --from-list file, as for the mapfile
+LIST_COLUMNS = ('file', 'URL', 'timestamp', 'Content-Type')
+
 
 # ============================================================================
 def get_version():
-    import pkg_resources
-    return '%(prog)s ' + pkg_resources.get_distribution('warcit').version
+    try:
+        from importlib.metadata import version
+    except ImportError:  #pragma: no cover
+        from pkg_resources import get_distribution
+        return '%(prog)s ' + get_distribution('warcit').version
+
+    return '%(prog)s ' + version('warcit')
+
+
+# ============================================================================
+class VersionAction(Action):
+    """ Like argparse 'version' action, but only looks up the version when requested
+    """
+    def __init__(self, option_strings, dest=SUPPRESS, default=SUPPRESS,
+                 help="show program's version number and exit"):
+        super(VersionAction, self).__init__(option_strings=option_strings,
+                                            dest=dest,
+                                            default=default,
+                                            nargs=0,
+                                            help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser._print_message(get_version() % dict(prog=parser.prog) + '\n', sys.stdout)
+        parser.exit()
 
 
 # ============================================================================
@@ -24,16 +57,61 @@ def init_logging(r):
     logging.getLogger('WARCIT').setLevel(loglevel)
 
 
+# ============================================================================
+def parse_list_header(line):
+    """ Columns and csv dialect of the header row of an input list, or None
+    if the list has no header row, being one path per line. The header must
+    start with the "file" column and name at least one other known column,
+    so that a plain list starting with a file named "file" is not a header.
+    """
+    header = line.rstrip('\r\n')
+    if not header.startswith(('file,', 'file\t')):
+        return None
+
+    import csv
+    dialect = 'excel-tab' if '\t' in header else 'excel'
+    columns = next(csv.reader([header], dialect=dialect))
+    if not any(column in LIST_COLUMNS[1:] for column in columns):
+        return None
+
+    for column in columns:
+        if column not in LIST_COLUMNS:
+            raise ValueError('Unknown column "{0}" in input list, expected one of: {1}'.format(column, ', '.join(LIST_COLUMNS)))
+
+    return columns, dialect
+
+
 # ============================================================================
 class BaseTool(object):
-    def __init__(self, url_prefix, inputs):
+    def __init__(self, url_prefix, inputs, sort_inputs=None, sort_batch_size=None, from_list=None, list_root=None):
         self.logger = logging.getLogger('WARCIT')
         self.url_prefix = url_prefix
         self.inputs = inputs
 
+        # file listing input files, or '-' for stdin, and the directory
+        # their URLs are relative to, by default the current directory
+        self.from_list = from_list
+        self.list_root = list_root
+
+        # 'none', 'inode' or 'extent', see warcit.ordering
+        self.sort_inputs = sort_inputs if sort_inputs != 'none' else None
+        self.sort_batch_size = sort_batch_size
+
     def iter_inputs(self):
+        if not self.sort_inputs:
+            return self._iter_inputs()
+
+        from warcit.ordering import InputSorter, SORT_BATCH_SIZE
+        sorter = InputSorter(self.sort_inputs, self.sort_batch_size or SORT_BATCH_SIZE)
+        return sorter(self._iter_inputs())
+
+    def _iter_inputs(self):
         for input_ in self.inputs:
-            if os.path.isdir(input_):
+            # already a FileInfo, eg. for content in memory
+            if isinstance(input_, FileInfo):
+                yield input_
+
+            elif os.path.isdir(input_):
                 for root, dirs, files in os.walk(input_):
                     for name in files:
                         filename = os.path.join(root, name)
@@ -50,8 +128,14 @@ class BaseTool(object):
                         self.logger.error('"{0}" not a valid file or directory'.format(input_))
 
                 else:
+                    import zipfile
                     with zipfile.ZipFile(filename) as zp:
-                        for zinfo in zp.infolist():
+                        zinfos = zp.infolist()
+                        # members are read in place, so sort by position in the zip file
+                        if self.sort_inputs:
+                            zinfos = sorted(zinfos, key=lambda zinfo: zinfo.header_offset)
+
+                        for zinfo in zinfos:
                             if zinfo.filename.endswith('/'):
                                 continue
 
@@ -60,11 +144,87 @@ class BaseTool(object):
 
                             yield ZipFileInfo(self.url_prefix, zp, zinfo, zip_prefix)
 
+        if self.from_list:
+            for file_info in self._iter_list():
+                yield file_info
+
+    def _iter_list(self):
+        """ Files listed in from_list, one path per line, or as CSV or TSV with
+        a header row, like the mapfile, with a "file" column and optional "URL",
+        "timestamp" and "Content-Type" columns. The list is read as the files
+        are processed, without walking any directories.
+        """
+        if self.from_list == '-':
+            fh = sys.stdin
+        else:
+            fh = open(self.from_list, 'r', newline='')
+
+        try:
+            first = fh.readline()
+
+            try:
+                header = parse_list_header(first)
+            except ValueError as e:
+                self.logger.error(e)
+                sys.exit(1)
+
+            if header:
+                self.logger.info('Reading input list with header row, columns: {0}'.format(', '.join(header[0])))
+                rows = self._iter_list_rows(header, fh)
+            else:
+                rows = ({'file': line.rstrip('\r\n')} for line in itertools.chain([first], fh))
+
+            root = os.path.abspath(self.list_root or os.getcwd())
+
+            for row in rows:
+                file_info = self._make_list_file_info(row, root)
+                if file_info:
+                    yield file_info
+
+        finally:
+            if fh is not sys.stdin:
+                fh.close()
+
+    def _iter_list_rows(self, header, fh):
+        import csv
+        columns, dialect = header
+        for values in csv.reader(fh, dialect=dialect):
+            if values:
+                yield dict(zip(columns, values))
+
+    def _make_list_file_info(self, row, root):
+        filename = row.pop('file')
+        if not filename:
+            return None
+
+        if not os.path.isfile(filename):
+            self.logger.error('"{0}" not a valid file'.format(filename))
+            return None
+
+        url = row.pop('URL', None)
+        if url:
+            file_info = FileInfo(url, filename)
+        else:
+            # relative to the root, as for the files of a directory input
+            path = os.path.relpath(os.path.abspath(filename), root)
+            if path.startswith(os.pardir + os.sep):
+                self.logger.error('"{0}" not in the list root "{1}", and has no URL'.format(filename, root))
+                return None
+
+            file_info = PrefixedFileInfo(self.url_prefix, path, filename, os.path.dirname(root))
+
+        # timestamp and Content-Type, used as the results of a mapfile match
+        results = dict((name, value) for name, value in row.items() if value)
+        if results:
+            file_info.mapfile_results = results
+
+        return file_info
+
     def parse_filename(self, filename):
         zip_path = []
         while filename:
             if os.path.isfile(filename):
-                if filename.endswith('.zip') and zipfile.is_zipfile(filename):
+                if filename.endswith('.zip') and is_zipfile(filename):
                     return True, filename, '/'.join(zip_path)
                 else:
                     return False, filename, ''
@@ -79,8 +239,21 @@ class BaseTool(object):
         return False, '', ''
 
 
+# ============================================================================
+def is_zipfile(filename):
+    import zipfile
+    return zipfile.is_zipfile(filename)
+
+
 # ============================================================================
 class FileInfo(object):
+    # content is read directly from full_filename
+    is_local = True
+
+    # no per-instance dict, as there may be millions of file infos
+    __slots__ = ('url', 'full_filename', 'root_dir', 'modified_dt', 'size',
+                 'mapfile_results', 'tika_results', 'detect_results')
+
     def __init__(self, url, filename, root_dir=None):
         self.url = url
         self.full_filename = filename
@@ -88,6 +261,7 @@ class FileInfo(object):
 
         self.mapfile_results = None
         self.tika_results = None
+        self.detect_results = None
 
         self._init_stats()
 
@@ -99,9 +273,27 @@ class FileInfo(object):
     def open(self):
         return open(self.full_filename, 'rb')
 
+    def open_mapped(self, min_size):
+        """ Open the file memory-mapped if at least ``min_size`` bytes, for
+        reading the payload without copying it, or as a regular file if smaller,
+        not local or if it can't be mapped
+        """
+        fh = self.open()
+        if not self.is_local or not min_size or self.size < min_size:
+            return fh
+
+        try:
+            with fh:
+                return MappedFile(fh)
+        except (ImportError, ValueError, EnvironmentError) as e:
+            logging.getLogger('WARCIT').debug('Not memory-mapping "{0}": {1}'.format(self.full_filename, e))
+            return self.open()
+
 
 # ============================================================================
 class PrefixedFileInfo(FileInfo):
+    __slots__ = ()
+
     def __init__(self, url_prefix, path, filename, root_dir=''):
         url = path.replace(os.path.sep, '/').strip('./')
         for replace_char in '#;?:@&=+$, ': # see RFC 2396, plus '#' and ' '
@@ -113,6 +305,10 @@ class PrefixedFileInfo(FileInfo):
 
 # ============================================================================
 class ZipFileInfo(FileInfo):
+    is_local = False
+
+    __slots__ = ('zp', 'zinfo', 'internal_filename')
+
     def __init__(self, url_prefix, zp, zinfo, prefix):
         self.zp = zp
         self.zinfo = zinfo
@@ -135,4 +331,237 @@ class ZipFileInfo(FileInfo):
     def open(self):
         return self.zp.open(self.internal_filename, 'r')
 
+    def open_digested(self, digester, spool_size):
+        """ Compute the digest of the member, returning it along with a
+        stream to write it from.
+
+        The member stream can't be rewound without decompressing it again, so
+        members up to ``spool_size`` are read into memory once, while larger
+        ones are read once for the digest, then opened again for writing,
+        rather than spooled to disk.
+        """
+        if self.size <= spool_size:
+            with self.open() as fh:
+                data = fh.read()
+
+            digester.update(data)
+            return BytesIO(data), str(digester)
+
+        with self.open() as fh:
+            while True:
+                buff = fh.read(BUFF_SIZE)
+                if not buff:
+                    break
+
+                digester.update(buff)
 
+        return self.open(), str(digester)
+
+
+
+
+# ============================================================================
+class StreamFileInfo(FileInfo):
+    """ FileInfo for content available as a seekable stream rather than
+    a file of its own, eg. a spooled conversion output.
+
+    The stream is rewound on each open() and only closed by close()
+    """
+    is_local = False
+
+    __slots__ = ('stream',)
+
+    def __init__(self, url, stream, size, filename, modified_dt=None):
+        self.stream = stream
+        self.size = size
+        self.modified_dt = modified_dt or datetime.datetime.utcnow()
+
+        super(StreamFileInfo, self).__init__(url, filename)
+
+    def _init_stats(self):
+        pass
+
+    def open(self):
+        self.stream.seek(0)
+        return UnclosedStream(self.stream)
+
+    def close(self):
+        self.stream.close()
+
+
+# ============================================================================
+class UnclosedStream(object):
+    """ Wraps a stream to be read multiple times, ignoring close()
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def seek(self, offset, whence=0):
+        return self.stream.seek(offset, whence)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+# ============================================================================
+class MappedFile(object):
+    """ Read-only stream over a memory-mapped file. read() returns memoryview
+    slices of the mapped pages instead of copies, which can be passed as is
+    to hashlib, zlib, zstandard and file writes.
+    """
+    def __init__(self, fh):
+        import mmap
+        self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self.mmap, 'madvise'):
+            self.mmap.madvise(mmap.MADV_SEQUENTIAL)
+
+        self.view = memoryview(self.mmap)
+        self.size = len(self.mmap)
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self.pos + size, self.size)
+
+        buff = self.view[self.pos:end]
+        self.pos = end
+        return buff
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+
+        self.pos = max(min(offset, self.size), 0)
+        return self.pos
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # a slice is still referenced, the mapping is closed when it is freed
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ============================================================================
+class CountingWriter(object):
+    """ Counts bytes written to a non-seekable output, eg. a pipe, so that
+    tell() works. close() flushes, but doesn't close the output
+    """
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+
+    def write(self, buff):
+        self.out.write(buff)
+        self.offset += len(buff)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        self.out.flush()
+
+
+# ============================================================================
+class OutputFile(object):
+    """ Wraps the WARC output file to control how it is written to disk.
+
+    warcio flushes after each record, which is ignored here, so that data is
+    written in chunks of the output buffer size. With ``preallocate``, space
+    is reserved ahead of the writes in chunks of this many bytes with
+    posix_fallocate, and the file is truncated to the written size on close.
+    With ``sync_size``, the file is flushed and fdatasync'd at the end of the
+    first record group (a file and its revisit and conversion records)
+    after each ``sync_size`` bytes, or after each group if 0.
+
+    The time spent in writes and syncs is added to ``stats`` as the
+    'output_write' and 'output_sync' stages.
+    """
+    def __init__(self, out, stats, preallocate=0, sync_size=None):
+        self.out = out
+        self.stats = stats
+        self.preallocate = preallocate
+        self.sync_size = sync_size
+
+        self.pos = out.tell()
+        self.allocated = self.pos
+        self.synced = self.pos
+
+    def write(self, buff):
+        size = len(buff)
+        if self.preallocate and self.pos + size > self.allocated:
+            self._allocate(self.pos + size)
+
+        start = timer()
+        self.out.write(buff)
+        self.stats.add('output_write', timer() - start, size)
+
+        self.pos += size
+
+    def _allocate(self, end):
+        length = max(end - self.allocated, self.preallocate)
+        try:
+            os.posix_fallocate(self.out.fileno(), self.allocated, length)
+        except (AttributeError, EnvironmentError) as e:
+            # not supported by the platform or filesystem
+            logging.getLogger('WARCIT').warning('Not preallocating the output: {0}'.format(e))
+            self.preallocate = 0
+            return
+
+        self.allocated += length
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def group_done(self):
+        if self.sync_size is not None and self.pos - self.synced >= self.sync_size:
+            self.sync()
+
+    def sync(self):
+        start = timer()
+        self.out.flush()
+        getattr(os, 'fdatasync', os.fsync)(self.out.fileno())
+        self.stats.add('output_sync', timer() - start, self.pos - self.synced)
+        self.synced = self.pos
+
+    def close(self):
+        self.out.flush()
+        if self.allocated > self.pos:
+            self.out.truncate(self.pos)
+
+        if self.sync_size is not None and self.pos > self.synced:
+            self.sync()
+
+        self.out.close()
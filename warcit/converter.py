@@ -1,16 +1,21 @@
 from __future__ import absolute_import
 
-import yaml
 import logging
 import re
 import os
 import subprocess
 import pkgutil
-
-from collections import defaultdict
+import datetime
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+
+from collections import defaultdict, OrderedDict
 from argparse import ArgumentParser, RawTextHelpFormatter
 
-from warcit.base import BaseTool, get_version, init_logging, FileInfo
+from warcit.base import BaseTool, VersionAction, init_logging, FileInfo, StreamFileInfo
 from warcio.timeutils import timestamp_now
 
 
@@ -20,16 +25,29 @@ RULES_FILE = 'default-conversion-rules.yaml'
 
 RESULTS_FILE = 'warcit-conversion-results.yaml'
 
+BUFF_SIZE = 16384
+
+SPOOL_SIZE = 16 * 1024 * 1024
+
+POLL_INTERVAL = 0.25
+
+THROTTLE_INTERVAL = 5.0
+
 
 # ============================================================================
 def main(args=None):
     parser = ArgumentParser(description='Perform format conversion based on ' +
                                         'conversion rules (in preparation for WARC storage)')
 
-    parser.add_argument('-V', '--version', action='version', version=get_version())
+    parser.add_argument('-V', '--version', action=VersionAction)
 
     parser.add_argument('--dry-run', action='store_true')
 
+    parser.add_argument('--plan',
+                        help='''Perform a dry run and write a plan of all conversions, with
+                                estimated cost based on previous results, to this YAML file''',
+                        metavar='<FILENAME>')
+
     parser.add_argument('--output-dir', help='Root output directory for conversions')
 
     parser.add_argument('-q', '--quiet', action='store_true')
@@ -40,6 +58,23 @@ def main(args=None):
 
     parser.add_argument('--rules', help='Conversion rules YAML file')
 
+    parser.add_argument('--force', action='store_true',
+                        help='''Rerun all conversions, even if an up-to-date output
+                                from a previous run already exists''')
+
+    parser.add_argument('--check-digest', action='store_true',
+                        help='''In addition to modified time and size, also compare a digest
+                                of each input against the previous run to determine if its
+                                conversion outputs are up-to-date''')
+
+    parser.add_argument('--max-load', type=float,
+                        help='''Wait before starting each conversion while the 1 minute
+                                load average is above this value''')
+
+    parser.add_argument('--min-free-memory', type=int,
+                        help='''Wait before starting each conversion while less than this
+                                many bytes of memory are available''')
+
     parser.add_argument('url_prefix',
                         help='''The base URL for all items to be included, including
                                 protocol. Example: https://cool.website:8080/files/''')
@@ -47,17 +82,60 @@ def main(args=None):
     parser.add_argument('inputs', nargs='+',
                         help='''Paths of directories and/or files to be checked for conversion''')
 
+    parser.add_argument('--profile',
+                        help='''Profile the run and write the profile to this file: a pstats file,
+                                or collapsed stacks with "--profile-mode sample".
+                                The top functions are printed to stderr.''',
+                        metavar='<FILENAME>')
+
+    parser.add_argument('--profile-mode',
+                        help='''"cprofile" (default) for the deterministic profiler, or "sample"
+                                for sampling the stack at a fixed CPU time interval, with less overhead''',
+                        choices=('cprofile', 'sample'), default='cprofile')
+
+    parser.add_argument('--profile-limit',
+                        help='''Only profile the first N input files''',
+                        type=int,
+                        metavar='<N>')
+
     r = parser.parse_args(args=args)
 
     init_logging(r)
 
+    profiler = None
+    if r.profile:
+        from warcit.profiler import Profiler
+        profiler = Profiler(r.profile, mode=r.profile_mode, limit=r.profile_limit)
+
     converter = FileConverter(rules_filename=r.rules,
                               inputs=r.inputs,
                               url_prefix=r.url_prefix,
                               output_dir=r.output_dir,
-                              results_file=r.results)
+                              results_file=r.results,
+                              force=r.force,
+                              check_digest=r.check_digest,
+                              max_load=r.max_load,
+                              min_free_memory=r.min_free_memory,
+                              profiler=profiler)
+
+    dry_run = r.dry_run or bool(r.plan)
+
+    if profiler:
+        profiler.run(converter.convert_all, dry_run=dry_run, plan_file=r.plan)
+    else:
+        converter.convert_all(dry_run=dry_run, plan_file=r.plan)
+
+
+# ============================================================================
+def load_rules(rules_filename=None):
+    import yaml
 
-    converter.convert_all(dry_run=r.dry_run)
+    # if no rules specified, load default rules from package
+    if not rules_filename:
+        return yaml.safe_load(pkgutil.get_data('warcit', RULES_FILE))
+
+    with open(rules_filename, 'rt') as fh:
+        return yaml.safe_load(fh.read())
 
 
 # ============================================================================
@@ -65,18 +143,21 @@ class FileConverter(BaseTool):
     def __init__(self, rules_filename, inputs,
                  url_prefix=None,
                  output_dir=None,
-                 results_file=None):
-
-        # if no rules specified, load default rules from package
-        if not rules_filename:
-            rules = yaml.safe_load(pkgutil.get_data('warcit', RULES_FILE))
+                 results_file=None,
+                 force=False,
+                 check_digest=False,
+                 max_load=None,
+                 min_free_memory=None,
+                 profiler=None):
 
-        else:
-            with open(rules_filename, 'rt') as fh:
-                rules = yaml.safe_load(fh.read())
+        rules = load_rules(rules_filename)
 
         self.convert_stdout = rules.get('convert_stdout')
 
+        self.runner = ConversionRunner(rules,
+                                       max_load=max_load,
+                                       min_free_memory=min_free_memory)
+
         self.output_dir = output_dir or rules.get('output_dir', '.')
 
         url_prefix = url_prefix or rules['url_prefix']
@@ -84,26 +165,40 @@ class FileConverter(BaseTool):
         self.results_file = results_file or RESULTS_FILE
 
         self.results = defaultdict(list)
+        self.prev_results = {}
+
+        self.plan = None
+
+        self.force = force
+        self.check_digest = check_digest
+        self.profiler = profiler
 
         super(FileConverter, self).__init__(url_prefix=url_prefix,
                                             inputs=inputs)
 
-        for file_type in rules['file_types']:
-            if 'regex' in file_type:
-                file_type['regex'] = re.compile(file_type.get('regex'))
-
         self.file_types = rules['file_types']
 
-    def write_results(self):
-        filename = os.path.join(self.output_dir, self.results_file)
+        self.file_type_index = FileTypeIndex(self.file_types)
 
-        self._ensure_dir(filename)
+    def load_results(self):
+        import yaml
+        filename = os.path.join(self.output_dir, self.results_file)
 
         try:
             with open(filename, 'rt') as fh:
                 root = yaml.safe_load(fh.read())
         except:
-            root = {}
+            root = None
+
+        return root or {}
+
+    def write_results(self):
+        import yaml
+        filename = os.path.join(self.output_dir, self.results_file)
+
+        self._ensure_dir(filename)
+
+        root = self.load_results()
 
         if 'conversions' not in root:
             root['conversions'] = {}
@@ -114,11 +209,19 @@ class FileConverter(BaseTool):
         with open(filename, 'wt') as fh:
             fh.write(yaml.dump(root, default_flow_style=False))
 
-    def convert_all(self, dry_run=False):
+    def convert_all(self, dry_run=False, plan_file=None):
         stdout = None
         if self.convert_stdout:
             stdout = open(self.convert_stdout, 'wt')
 
+        prev_results = self.load_results().get('conversions') or {}
+
+        if not self.force:
+            self.prev_results = prev_results
+
+        if dry_run:
+            self.plan = ConversionPlan(prev_results)
+
         try:
             for file_info in self.iter_inputs():
                 self.convert_file(file_info,
@@ -129,53 +232,141 @@ class FileConverter(BaseTool):
                 if not dry_run:
                     self.write_results()
 
+                if self.profiler:
+                    self.profiler.file_done()
+
         finally:
             if stdout:
                 stdout.close()
 
+        if self.plan:
+            self.plan.log_summary()
+            if plan_file:
+                self.plan.write(plan_file)
+
     def convert_file(self, file_info, dry_run=False, convert_stdout=None, convert_stderr=None):
-        for file_type in self.file_types:
-            matched = False
-            # first, check by extension if available
-            if 'ext' in file_type and file_info.url.endswith(file_type['ext']):
-                matched = True
-            elif 'regex' in file_type and file_type['regex'].match(file_info.url):
-                matched = True
+        file_types = self.file_type_index.match(file_info.url)
+        if not file_types:
+            return
+
+        self.logger.info('Converting: ' + file_info.url)
+
+        prev_results = dict((prev['output'], prev) for prev in
+                            self.prev_results.get(file_info.url, [])
+                            if 'output' in prev)
+
+        source_digest = None
+        if self.check_digest:
+            source_digest = self.get_source_digest(file_info)
+
+        for file_type in file_types:
+            for conversion in file_type['conversion_rules']:
+                if conversion.get('skip'):
+                    self.logger.debug('Skipping: ' + conversion['name'])
+                    continue
+
+                output = self.get_output_filename(file_info.full_filename + '.' + conversion['ext'],
+                                                  dry_run=dry_run,
+                                                  root_dir=file_info.root_dir)
+
+                self.logger.debug('Output Filename: ' + output)
 
-            if matched:
-                self.logger.info('Converting: ' + file_info.url)
+                prev = prev_results.get(output)
+                up_to_date = prev and self.is_up_to_date(file_info, output, prev, conversion, source_digest)
 
-                for conversion in file_type['conversion_rules']:
-                    if conversion.get('skip'):
-                        self.logger.debug('Skipping: ' + conversion['name'])
-                        continue
+                if self.plan:
+                    self.plan.add(file_info, conversion, output, up_to_date)
 
-                    output = self.get_output_filename(file_info.full_filename + '.' + conversion['ext'],
-                                                      dry_run=dry_run,
-                                                      root_dir=file_info.root_dir)
+                if up_to_date:
+                    self.logger.debug('Up-to-date, skipping: ' + output)
+                    self.results[file_info.url].append(prev)
+                    continue
 
-                    self.logger.debug('Output Filename: ' + output)
-                    command = conversion['command'].format(input=file_info.full_filename,
-                                                           output=output)
+                command = conversion['command'].format(input=file_info.full_filename,
+                                                       output=output)
 
-                    self.logger.debug('*** Running Command: ' + str(command.split(' ')))
-                    if dry_run:
-                        continue
+                self.logger.debug('*** Running Command: ' + str(command.split(' ')))
+                if dry_run:
+                    continue
 
-                    res = subprocess.call(command.split(' '), shell=False,
-                                          stdout=convert_stdout,
-                                          stderr=convert_stderr)
+                start = time.time()
 
-                    self.logger.debug('Exit Code: {0}'.format(res))
+                res, error = self.runner.run(command.split(' '), conversion,
+                                             output=output,
+                                             stdout=convert_stdout,
+                                             stderr=convert_stderr)
 
-                    result = {'url': file_info.url + '.' + conversion['ext'],
-                              'output': output,
-                              'metadata': conversion,
-                              'type': 'conversion',
-                              'success': (res == 0),
-                             }
+                self.logger.debug('Exit Code: {0}'.format(res))
 
-                    self.results[file_info.url].append(result)
+                result = {'url': file_info.url + '.' + conversion['ext'],
+                          'output': output,
+                          'metadata': conversion,
+                          'type': 'conversion',
+                          'success': (res == 0 and not error),
+                          'source_size': file_info.size,
+                          'duration': round(time.time() - start, 6),
+                         }
+
+                if error:
+                    self.logger.error('Conversion failed: {0}: {1}'.format(output, error))
+                    result['error'] = error
+
+                if os.path.isfile(output):
+                    result['output_size'] = os.path.getsize(output)
+
+                if source_digest:
+                    result['source_digest'] = source_digest
+
+                self.results[file_info.url].append(result)
+
+    def is_up_to_date(self, file_info, output, prev, conversion, source_digest=None):
+        """ Return true if the output from a previous successful conversion
+        exists, is newer than the input, was made with the same command and
+        the input and output sizes (and input digest, if checked) match the
+        ones recorded for it.
+
+        A result without an input digest is recorded with the current one
+        if otherwise up-to-date.
+        """
+        if not prev.get('success'):
+            return False
+
+        if (prev.get('metadata') or {}).get('command') != conversion['command']:
+            return False
+
+        try:
+            stats = os.stat(output)
+        except OSError:
+            return False
+
+        if datetime.datetime.utcfromtimestamp(stats.st_mtime) < file_info.modified_dt:
+            return False
+
+        if stats.st_size != prev.get('output_size'):
+            return False
+
+        if file_info.size != prev.get('source_size'):
+            return False
+
+        if source_digest:
+            if 'source_digest' not in prev:
+                prev['source_digest'] = source_digest
+            elif source_digest != prev['source_digest']:
+                return False
+
+        return True
+
+    def get_source_digest(self, file_info):
+        digester = hashlib.sha1()
+        with file_info.open() as fh:
+            while True:
+                buff = fh.read(BUFF_SIZE)
+                if not buff:
+                    break
+
+                digester.update(buff)
+
+        return 'sha1:' + digester.hexdigest()
 
     def get_output_filename(self, convert_filename, dry_run=False, root_dir=''):
         rel_filename = os.path.relpath(convert_filename, root_dir)
@@ -194,15 +385,531 @@ class FileConverter(BaseTool):
                 self.logger.error(str(oe))
 
 
+# ============================================================================
+class ConversionPlan(object):
+    """ Plan of the conversions a run would perform, for a dry run.
+
+    The cost of each conversion is estimated from the input size and the
+    throughput (input bytes per second) of the same rule in previous runs,
+    computed from the 'source_size' and 'duration' recorded in the results.
+    """
+    def __init__(self, prev_conversions=None):
+        self.throughput = self.compute_throughput(prev_conversions or {})
+        self.inputs = OrderedDict()
+        self.rules = OrderedDict()
+
+    @staticmethod
+    def compute_throughput(conversions):
+        totals = defaultdict(lambda: [0, 0.0])
+        for results in conversions.values():
+            for result in results:
+                if not result.get('success') or not result.get('duration'):
+                    continue
+
+                name = (result.get('metadata') or {}).get('name')
+                if name and result.get('source_size') is not None:
+                    totals[name][0] += result['source_size']
+                    totals[name][1] += result['duration']
+
+        return dict((name, size / duration) for name, (size, duration) in totals.items())
+
+    def estimate(self, conversion, size):
+        throughput = self.throughput.get(conversion['name'])
+        if not throughput:
+            return None
+
+        return round(size / throughput, 3)
+
+    def add(self, file_info, conversion, output, up_to_date=False):
+        entry = self.inputs.get(file_info.url)
+        if not entry:
+            entry = {'url': file_info.url,
+                     'input': file_info.full_filename,
+                     'size': file_info.size,
+                     'conversions': []}
+
+            self.inputs[file_info.url] = entry
+
+        estimate = 0 if up_to_date else self.estimate(conversion, file_info.size)
+
+        entry['conversions'].append({'name': conversion['name'],
+                                     'output': output,
+                                     'up_to_date': bool(up_to_date),
+                                     'estimated_seconds': estimate})
+
+        rule = self.rules.get(conversion['name'])
+        if not rule:
+            rule = {'conversions': 0,
+                    'up_to_date': 0,
+                    'input_bytes': 0,
+                    'estimated_seconds': 0,
+                    'unestimated': 0,
+                    'throughput': self.throughput.get(conversion['name'])}
+
+            self.rules[conversion['name']] = rule
+
+        if up_to_date:
+            rule['up_to_date'] += 1
+            return
+
+        rule['conversions'] += 1
+        rule['input_bytes'] += file_info.size
+        if estimate is None:
+            rule['unestimated'] += 1
+        else:
+            rule['estimated_seconds'] += estimate
+
+    def get_totals(self):
+        totals = {'inputs': len(self.inputs),
+                  'input_bytes': sum(entry['size'] for entry in self.inputs.values())}
+
+        for key in ('conversions', 'up_to_date', 'estimated_seconds', 'unestimated'):
+            totals[key] = sum(rule[key] for rule in self.rules.values())
+
+        totals['estimated_seconds'] = round(totals['estimated_seconds'], 3)
+        return totals
+
+    def to_dict(self):
+        return {'totals': self.get_totals(),
+                'rules': dict(self.rules),
+                'inputs': list(self.inputs.values())}
+
+    def log_summary(self):
+        totals = self.get_totals()
+        logger.info('Plan: {conversions} conversions ({up_to_date} up-to-date) for {inputs} inputs, '
+                    '{input_bytes} bytes, estimated {estimated_seconds} seconds '
+                    '({unestimated} conversions without estimate)'.format(**totals))
+
+    def write(self, filename):
+        import yaml
+        with open(filename, 'wt') as fh:
+            fh.write(yaml.safe_dump(self.to_dict(), default_flow_style=False))
+
+
+# ============================================================================
+class ConversionRunner(object):
+    """ Runs conversion commands, enforcing the resource limits set per
+    conversion rule, or for all rules under ``limits`` in the rules file:
+
+    - ``timeout``: max seconds the command may run for
+    - ``max_output_bytes``: max size of the conversion output
+    - ``nice``: niceness increment for the command
+    - ``max_cpu_time``: max cpu seconds (RLIMIT_CPU)
+    - ``max_memory``: max address space in bytes (RLIMIT_AS)
+
+    The niceness and rlimits are only applied on posix systems.
+
+    Optionally, each command is only started once the load average is at or below
+    ``max_load`` and at least ``min_free_memory`` bytes of memory are available.
+    """
+    LIMITS = ('timeout', 'max_output_bytes', 'nice', 'max_cpu_time', 'max_memory')
+
+    def __init__(self, rules=None, max_load=None, min_free_memory=None):
+        rules = rules or {}
+        self.default_limits = rules.get('limits') or {}
+
+        self.max_load = max_load or rules.get('max_load')
+        self.min_free_memory = min_free_memory or rules.get('min_free_memory')
+
+    def get_limits(self, conversion):
+        limits = dict(self.default_limits)
+        for name in self.LIMITS:
+            if conversion.get(name) is not None:
+                limits[name] = conversion[name]
+
+        return limits
+
+    def run(self, args, conversion, output=None, spool=None, stdout=None, stderr=None):
+        """ Run conversion command, writing stdout to ``spool``, if provided.
+        Returns the exit code and an error message, set if the
+        command could not be run or was killed
+        """
+        limits = self.get_limits(conversion)
+
+        self.wait_for_resources()
+
+        try:
+            proc = subprocess.Popen(args, shell=False,
+                                    stdout=subprocess.PIPE if spool else stdout,
+                                    stderr=stderr,
+                                    preexec_fn=self._get_preexec(limits))
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            return None, 'command failed: {0}'.format(e)
+
+        copier = None
+        if spool:
+            copier = SpoolCopier(proc.stdout, spool)
+            copier.start()
+
+        timeout = limits.get('timeout')
+        max_output_bytes = limits.get('max_output_bytes')
+
+        start = time.time()
+        error = None
+
+        while True:
+            try:
+                res = proc.wait(timeout=POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+
+            if timeout and time.time() - start > timeout:
+                error = 'timeout after {0} seconds'.format(timeout)
+
+            elif max_output_bytes and self._get_output_size(output, copier) > max_output_bytes:
+                error = 'output exceeded {0} bytes'.format(max_output_bytes)
+
+            if error:
+                proc.kill()
+                res = proc.wait()
+                break
+
+        if copier:
+            copier.join()
+
+        if not error and max_output_bytes and self._get_output_size(output, copier) > max_output_bytes:
+            error = 'output exceeded {0} bytes'.format(max_output_bytes)
+
+        if not error and res < 0:
+            error = 'killed by signal {0}'.format(-res)
+
+        # don't leave partial output from a killed command around
+        if error and output and os.path.isfile(output):
+            os.remove(output)
+
+        return res, error
+
+    def _get_output_size(self, output, copier):
+        if copier:
+            return copier.size
+
+        try:
+            return os.path.getsize(output)
+        except (OSError, TypeError):
+            return 0
+
+    def _get_preexec(self, limits):
+        if os.name != 'posix':
+            return None
+
+        nice = limits.get('nice')
+        rlimits = []
+        if limits.get('max_cpu_time'):
+            rlimits.append(('RLIMIT_CPU', int(limits['max_cpu_time'])))
+
+        if limits.get('max_memory'):
+            rlimits.append(('RLIMIT_AS', int(limits['max_memory'])))
+
+        if not nice and not rlimits:
+            return None
+
+        def preexec():
+            if nice:
+                os.nice(int(nice))
+
+            if rlimits:
+                import resource
+                for name, value in rlimits:
+                    limit = getattr(resource, name)
+                    # can't raise a limit above the current hard limit
+                    hard = resource.getrlimit(limit)[1]
+                    if hard != resource.RLIM_INFINITY:
+                        value = min(value, hard)
+
+                    resource.setrlimit(limit, (value, value))
+
+        return preexec
+
+    def wait_for_resources(self):
+        while True:
+            reason = self._check_resources()
+            if not reason:
+                return
+
+            logger.debug('Waiting to start conversion, ' + reason)
+            time.sleep(THROTTLE_INTERVAL)
+
+    def _check_resources(self):
+        if self.max_load:
+            try:
+                load = os.getloadavg()[0]
+            except (AttributeError, OSError):
+                load = None
+
+            if load is not None and load > self.max_load:
+                return 'load average {0:.2f} > {1}'.format(load, self.max_load)
+
+        if self.min_free_memory:
+            avail = get_available_memory()
+            if avail is not None and avail < self.min_free_memory:
+                return 'available memory {0} < {1}'.format(avail, self.min_free_memory)
+
+        return None
+
+
+# ============================================================================
+def get_available_memory():
+    """ Return available memory in bytes, if it can be determined (on Linux)
+    """
+    try:
+        with open('/proc/meminfo', 'rt') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+
+# ============================================================================
+class SpoolCopier(threading.Thread):
+    """ Copies command stdout to a spool in the background, so that the
+    command can be killed if it hangs or produces too much output
+    """
+    def __init__(self, stream, spool):
+        super(SpoolCopier, self).__init__()
+        self.daemon = True
+        self.stream = stream
+        self.spool = spool
+        self.size = 0
+
+    def run(self):
+        with self.stream:
+            while True:
+                buff = self.stream.read(BUFF_SIZE)
+                if not buff:
+                    break
+
+                self.spool.write(buff)
+                self.size += len(buff)
+
+
+# ============================================================================
+class FileTypeIndex(object):
+    """ Dispatch index for the conversion rule file types, built once at load time.
+
+    Extensions are looked up by suffix in a dict and all regexes are combined
+    into a single regex of named alternatives, so that the common case of a
+    file not matching any rule takes a single lookup per suffix length and one
+    regex match, regardless of the number of rules.
+
+    As before, all matching file types are returned, in rule order.
+    """
+    BACKREF_RX = re.compile(r'\\[1-9]')
+
+    def __init__(self, file_types):
+        self.file_types = file_types
+
+        self.ext_map = defaultdict(list)
+        self.regexes = []
+
+        for i, file_type in enumerate(file_types):
+            if 'ext' in file_type:
+                self.ext_map[file_type['ext']].append(i)
+
+            if 'regex' in file_type:
+                regex = file_type['regex']
+                if not hasattr(regex, 'match'):
+                    regex = re.compile(regex)
+                    file_type['regex'] = regex
+
+                self.regexes.append((i, regex))
+
+        self.ext_lens = sorted(set(len(ext) for ext in self.ext_map))
+
+        self.combined_regex = self._combine_regexes()
+
+    def _combine_regexes(self):
+        if not self.regexes:
+            return None
+
+        # numbered backrefs would refer to the wrong groups once combined
+        if any(self.BACKREF_RX.search(regex.pattern) for _, regex in self.regexes):
+            return None
+
+        try:
+            return re.compile('|'.join('(?P<_rule{0}>{1})'.format(n, regex.pattern)
+                                       for n, (_, regex) in enumerate(self.regexes)))
+        except re.error as e:
+            logger.debug('Unable to combine conversion regexes: {0}'.format(e))
+            return None
+
+    def match(self, url):
+        matched = set()
+
+        url_len = len(url)
+        for ext_len in self.ext_lens:
+            indexes = self.ext_map.get(url[url_len - ext_len:])
+            if indexes:
+                matched.update(indexes)
+
+        if self.regexes:
+            matched.update(self._match_regexes(url))
+
+        if not matched:
+            return []
+
+        return [self.file_types[i] for i in sorted(matched)]
+
+    def _match_regexes(self, url):
+        if not self.combined_regex:
+            return [i for i, regex in self.regexes if regex.match(url)]
+
+        m = self.combined_regex.match(url)
+        if not m:
+            return []
+
+        # first matching alternative found, only the ones after it may also match
+        first = int(m.lastgroup[len('_rule'):])
+        return ([self.regexes[first][0]] +
+                [i for i, regex in self.regexes[first + 1:] if regex.match(url)])
+
+
+# ============================================================================
+class InlineConverter(object):
+    """ Runs the conversion rules while the WARC is being written, providing
+    each output directly for a conversion record, in place of a separate
+    warcit-converter run and its --output-dir tree and results file.
+
+    Rules with ``stdout: true`` write the output to stdout, which is read into
+    a temp file spooled in memory up to ``spool_size``. Otherwise, the rule
+    writes the output to a scratch file. Either is removed as soon as the
+    conversion record has been written.
+    """
+    def __init__(self, rules_filename=None, spool_size=SPOOL_SIZE):
+        rules = load_rules(rules_filename)
+
+        self.file_type_index = FileTypeIndex(rules['file_types'])
+
+        self.convert_stdout = rules.get('convert_stdout')
+        self.convert_out = None
+
+        self.runner = ConversionRunner(rules)
+
+        self.spool_size = spool_size
+        self.scratch_dir = None
+
+        # formats converted for the current url, used for transclusions
+        self.formats_url = None
+        self.formats = []
+
+    def find_conversions(self, url, file_info=None):
+        self.formats_url = url
+        self.formats = []
+
+        if not file_info:
+            return
+
+        for file_type in self.file_type_index.match(url):
+            for conversion in file_type['conversion_rules']:
+                if conversion.get('skip'):
+                    logger.debug('Skipping: ' + conversion['name'])
+                    continue
+
+                conv_info = self.convert(url, file_info, conversion)
+                if not conv_info:
+                    continue
+
+                try:
+                    self.formats.append((conv_info.url, dict(conversion)))
+                    yield conv_info, 'conversion', dict(conversion)
+                finally:
+                    conv_info.close()
+
+    def find_formats(self, url):
+        if url != self.formats_url:
+            return []
+
+        return self.formats
+
+    def convert(self, url, file_info, conversion):
+        logger.info('Converting: {0} -> {1}'.format(url, conversion['name']))
+
+        if self.convert_stdout and not self.convert_out:
+            self.convert_out = open(self.convert_stdout, 'wt')
+
+        spool = None
+        output = None
+        if conversion.get('stdout'):
+            spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        else:
+            output = self._get_scratch_filename(conversion)
+
+        command = conversion['command'].format(input=file_info.full_filename,
+                                               output=output)
+
+        logger.debug('*** Running Command: ' + str(command.split(' ')))
+
+        res, error = self.runner.run(command.split(' '), conversion,
+                                     output=output,
+                                     spool=spool,
+                                     stdout=self.convert_out,
+                                     stderr=self.convert_out)
+
+        logger.debug('Exit Code: {0}'.format(res))
+
+        if error:
+            logger.error('Conversion failed: {0} -> {1}: {2}'.format(url, conversion['name'], error))
+
+        if res != 0 or error:
+            logger.warning('Skipping unsuccessful conversion: {0} -> {1}'.format(url, conversion['name']))
+            if spool:
+                spool.close()
+            elif os.path.isfile(output):
+                os.remove(output)
+
+            return None
+
+        stream = spool or open(output, 'rb')
+
+        stream.seek(0, 2)
+        size = stream.tell()
+
+        return InlineConversionInfo(url + '.' + conversion['ext'], stream, size,
+                                    file_info.full_filename, output)
+
+    def _get_scratch_filename(self, conversion):
+        if not self.scratch_dir:
+            self.scratch_dir = tempfile.mkdtemp(prefix='warcit-convert-')
+
+        return os.path.join(self.scratch_dir, 'conversion.' + conversion['ext'])
+
+    def close(self):
+        if self.convert_out:
+            self.convert_out.close()
+            self.convert_out = None
+
+        if self.scratch_dir:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            self.scratch_dir = None
+
+
+# ============================================================================
+class InlineConversionInfo(StreamFileInfo):
+    __slots__ = ('scratch_filename',)
+
+    def __init__(self, url, stream, size, source_filename, scratch_filename=None):
+        self.scratch_filename = scratch_filename
+        super(InlineConversionInfo, self).__init__(url, stream, size, source_filename)
+
+    def close(self):
+        super(InlineConversionInfo, self).close()
+        if self.scratch_filename and os.path.isfile(self.scratch_filename):
+            os.remove(self.scratch_filename)
+
+
 # ============================================================================
 class ConversionSerializer(object):
     def __init__(self, results_filename):
+        import yaml
         with open(results_filename, 'rt') as fh:
             results = yaml.safe_load(fh.read())
 
         self.conversions = results.get('conversions', {})
 
-    def find_conversions(self, url):
+    def find_conversions(self, url, file_info=None):
         matched = self.conversions.get(url)
         if not matched:
             return
@@ -215,10 +922,16 @@ class ConversionSerializer(object):
             file_info = FileInfo(url=conv['url'], filename=conv['output'])
             yield file_info, conv.get('type', 'conversion'), conv.get('metadata')
 
+    def find_formats(self, url):
+        for conv in self.conversions.get(url) or []:
+            if conv.get('success'):
+                yield conv['url'], conv.get('metadata')
+
 
 # ============================================================================
 class TransclusionSerializer(object):
     def __init__(self, transclusions_filename, conversions=None):
+        import yaml
         with open(transclusions_filename, 'rt') as fh:
             results = yaml.safe_load(fh.read())
 
@@ -257,8 +970,8 @@ class TransclusionSerializer(object):
             formats = []
 
             if self.conversion_serializer:
-                for file_info, _, metadata in self.conversion_serializer.find_conversions(url):
-                    metadata['url'] = file_info.url
+                for conv_url, metadata in self.conversion_serializer.find_formats(url):
+                    metadata['url'] = conv_url
                     metadata['original_url'] = url
                     formats.append(metadata)
 
@@ -0,0 +1,229 @@
+from __future__ import absolute_import
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, Future
+
+
+logger = logging.getLogger('WARCIT')
+
+BUFF_SIZE = 2048
+
+READ_SIZE = 65536
+
+CACHE_SIZE = 100000
+
+# non-local files (eg. zip members) up to this size are sent to the workers
+# as bytes, larger ones are spooled to a temp file first
+SPOOL_SIZE = 1024 * 1024
+
+
+# ============================================================================
+# process pool worker
+_magic = None
+
+_charset_cache = None
+
+
+def _init_worker(use_magic, cache_size=CACHE_SIZE):
+    global _magic, _charset_cache
+    if use_magic:
+        import magic
+        _magic = magic.Magic(mime=True)
+
+    _charset_cache = LRUCache(cache_size)
+
+
+def _read_source(source, size=-1):
+    if isinstance(source, bytes):
+        return source if size < 0 else source[:size]
+
+    with open(source, 'rb') as fh:
+        return fh.read(size)
+
+
+def _detect(source, detect_mime, detect_charset):
+    """ Detect mime (with magic) and/or charset (with cchardet) of source,
+    either a filename or the content. The charset is only detected
+    for text/* mime types, and memoized by content digest in each worker.
+    """
+    results = {}
+    if detect_mime:
+        mime = _magic.from_buffer(_read_source(source, BUFF_SIZE))
+        results['mime'] = mime
+
+        if not mime or not mime.startswith('text/'):
+            return results
+
+    if detect_charset:
+        data = _read_source(source)
+        digest = hashlib.sha1(data).hexdigest()
+
+        charset = _charset_cache.get(digest)
+        results['cached'] = charset is not None
+        if charset is None:
+            charset = detect_charset_buffer(data)
+            _charset_cache.put(digest, charset)
+
+        results['charset'] = charset
+
+    return results
+
+
+def detect_charset_buffer(data):
+    import cchardet
+    result = cchardet.detect(data)
+    if result:
+        return result['encoding'] or ''
+
+    return ''
+
+
+# ============================================================================
+class LRUCache(object):
+    def __init__(self, max_size=CACHE_SIZE):
+        self.cache = OrderedDict()
+        self.max_size = max_size
+
+    def get(self, key):
+        value = self.cache.get(key)
+        if value is not None:
+            self.cache.move_to_end(key)
+
+        return value
+
+    def put(self, key, value):
+        self.cache[key] = value
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+
+# ============================================================================
+class DetectionPool(object):
+    """ Runs python-magic mime and cchardet charset detection in a process pool,
+    ahead of the writer, so that detection doesn't serialize with writing
+    and compressing records.
+
+    Results are memoized: mime types by a digest of the head bytes checked by
+    magic, charsets by a digest of the full content, computed in the worker
+    reading the file, each worker keeping its own charset cache, so that
+    repeated content may be detected once per worker. The charset
+    is only detected for text/* mime types, either as determined by magic,
+    or by ``guess_type`` when magic is not used.
+    """
+    def __init__(self, detect_mime=False, detect_charset=False, guess_type=None,
+                 max_workers=None, cache_size=CACHE_SIZE):
+        self.detect_mime = detect_mime
+        self.detect_charset = detect_charset
+        self.guess_type = guess_type
+
+        self.executor = ProcessPoolExecutor(max_workers=max_workers,
+                                            initializer=_init_worker,
+                                            initargs=(detect_mime, cache_size))
+
+        self.mime_cache = LRUCache(cache_size)
+
+        self.hits = 0
+        self.misses = 0
+
+    def submit(self, file_info):
+        file_info.detect_results = self._submit(file_info)
+
+    def _submit(self, file_info):
+        results = {}
+
+        if self.detect_mime:
+            with file_info.open() as fh:
+                head = fh.read(BUFF_SIZE)
+
+            head_key = hashlib.sha1(head).hexdigest()
+            mime = self.mime_cache.get(head_key)
+
+            # mime not known yet, detect both at once
+            if mime is None:
+                self.misses += 1
+                return self._submit_job(file_info, results, head_key=head_key,
+                                        detect_mime=True,
+                                        detect_charset=self.detect_charset)
+
+            self.hits += 1
+            results['mime'] = mime
+
+        else:
+            mime = self.guess_type(file_info)
+
+        if not self.detect_charset or not mime.startswith('text/'):
+            return self._done(results)
+
+        return self._submit_job(file_info, results, detect_charset=True)
+
+    def _submit_job(self, file_info, results, head_key=None, detect_mime=False, detect_charset=False):
+        spool_name = None
+        if file_info.is_local:
+            source = file_info.full_filename
+        elif file_info.size <= SPOOL_SIZE:
+            with file_info.open() as fh:
+                source = fh.read()
+        else:
+            source = spool_name = self._spool(file_info)
+
+        future = self.executor.submit(_detect, source, detect_mime, detect_charset)
+        if spool_name:
+            future.add_done_callback(lambda f: os.remove(spool_name))
+
+        future.head_key = head_key
+        future.partial_results = results
+        future.is_job = True
+        return future
+
+    def _spool(self, file_info):
+        with tempfile.NamedTemporaryFile(prefix='warcit-detect-', delete=False) as spool:
+            with file_info.open() as fh:
+                shutil.copyfileobj(fh, spool, READ_SIZE)
+
+        return spool.name
+
+    def _done(self, results):
+        future = Future()
+        future.set_result(results)
+        future.is_job = False
+        return future
+
+    def get_results(self, file_info):
+        """ Results for a submitted file, as a dict with 'mime' and/or 'charset'
+        keys, if these were detected
+        """
+        future = file_info.detect_results
+        if not future:
+            return {}
+
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.error('Detection failed for "{0}": {1}'.format(file_info.full_filename, e))
+            return {}
+
+        if not future.is_job:
+            return results
+
+        results.update(future.partial_results)
+
+        if future.head_key and 'mime' in results:
+            self.mime_cache.put(future.head_key, results['mime'])
+
+        if 'cached' in results:
+            if results.pop('cached'):
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        future.is_job = False
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,154 @@
+from __future__ import absolute_import
+
+import os
+import re
+import base64
+import binascii
+import hashlib
+import logging
+
+
+logger = logging.getLogger('WARCIT')
+
+ALGORITHMS = ('sha1', 'sha256', 'sha512')
+
+HEX_LENGTHS = {40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+MANIFEST_NAME_RX = re.compile(r'(?:tag)?manifest-(\w+)\.txt$')
+
+BUFF_SIZE = 65536
+
+VERIFY_RATE = 0.01
+
+
+# ============================================================================
+class DigestManifest(object):
+    """ Index of known digests of local files, loaded from BagIt
+    ``manifest-<algorithm>.txt`` files or generic ``<hex digest>  <path>``
+    manifests, as written by sha1sum or sha256sum. Paths are relative to
+    the directory of the manifest.
+
+    Digests are only used for files not modified after the manifest.
+    A fraction ``verify_rate`` of the files is hashed anyway, starting with
+    the first one, and on a mismatch the manifests are no longer used.
+    """
+    def __init__(self, verify_rate=VERIFY_RATE):
+        self.index = {}
+        self.verify_rate = verify_rate
+        self.verify_credit = 1.0
+        self.enabled = True
+
+        self.used = 0
+        self.stale = 0
+        self.verified = 0
+        self.mismatched = 0
+
+    def load(self, filename):
+        m = MANIFEST_NAME_RX.search(os.path.basename(filename))
+        algorithm = m.group(1).lower() if m else None
+
+        if algorithm and algorithm not in ALGORITHMS:
+            logger.warning('Skipping manifest "{0}": unsupported digest algorithm "{1}"'.format(filename, algorithm))
+            return 0
+
+        root = os.path.dirname(os.path.abspath(filename))
+        mtime = os.path.getmtime(filename)
+
+        count = 0
+        with open(filename, 'rt') as fh:
+            for line in fh:
+                line = line.rstrip('\r\n')
+                if not line or line.startswith('#'):
+                    continue
+
+                parts = line.split(None, 1)
+                if len(parts) != 2:
+                    continue
+
+                hex_digest, path = parts
+                # sha*sum binary mode marker
+                if path.startswith('*'):
+                    path = path[1:]
+
+                line_algorithm = algorithm or HEX_LENGTHS.get(len(hex_digest))
+                if not line_algorithm:
+                    continue
+
+                try:
+                    digest = to_warc_digest(line_algorithm, hex_digest)
+                except (TypeError, ValueError):
+                    continue
+
+                full_path = os.path.normpath(os.path.join(root, unescape_bagit_path(path)))
+                self.index[full_path] = (digest, mtime)
+                count += 1
+
+        logger.info('Loaded {0} digests from {1}'.format(count, filename))
+        return count
+
+    def get_digest(self, file_info):
+        """ Known 'algorithm:base32' digest of file, or None if not known,
+        stale or the manifests are no longer used
+        """
+        if not self.enabled or not file_info.is_local:
+            return None
+
+        entry = self.index.get(os.path.abspath(file_info.full_filename))
+        if not entry:
+            return None
+
+        digest, mtime = entry
+        if os.path.getmtime(file_info.full_filename) > mtime:
+            self.stale += 1
+            return None
+
+        self.verify_credit += self.verify_rate
+        if self.verify_credit >= 1.0:
+            self.verify_credit -= 1.0
+            if not self.verify(file_info, digest):
+                return None
+
+        self.used += 1
+        return digest
+
+    def verify(self, file_info, digest):
+        self.verified += 1
+
+        algorithm = digest.split(':', 1)[0]
+        digester = hashlib.new(algorithm)
+        with file_info.open() as fh:
+            while True:
+                buff = fh.read(BUFF_SIZE)
+                if not buff:
+                    break
+
+                digester.update(buff)
+
+        actual = algorithm + ':' + base64.b32encode(digester.digest()).decode('ascii')
+        if actual == digest:
+            return True
+
+        self.mismatched += 1
+        self.enabled = False
+        logger.error('Digest manifest mismatch for "{0}": {1} != {2}, no longer using digest manifests'.format(
+                     file_info.full_filename, digest, actual))
+        return False
+
+
+# ============================================================================
+def to_warc_digest(algorithm, hex_digest):
+    """ Convert hex digest, as found in manifests, to WARC 'algorithm:base32' form
+    """
+    raw = binascii.unhexlify(hex_digest.encode('ascii'))
+    if len(raw) != hashlib.new(algorithm).digest_size:
+        raise ValueError('invalid digest length')
+
+    return algorithm + ':' + base64.b32encode(raw).decode('ascii')
+
+
+def unescape_bagit_path(path):
+    # BagIt percent-encodes only CR, LF and %
+    if '%' not in path:
+        return path
+
+    return path.replace('%0A', '\n').replace('%0a', '\n').replace('%0D', '\r').replace('%0d', '\r').replace('%25', '%')
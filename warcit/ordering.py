@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+
+import os
+import struct
+import logging
+
+
+logger = logging.getLogger('WARCIT')
+
+SORT_MODES = ('none', 'inode', 'extent')
+
+SORT_BATCH_SIZE = 10000
+
+# linux FS_IOC_FIEMAP ioctl, see linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+
+# struct fiemap header: start, length, flags, mapped extents, extent count, reserved
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+
+# struct fiemap_extent: logical, physical, length, 2 reserved, flags, 3 reserved
+FIEMAP_EXTENT = struct.Struct('=QQQ2QI3I')
+
+
+# ============================================================================
+class InputSorter(object):
+    """ Reorders local files in batches of ``batch_size``, by inode number or,
+    with 'extent', by the physical offset of their first extent on disk,
+    to reduce seeking on spinning disks and tape-backed filesystems.
+
+    The physical offset is looked up with the FIEMAP ioctl, on Linux, falling
+    back to the inode number for files without extents or on filesystems
+    not supporting it.
+
+    Other inputs, eg. zip file members, are passed through in their original
+    position relative to the batches.
+    """
+    def __init__(self, mode, batch_size=SORT_BATCH_SIZE):
+        if mode not in SORT_MODES:
+            raise ValueError('Unknown input sort mode: ' + mode)
+
+        self.mode = mode
+        self.batch_size = batch_size
+
+        self.use_fiemap = (mode == 'extent')
+        self.extents = 0
+        self.inodes = 0
+
+    def __call__(self, file_infos):
+        batch = []
+        for file_info in file_infos:
+            if not file_info.is_local:
+                for sorted_info in self.sort_batch(batch):
+                    yield sorted_info
+
+                batch = []
+                yield file_info
+                continue
+
+            batch.append(file_info)
+            if len(batch) >= self.batch_size:
+                for sorted_info in self.sort_batch(batch):
+                    yield sorted_info
+
+                batch = []
+
+        for sorted_info in self.sort_batch(batch):
+            yield sorted_info
+
+    def sort_batch(self, batch):
+        if len(batch) > 1:
+            batch.sort(key=self.sort_key)
+
+        return batch
+
+    def sort_key(self, file_info):
+        try:
+            stats = os.stat(file_info.full_filename)
+        except OSError:
+            return (0, 0, 0)
+
+        if self.use_fiemap:
+            physical = self.get_physical_offset(file_info.full_filename)
+            if physical is not None:
+                self.extents += 1
+                return (stats.st_dev, 0, physical)
+
+        self.inodes += 1
+        return (stats.st_dev, 1, stats.st_ino)
+
+    def get_physical_offset(self, filename):
+        """ Physical offset of the first extent of the file,
+        or None if not available
+        """
+        try:
+            return get_first_extent(filename)
+        except (ImportError, IOError, OSError):
+            # not supported by the platform or the filesystem, don't try again
+            logger.debug('FIEMAP not available, sorting inputs by inode')
+            self.use_fiemap = False
+            return None
+
+
+# ============================================================================
+def get_first_extent(filename):
+    """ Physical offset of the first extent of a file, using the
+    FIEMAP ioctl, or None if the file has no extents, eg. if empty
+    """
+    import fcntl
+
+    buff = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(buff, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buff, True)
+    finally:
+        os.close(fd)
+
+    mapped = FIEMAP_HEADER.unpack_from(buff, 0)[3]
+    if not mapped:
+        return None
+
+    return FIEMAP_EXTENT.unpack_from(buff, FIEMAP_HEADER.size)[1]
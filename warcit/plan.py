@@ -0,0 +1,203 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import zlib
+import random
+import hashlib
+
+from io import BytesIO
+from collections import defaultdict
+
+from warcio.warcwriter import WARCWriter
+
+from warcit.stats import MB, timer, format_duration
+
+
+PLAN_SAMPLES = 100
+
+# bytes read from each sampled file
+SAMPLE_SIZE = 256 * 1024
+
+
+# ============================================================================
+class Planner(object):
+    """ Estimates the records, output size and time of a WARCIT run without
+    writing anything, from the listing and filters of the inputs, reading
+    only a random sample of ``samples`` files to estimate the compression
+    ratio of each MIME type and the throughput.
+
+    Conversion and transclusion records are not included.
+    """
+    def __init__(self, warcit, samples=PLAN_SAMPLES, seed=None, stream=None):
+        self.warcit = warcit
+        self.samples = samples
+        self.random = random.Random(seed)
+        self.stream = stream or sys.stdout
+
+        self.files = 0
+        self.size = 0
+        self.excluded = 0
+        self.revisits = 0
+
+        # count and size by (extension, mime)
+        self.groups = defaultdict(lambda: [0, 0])
+
+        self.sampled = []
+
+        # raw and compressed sample bytes by mime
+        self.ratios = defaultdict(lambda: [0, 0])
+        self.sample_bytes = 0
+        self.sample_time = 0.0
+
+    def run(self):
+        self.scan()
+        self.sample()
+        self.report()
+        return 0
+
+    def scan(self):
+        warcit = self.warcit
+        for file_info in warcit._iter_inputs():
+            if warcit.is_excluded(file_info):
+                self.excluded += 1
+                continue
+
+            if warcit.use_mapfile and not file_info.mapfile_results:
+                file_info.mapfile_results = warcit._match_mapfile(file_info.full_filename)
+
+            mime = self.guess_type(file_info)
+            url = (file_info.mapfile_results or {}).get('URL') or file_info.url
+            path = url.split('?', 1)[0]
+            ext = os.path.splitext(path.rsplit('/', 1)[-1])[1].lower() or '(none)'
+
+            group = self.groups[(ext, mime)]
+            group[0] += 1
+            group[1] += file_info.size
+
+            if path.lower().endswith(warcit.index_files):
+                self.revisits += 1
+
+            # reservoir sample, read when selected, as zip files are
+            # closed after their members are listed
+            self.files += 1
+            self.size += file_info.size
+            if len(self.sampled) < self.samples:
+                self.sampled.append(self.read_sample(file_info, mime))
+            else:
+                i = self.random.randrange(self.files)
+                if i < self.samples:
+                    self.sampled[i] = self.read_sample(file_info, mime)
+
+    def read_sample(self, file_info, mime):
+        start = timer()
+        with file_info.open() as fh:
+            data = fh.read(SAMPLE_SIZE)
+
+        return data, mime, timer() - start
+
+    def guess_type(self, file_info):
+        """ Type from the mapfile or list row, the overrides or the filename only,
+        without reading the file
+        """
+        if self.warcit.use_magic == 'filename':
+            return self.warcit._guess_type(file_info)
+
+        results = file_info.mapfile_results
+        if results and 'Content-Type' in results:
+            return results['Content-Type'].split(';')[0]
+
+        from warcit.warcit import get_mimetypes
+        return get_mimetypes().guess_type(file_info.url.split('?', 1)[0], False)[0] or 'text/html'
+
+    def make_compressor(self):
+        warcit = self.warcit
+        if warcit.zstd:
+            import zstandard
+            return zstandard.ZstdCompressor(level=warcit.zstd_level).compressobj()
+        elif warcit.gzip:
+            return zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS + 16)
+        else:
+            return None
+
+    def sample(self):
+        """ Digest and compress the start of each sampled file
+        """
+        for data, mime, read_time in self.sampled:
+            start = timer() - read_time
+            hashlib.sha1(data).digest()
+
+            compressor = self.make_compressor()
+            if compressor:
+                compressed = len(compressor.compress(data)) + len(compressor.flush())
+            else:
+                compressed = len(data)
+
+            self.sample_time += timer() - start
+            self.sample_bytes += len(data)
+
+            ratio = self.ratios[mime]
+            ratio[0] += len(data)
+            ratio[1] += compressed
+
+    def get_ratio(self, mime=None):
+        if mime and self.ratios[mime][0]:
+            raw, compressed = self.ratios[mime]
+        else:
+            raw = sum(ratio[0] for ratio in self.ratios.values())
+            compressed = sum(ratio[1] for ratio in self.ratios.values())
+
+        return (float(compressed) / raw) if raw else 1.0
+
+    def get_record_overhead(self):
+        """ Size of the WARC headers of a record, written for an empty file
+        """
+        buff = BytesIO()
+        if self.warcit.zstd:
+            from warcit.zstdwriter import ZstdWARCWriter
+            writer = ZstdWARCWriter(buff, level=self.warcit.zstd_level)
+        else:
+            writer = WARCWriter(buff, gzip=self.warcit.gzip)
+        record = writer.create_warc_record('http://example.com/some/path/file.html', 'resource',
+                                           payload=BytesIO(),
+                                           length=0,
+                                           warc_content_type='text/html',
+                                           warc_headers_dict={'WARC-Source-URI': 'file:///some/local/path/file.html',
+                                                              'WARC-Creation-Date': writer._make_warc_date()})
+        writer.write_record(record)
+        return len(buff.getvalue())
+
+    def report(self):
+        overhead = self.get_record_overhead()
+        records = self.files + self.revisits
+
+        by_ext = defaultdict(lambda: [0, 0, 0.0])
+        for (ext, mime), (count, size) in self.groups.items():
+            row = by_ext[ext]
+            row[0] += count
+            row[1] += size
+            row[2] += size * self.get_ratio(mime) + count * overhead
+
+        out_size = sum(row[2] for row in by_ext.values()) + self.revisits * overhead
+
+        write = self.stream.write
+        write('Plan for {0}\n'.format(self.warcit.name))
+        write('  Files:       {0} ({1:.1f} MB), {2} excluded\n'.format(self.files, self.size / MB, self.excluded))
+        write('  Records:     {0} ({1} resource, {2} revisit){3}\n'.format(records, self.files, self.revisits,
+                                                                        ' + warcinfo' if self.warcit.warcinfo else ''))
+        write('  Output size: {0:.1f} MB, ratio {1:.2f}, from {2} sampled files\n'.format(out_size / MB,
+                                                                                         self.get_ratio(),
+                                                                                         len(self.sampled)))
+        write('  WARC files:  1\n')
+
+        if self.sample_time and self.sample_bytes:
+            rate = self.sample_bytes / self.sample_time
+            write('  Time:        {0} at {1:.1f} MB/s, for reading, digest and compression of the samples\n'.format(
+                  format_duration(self.size / rate), rate / MB))
+
+        write('\n{0:<12} {1:>10} {2:>12} {3:>12} {4:>7}\n'.format('Extension', 'Files', 'Size MB', 'Output MB', 'Ratio'))
+        for ext, (count, size, est_size) in sorted(by_ext.items(), key=lambda item: -item[1][1]):
+            write('{0:<12} {1:>10} {2:>12.2f} {3:>12.2f} {4:>7.2f}\n'.format(ext, count, size / MB, est_size / MB,
+                                                                            (est_size / size) if size else 0))
+
+        self.stream.flush()
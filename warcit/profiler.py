@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+
+import sys
+import logging
+
+from collections import Counter
+
+
+logger = logging.getLogger('WARCIT')
+
+PROFILE_MODES = ('cprofile', 'sample')
+
+SAMPLE_INTERVAL = 0.005
+
+TOP_COUNT = 25
+
+
+# ============================================================================
+class Profiler(object):
+    """ Profiles a tool run, optionally only for the first ``limit`` files.
+
+    In 'cprofile' mode, the deterministic cProfile profiler is used and a
+    pstats file is written. In 'sample' mode, the stack of the main thread is
+    sampled on a CPU time timer, and written in collapsed stack format
+    (one 'frame;frame;... count' line per stack), eg. for flamegraph.pl.
+
+    The top functions are printed to stderr when done.
+    """
+    def __init__(self, filename, mode='cprofile', limit=None,
+                 interval=SAMPLE_INTERVAL, top=TOP_COUNT, stream=None):
+        if mode not in PROFILE_MODES:
+            raise ValueError('Unknown profile mode: ' + mode)
+
+        self.filename = filename
+        self.mode = mode
+        self.limit = limit
+        self.interval = interval
+        self.top = top
+        self.stream = stream or sys.stderr
+
+        self.files = 0
+        self.running = False
+
+        self.profile = None
+        self.samples = Counter()
+
+    def run(self, func, *args, **kwargs):
+        self.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.finish()
+
+    def start(self):
+        if self.mode == 'cprofile':
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            import signal
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+
+        if self.mode == 'cprofile':
+            self.profile.disable()
+        else:
+            import signal
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+        self.running = False
+
+    def file_done(self):
+        """ Called by the tools after each input, to stop after the limit
+        """
+        self.files += 1
+        if self.limit and self.files >= self.limit and self.running:
+            self.stop()
+            logger.info('Profiled first {0} files'.format(self.files))
+
+    def finish(self):
+        self.stop()
+
+        if self.mode == 'cprofile':
+            self.profile.dump_stats(self.filename)
+            self.print_cprofile_top()
+        else:
+            self.write_samples()
+            self.print_samples_top()
+
+        logger.info('Profile written to {0}'.format(self.filename))
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame:
+            code = frame.f_code
+            stack.append('{0} ({1}:{2})'.format(code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def write_samples(self):
+        with open(self.filename, 'wt') as fh:
+            for stack, count in self.samples.most_common():
+                fh.write('{0} {1}\n'.format(stack, count))
+
+    def print_cprofile_top(self):
+        import pstats
+        stats = pstats.Stats(self.profile, stream=self.stream)
+        stats.sort_stats('cumulative').print_stats(self.top)
+
+    def print_samples_top(self):
+        total = sum(self.samples.values())
+        if not total:
+            self.stream.write('No samples, the run was too short for the sampling interval\n')
+            return
+
+        # samples in which each function is running (self) or on the stack (total)
+        own = Counter()
+        cumulative = Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                cumulative[frame] += count
+
+        self.stream.write('{0} samples, {1} seconds interval\n\n'.format(total, self.interval))
+        self.stream.write('{0:>8} {1:>8}  {2}\n'.format('self%', 'total%', 'function'))
+
+        for frame, count in own.most_common(self.top):
+            self.stream.write('{0:8.1f} {1:8.1f}  {2}\n'.format(count * 100.0 / total,
+                                                               cumulative[frame] * 100.0 / total,
+                                                               frame))
@@ -0,0 +1,221 @@
+from __future__ import absolute_import
+
+import sys
+import json
+import heapq
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+try:
+    timer = time.perf_counter
+except AttributeError:  #pragma: no cover
+    timer = time.time
+
+SLOWEST_COUNT = 20
+
+PROGRESS_INTERVAL = 5.0
+
+MB = 1024.0 * 1024.0
+
+# upper bounds, in milliseconds, of the per-file time histogram buckets
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+# ============================================================================
+class Stats(object):
+    """ Counters, bytes, cumulative and longest time for each stage of a run,
+    a histogram of per-file times and the slowest files.
+
+    Stages may nest, eg. the records written for conversions are counted
+    both in their own stages and in the 'conversions' stage.
+    """
+    def __init__(self, slowest_count=SLOWEST_COUNT):
+        self.stages = OrderedDict()
+        self.slowest = []
+        self.slowest_count = slowest_count
+        self.histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.start = timer()
+
+    @contextmanager
+    def stage(self, name, size=0):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.add(name, timer() - start, size)
+
+    def add(self, name, duration, size=0):
+        stage = self.stages.get(name)
+        if not stage:
+            stage = self.stages[name] = {'count': 0, 'bytes': 0, 'time': 0.0, 'max': 0.0}
+
+        stage['count'] += 1
+        stage['bytes'] += size
+        stage['time'] += duration
+        if duration > stage['max']:
+            stage['max'] = duration
+
+    def iter_stage(self, name, iterable):
+        """ Wrap iterable, counting the time to get each item as stage ``name``
+        """
+        iterator = iter(iterable)
+        while True:
+            start = timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+
+            self.add(name, timer() - start)
+            yield item
+
+    def add_file(self, filename, duration, size=0):
+        ms = duration * 1000
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if ms < bound:
+                break
+        else:
+            i = len(HISTOGRAM_BUCKETS)
+
+        self.histogram[i] += 1
+
+        entry = (duration, filename, size)
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def to_dict(self):
+        stages = OrderedDict()
+        for name, stage in self.stages.items():
+            stages[name] = {'count': stage['count'],
+                            'bytes': stage['bytes'],
+                            'time': round(stage['time'], 6),
+                            'max': round(stage['max'], 6)}
+
+        histogram = OrderedDict()
+        lower = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS + (None,), self.histogram):
+            if bound:
+                histogram['{0}-{1}ms'.format(lower, bound)] = count
+                lower = bound
+            else:
+                histogram['{0}ms+'.format(lower)] = count
+
+        slowest = [{'file': filename, 'size': size, 'time': round(duration, 6)}
+                   for duration, filename, size in sorted(self.slowest, reverse=True)]
+
+        return OrderedDict([('total_time', round(timer() - self.start, 6)),
+                            ('stages', stages),
+                            ('file_time_histogram', histogram),
+                            ('slowest_files', slowest)])
+
+    def write(self, filename):
+        with open(filename, 'wt') as fh:
+            json.dump(self.to_dict(), fh, indent=2)
+            fh.write('\n')
+
+
+# ============================================================================
+class NullStats(object):
+    """ Stand-in for Stats when not collecting, doing as little as possible
+    """
+    class NullStage(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+    null_stage = NullStage()
+
+    def stage(self, name, size=0):
+        return self.null_stage
+
+    def add(self, name, duration, size=0):
+        pass
+
+    def iter_stage(self, name, iterable):
+        return iterable
+
+    def add_file(self, filename, duration, size=0):
+        pass
+
+
+# ============================================================================
+class Progress(object):
+    """ Periodic progress report of files and bytes read and written,
+    with an ETA based on the total size of the inputs.
+
+    update() is called once per file, and only compares the time to the
+    next report, the rest is only done every ``interval`` seconds.
+    """
+    def __init__(self, total_files, total_size, interval=PROGRESS_INTERVAL,
+                 output=None, stream=None):
+        self.total_files = total_files
+        self.total_size = total_size
+        self.interval = interval
+
+        self.output = output
+        self.output_start = self._output_pos()
+
+        self.stream = stream or sys.stderr
+
+        self.files = 0
+        self.size = 0
+
+        self.start = timer()
+        self.next_report = self.start + interval
+
+    def _output_pos(self):
+        try:
+            return self.output.tell()
+        except Exception:
+            return 0
+
+    def update(self, size):
+        self.files += 1
+        self.size += size
+
+        if timer() >= self.next_report:
+            self.report()
+
+    def report(self):
+        now = timer()
+        self.next_report = now + self.interval
+
+        elapsed = max(now - self.start, 0.000001)
+        out_size = self._output_pos() - self.output_start
+
+        rate_in = self.size / elapsed
+        if rate_in:
+            eta = format_duration((self.total_size - self.size) / rate_in)
+        elif self.files:
+            eta = format_duration((self.total_files - self.files) * elapsed / self.files)
+        else:
+            eta = '?'
+
+        ratio = (float(out_size) / self.size) if self.size else 0
+
+        self.stream.write(('{files}/{total_files} files, {size:.1f}/{total_size:.1f} MB, '
+                           '{files_rate:.1f} files/s, {rate_in:.2f} MB/s in, {rate_out:.2f} MB/s out, '
+                           'ratio {ratio:.2f}, ETA {eta}\n').format(
+                              files=self.files,
+                              total_files=self.total_files,
+                              size=self.size / MB,
+                              total_size=self.total_size / MB,
+                              files_rate=self.files / elapsed,
+                              rate_in=rate_in / MB,
+                              rate_out=out_size / elapsed / MB,
+                              ratio=ratio,
+                              eta=eta))
+        self.stream.flush()
+
+
+# ============================================================================
+def format_duration(seconds):
+    seconds = int(max(seconds, 0))
+    return '{0}:{1:02d}:{2:02d}'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
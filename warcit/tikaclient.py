@@ -0,0 +1,258 @@
+from __future__ import absolute_import
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlsplit, quote
+    from queue import LifoQueue, Empty
+except ImportError:  #pragma: no cover
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlsplit
+    from urllib import quote
+    from Queue import LifoQueue, Empty
+
+
+logger = logging.getLogger('WARCIT')
+
+DEFAULT_TIKA_SERVER = os.environ.get('TIKA_SERVER_ENDPOINT', 'http://localhost:9998')
+
+BUFF_SIZE = 65536
+
+CACHE_SIZE = 100000
+
+
+# ============================================================================
+class TikaError(Exception):
+    pass
+
+
+# ============================================================================
+class TikaClient(object):
+    """ Client for the Tika server REST API, keeping a pool of persistent
+    connections so that it may be used from several threads at once.
+
+    Only the type detection and metadata endpoints are used, the content
+    is never parsed for text.
+    """
+    def __init__(self, server_url=DEFAULT_TIKA_SERVER, pool_size=4, timeout=120):
+        parts = urlsplit(server_url)
+        if parts.scheme == 'https':
+            self.conn_cls = HTTPSConnection
+        else:
+            self.conn_cls = HTTPConnection
+
+        self.netloc = parts.netloc
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+
+        self.pool = LifoQueue(maxsize=pool_size)
+
+    def _get_conn(self):
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            return self.conn_cls(self.netloc, timeout=self.timeout)
+
+    def _put_conn(self, conn):
+        if self.pool.full():
+            conn.close()
+        else:
+            self.pool.put_nowait(conn)
+
+    def request(self, method, path, body=None, headers=None):
+        headers = headers or {}
+
+        # a pooled connection may have been closed by the server, retry once
+        # on a new connection, unless the body can't be re-sent
+        for attempt in range(2):
+            conn = self._get_conn()
+            try:
+                conn.request(method, self.base_path + path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except Exception as e:
+                conn.close()
+                if attempt or not self._rewind(body):
+                    raise TikaError(str(e))
+                continue
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._put_conn(conn)
+
+            if resp.status != 200:
+                raise TikaError('{0} {1}: {2} {3}'.format(method, path, resp.status, resp.reason))
+
+            return data
+
+    def _rewind(self, body):
+        if body is None or isinstance(body, bytes):
+            return True
+
+        try:
+            body.seek(0)
+            return True
+        except Exception:
+            return False
+
+
+    def version(self):
+        return self.request('GET', '/version').decode('utf-8').strip()
+
+    def detect(self, stream, size, filename=None):
+        """ Content-Type of stream, via type detection only
+        """
+        headers = self._make_headers(size, filename)
+        return self.request('PUT', '/detect/stream', stream, headers).decode('utf-8').strip()
+
+    def meta(self, stream, size, filename=None):
+        """ Metadata dict of stream, including Content-Type and Content-Encoding
+        """
+        headers = self._make_headers(size, filename)
+        headers['Accept'] = 'application/json'
+
+        return json.loads(self.request('PUT', '/meta', stream, headers).decode('utf-8'))
+
+    def _make_headers(self, size, filename=None):
+        headers = {'Content-Length': str(size)}
+
+        # the filename is a hint for detection, without it Tika only uses magic
+        if filename:
+            headers['Content-Disposition'] = 'attachment; filename="{0}"'.format(quote(filename))
+
+        return headers
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except Empty:
+                break
+
+
+# ============================================================================
+class TikaDetector(object):
+    """ Detects Content-Type and/or charset of files via a TikaClient.
+
+    The Content-Type is obtained from the cheaper type detection endpoint,
+    the full metadata (for the charset) is only requested for text/* files,
+    as determined by Tika, or by ``guess_type`` if Tika is only used for the
+    charset. If both are detected, files with a text/* type by filename are
+    only sent to the metadata endpoint, which returns both. The filename is
+    sent as a hint, and results are cached by content digest and extension.
+
+    Detection may be started ahead of time with submit(), to keep several
+    requests in flight from a thread pool.
+    """
+    def __init__(self, client, detect_type=True, detect_charset=False,
+                 guess_type=None, max_workers=4, cache_size=CACHE_SIZE):
+        self.client = client
+        self.detect_type = detect_type
+        self.detect_charset = detect_charset
+        self.guess_type = guess_type
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+
+    def submit(self, file_info):
+        file_info.tika_results = self.executor.submit(self.detect, file_info)
+
+    def get_results(self, file_info):
+        results = file_info.tika_results
+        if isinstance(results, Future):
+            return results.result()
+
+        return self.detect(file_info)
+
+    def detect(self, file_info):
+        try:
+            return {'metadata': self._detect(file_info)}
+        except Exception as e:
+            logger.error('Tika detection failed for "{0}": {1}'.format(file_info.full_filename, e))
+            return {'metadata': {}}
+
+    def _detect(self, file_info):
+        # if only used for charset, no need to ask Tika about non-text files
+        if not self.detect_type:
+            if not self.guess_type(file_info).startswith('text/'):
+                return {}
+
+        # the result may depend on the extension, sent as a hint
+        digest = (self.get_digest(file_info),
+                  os.path.splitext(file_info.full_filename)[1].lower())
+
+        # the first request for a digest computes the result, any others wait for it
+        with self.cache_lock:
+            future = self.cache.get(digest)
+            is_new = future is None
+            if is_new:
+                future = self.cache[digest] = Future()
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            else:
+                self.cache.move_to_end(digest)
+
+        if not is_new:
+            return future.result()
+
+        try:
+            metadata = self._request_metadata(file_info)
+        except Exception as e:
+            with self.cache_lock:
+                self.cache.pop(digest, None)
+
+            future.set_exception(e)
+            raise
+
+        future.set_result(metadata)
+        return metadata
+
+    def _request_metadata(self, file_info):
+        filename = os.path.basename(file_info.full_filename)
+
+        metadata = {}
+        if self.detect_type and not (self.detect_charset and self._is_text_name(filename)):
+            with file_info.open() as fh:
+                metadata['Content-Type'] = self.client.detect(fh, file_info.size, filename)
+
+            if not metadata['Content-Type'].startswith('text/'):
+                return metadata
+
+        if self.detect_charset:
+            with file_info.open() as fh:
+                metadata.update(self.client.meta(fh, file_info.size, filename))
+
+        return metadata
+
+    def _is_text_name(self, filename):
+        from warcit.warcit import get_mimetypes
+        mime = get_mimetypes().guess_type(filename, False)[0]
+        return bool(mime) and mime.startswith('text/')
+
+    def get_digest(self, file_info):
+        digester = hashlib.sha1()
+        with file_info.open() as fh:
+            while True:
+                buff = fh.read(BUFF_SIZE)
+                if not buff:
+                    break
+
+                digester.update(buff)
+
+        return digester.hexdigest()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
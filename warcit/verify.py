@@ -0,0 +1,413 @@
+from __future__ import absolute_import
+from argparse import ArgumentParser
+
+import os
+import sys
+import json
+import base64
+import hashlib
+import logging
+
+from io import BytesIO
+from collections import defaultdict
+
+from warcio.archiveiterator import ArchiveIterator
+
+from warcit.base import BaseTool, VersionAction, init_logging
+
+
+logger = logging.getLogger('WARCIT')
+
+READ_SIZE = 65536
+
+# records per job when reading records by offset
+RECORD_CHUNK_SIZE = 1000
+
+# source files per hashing job
+SOURCE_CHUNK_SIZE = 100
+
+DEFAULT_ALGORITHM = 'sha1'
+
+
+# ============================================================================
+def main(args=None):
+    parser = ArgumentParser(description='Verify that the source files of a WARC created by warcit ' +
+                                        'were written to it intact')
+
+    parser.add_argument('-V', '--version', action=VersionAction)
+
+    parser.add_argument('warc',
+                        help='''The WARC file to verify''')
+
+    parser.add_argument('inputs', nargs='*',
+                        help='''Paths of the directories and/or files the WARC was created from.
+                                If given, input files without a record are reported as missing,
+                                and records for other files as extra.''')
+
+    parser.add_argument('--index',
+                        help='''jsonl log (warcit --log-format jsonl) or CDXJ index of the WARC, with
+                                the offset and length of each record, to read the records in parallel.
+                                By default, <warc>.jsonl, <warc>.cdxj or <name>.cdxj is used if present,
+                                otherwise the WARC is read sequentially.''',
+                        metavar='<FILENAME>')
+
+    parser.add_argument('--base-dir',
+                        help='''Directory to resolve relative WARC-Source-URI paths against, ie. the
+                                directory warcit was run from if given relative input paths.
+                                Default is the current directory.''',
+                        metavar='<DIR>')
+
+    parser.add_argument('--workers',
+                        help='''Number of processes for reading records and hashing source files.
+                                Default is the number of CPUs.''',
+                        type=int,
+                        metavar='<NUM>')
+
+    parser.add_argument('-q', '--quiet', action='store_true')
+    parser.add_argument('-v', '--verbose', action='store_true')
+
+    r = parser.parse_args(args=args)
+
+    init_logging(r)
+
+    verifier = WARCVerifier(r.warc, r.inputs,
+                            index=r.index,
+                            base_dir=r.base_dir,
+                            workers=r.workers)
+
+    return verifier.run()
+
+
+# ============================================================================
+# process pool workers
+def _digest_stream(stream, algorithm):
+    digester = hashlib.new(algorithm)
+    while True:
+        buff = stream.read(READ_SIZE)
+        if not buff:
+            break
+
+        digester.update(buff)
+
+    return algorithm + ':' + base64.b32encode(digester.digest()).decode('ascii')
+
+
+def _record_entry(record, base_dir=None):
+    """ (record type, url, source file, stored digest, content digest)
+    of a record, the digest of the content being computed with the
+    algorithm of the stored digest, and a relative source file being
+    resolved against base_dir, or the current directory
+    """
+    headers = record.rec_headers
+    stored = headers.get_header('WARC-Payload-Digest')
+    algorithm = stored.split(':', 1)[0].lower() if stored else DEFAULT_ALGORITHM
+
+    source = headers.get_header('WARC-Source-URI') or ''
+    if source.startswith('file://'):
+        source = os.path.abspath(os.path.join(base_dir or '', source[len('file://'):]))
+    else:
+        source = None
+
+    actual = None
+    if record.rec_type != 'revisit':
+        actual = _digest_stream(record.raw_stream, algorithm)
+
+    return (record.rec_type, headers.get_header('WARC-Target-URI'), source, stored, actual)
+
+
+def _open_decompressor(fh, warc_filename):
+    """ zstd decompressor for .warc.zst files, using the dictionary at the
+    start of the file if any, or None for gzip or uncompressed WARCs
+    """
+    if not warc_filename.endswith('.zst'):
+        return None
+
+    import zstandard
+    from warcit.zstdwriter import read_dictionary_frame
+    return zstandard.ZstdDecompressor(dict_data=read_dictionary_frame(fh))
+
+
+def _read_records(warc_filename, ranges, base_dir=None):
+    """ Read and digest the records at the (offset, length) ranges
+    """
+    entries = []
+    with open(warc_filename, 'rb') as fh:
+        decompressor = _open_decompressor(fh, warc_filename)
+
+        for offset, length in ranges:
+            try:
+                fh.seek(offset)
+                data = fh.read(length)
+                if decompressor:
+                    data = decompressor.decompressobj().decompress(data)
+
+                for record in ArchiveIterator(BytesIO(data)):
+                    entries.append((offset,) + _record_entry(record, base_dir))
+                    break
+
+            except Exception as e:
+                entries.append((offset, None, None, None, None, 'error: {0}'.format(e)))
+
+    return entries
+
+
+def _hash_sources(sources):
+    """ Digests of (filename, algorithm) sources, None if no longer found.
+
+    Zip file members, as <zip file>/<member>, are grouped by zip file,
+    to open each one once.
+    """
+    tool = BaseTool('', [])
+
+    results = []
+    zip_members = defaultdict(list)
+    for filename, algorithm in sources:
+        try:
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as fh:
+                    results.append((filename, algorithm, _digest_stream(fh, algorithm)))
+
+                continue
+
+            is_zip, zip_filename, member = tool.parse_filename(filename)
+        except (IOError, OSError):
+            is_zip = False
+
+        if is_zip and member:
+            zip_members[zip_filename].append((filename, algorithm, member))
+        else:
+            results.append((filename, algorithm, None))
+
+    for zip_filename, members in zip_members.items():
+        results.extend(_hash_zip_members(zip_filename, members))
+
+    return results
+
+
+def _hash_zip_members(zip_filename, members):
+    import zipfile
+    try:
+        zp = zipfile.ZipFile(zip_filename)
+    except (IOError, OSError, zipfile.BadZipfile):
+        return [(filename, algorithm, None) for filename, algorithm, member in members]
+
+    results = []
+    with zp:
+        for filename, algorithm, member in members:
+            try:
+                with zp.open(member) as fh:
+                    digest = _digest_stream(fh, algorithm)
+            except (IOError, OSError, KeyError):
+                digest = None
+
+            results.append((filename, algorithm, digest))
+
+    return results
+
+
+# ============================================================================
+class WARCVerifier(BaseTool):
+    """ Verifies a WARC written by warcit against its source files.
+
+    The payload digest of each record is recomputed and compared to the stored
+    one, and the source files, from WARC-Source-URI, are hashed again and
+    compared to the records written from them. With an index of the records,
+    they are read in parallel, otherwise the WARC is read sequentially, while
+    the sources are hashed in parallel.
+
+    Problems are reported as MISMATCH, MISSING (an input without a record)
+    or EXTRA (a record for a source not found or not among the inputs).
+
+    Relative source paths, from relative warcit inputs, are resolved
+    against ``base_dir``, by default the current directory.
+    """
+    def __init__(self, warc_filename, inputs=None, index=None, base_dir=None, workers=None, output=None):
+        super(WARCVerifier, self).__init__(url_prefix='', inputs=inputs or [])
+
+        self.warc_filename = warc_filename
+        self.index = index or find_index(warc_filename)
+        self.base_dir = base_dir
+        self.workers = workers
+        self.output = output or sys.stdout
+
+        self.records = 0
+        self.sources = 0
+
+        self.mismatched = 0
+        self.missing = 0
+        self.extra = 0
+
+    def run(self):
+        if not os.path.isfile(self.warc_filename):
+            logger.error('WARC "{0}" not found'.format(self.warc_filename))
+            return 1
+
+        # digests of the records written from each source file
+        expected = defaultdict(list)
+
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            pending = []
+            jobs = []
+
+            for entry in self.iter_entries(executor):
+                offset, rec_type, url, source, stored, actual = entry
+                self.records += 1
+
+                if rec_type is None:
+                    self.report('MISMATCH', 'record at offset {0} could not be read, {1}'.format(offset, actual))
+                    continue
+
+                if stored and actual and stored != actual:
+                    self.report('MISMATCH', '{0} {1}: WARC record digest {2}, content {3}'.format(rec_type, url, stored, actual))
+
+                # only resource records are written from the source as is
+                if rec_type != 'resource' or not source:
+                    continue
+
+                digest = stored or actual
+                if source not in expected:
+                    pending.append((source, digest.split(':', 1)[0]))
+                    if len(pending) >= SOURCE_CHUNK_SIZE:
+                        jobs.append(executor.submit(_hash_sources, pending))
+                        pending = []
+
+                expected[source].append((url, digest))
+
+            if pending:
+                jobs.append(executor.submit(_hash_sources, pending))
+
+            for job in jobs:
+                for source, algorithm, digest in job.result():
+                    self.check_source(source, digest, expected[source])
+
+        finally:
+            executor.shutdown(wait=True)
+
+        if self.inputs:
+            self.check_inputs(expected)
+
+        self.output.write('Verified {0} records from {1} source files: {2} mismatched, {3} missing, {4} extra\n'.format(
+                          self.records, self.sources, self.mismatched, self.missing, self.extra))
+
+        if self.mismatched or self.missing or self.extra:
+            return 1
+
+        return 0
+
+    def iter_entries(self, executor):
+        if not self.index:
+            logger.info('No index found, reading {0} sequentially'.format(self.warc_filename))
+            for entry in iter_warc_entries(self.warc_filename, self.base_dir):
+                yield entry
+
+            return
+
+        ranges = load_index_ranges(self.index, self.warc_filename)
+        logger.info('Reading {0} records of {1} in parallel, from index {2}'.format(len(ranges),
+                                                                                  self.warc_filename,
+                                                                                  self.index))
+
+        jobs = [executor.submit(_read_records, self.warc_filename, ranges[i:i + RECORD_CHUNK_SIZE], self.base_dir)
+                for i in range(0, len(ranges), RECORD_CHUNK_SIZE)]
+
+        for job in jobs:
+            for entry in job.result():
+                yield entry
+
+    def check_source(self, source, digest, records):
+        self.sources += 1
+        for url, expected in records:
+            if digest is None:
+                self.report('EXTRA', '{0}: source {1} not found'.format(url, source))
+            elif digest != expected:
+                self.report('MISMATCH', '{0}: WARC {1}, source {2} {3}'.format(url, expected, source, digest))
+
+    def check_inputs(self, expected):
+        input_files = set()
+        for file_info in self.iter_inputs():
+            filename = os.path.abspath(file_info.full_filename)
+            input_files.add(filename)
+
+            if filename not in expected:
+                self.report('MISSING', filename)
+
+        for source in expected:
+            if source not in input_files and os.path.exists(source):
+                for url, digest in expected[source]:
+                    self.report('EXTRA', '{0}: source {1} not among the inputs'.format(url, source))
+
+    def report(self, kind, msg):
+        if kind == 'MISMATCH':
+            self.mismatched += 1
+        elif kind == 'MISSING':
+            self.missing += 1
+        else:
+            self.extra += 1
+
+        self.output.write('{0} {1}\n'.format(kind, msg))
+
+
+# ============================================================================
+def find_index(warc_filename):
+    name = warc_filename
+    for ext in ('.gz', '.zst', '.warc'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+
+    for index in (warc_filename + '.jsonl', warc_filename + '.cdxj', name + '.cdxj'):
+        if os.path.isfile(index):
+            return index
+
+    return None
+
+
+def load_index_ranges(index_filename, warc_filename):
+    """ Sorted (offset, length) of records of the WARC in a warcit jsonl log
+    or CDXJ index
+    """
+    basename = os.path.basename(warc_filename)
+    ranges = set()
+    with open(index_filename, 'rt') as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+
+            # CDXJ lines are '<urlkey> <timestamp> <json>'
+            if not line.startswith('{'):
+                line = line.split(' ', 2)[-1]
+
+            entry = json.loads(line)
+
+            name = entry.get('warc') or entry.get('filename')
+            if name and name != '-' and os.path.basename(name) != basename:
+                continue
+
+            if entry.get('offset') is None or entry.get('length') is None:
+                continue
+
+            ranges.add((int(entry['offset']), int(entry['length'])))
+
+    return sorted(ranges)
+
+
+def iter_warc_entries(warc_filename, base_dir=None):
+    with open(warc_filename, 'rb') as fh:
+        decompressor = _open_decompressor(fh, warc_filename)
+        stream = fh
+        if decompressor:
+            stream = decompressor.stream_reader(fh, read_across_frames=True)
+
+        it = ArchiveIterator(stream)
+        for record in it:
+            # offset is only known once the record is read
+            entry = _record_entry(record, base_dir)
+            yield (it.get_record_offset(),) + entry
+
+
+# ============================================================================
+if __name__ == "__main__":   #pragma: no cover
+    res = main()
+    sys.exit(res)
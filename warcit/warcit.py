@@ -4,29 +4,46 @@ from argparse import ArgumentParser, RawTextHelpFormatter
 import os
 import sys
 import datetime
-import mimetypes
 import logging
 import fnmatch
 import csv
 import errno
 import json
 
-from io import BytesIO
+from io import BytesIO, UnsupportedOperation, open as io_open
 
 from warcio.warcwriter import WARCWriter
 from warcio.timeutils import datetime_to_iso_date, timestamp_to_iso_date
 from warcio.timeutils import pad_timestamp, PAD_14_DOWN, DATE_TIMESPLIT
 import warcio.utils
 from contextlib import closing
-from collections import OrderedDict
-import cchardet
+from collections import OrderedDict, deque
 
-from warcit.base import BaseTool, get_version, init_logging
-from warcit.converter import ConversionSerializer, TransclusionSerializer
+from warcit.base import BaseTool, VersionAction, ZipFileInfo, CountingWriter, OutputFile, get_version, init_logging
+from warcit.base import parse_list_header
+from warcit.manifest import VERIFY_RATE
+from warcit.stats import Stats, NullStats, Progress, PROGRESS_INTERVAL, MB, timer
+from warcit.ordering import SORT_MODES, SORT_BATCH_SIZE
 
 
 BUFF_SIZE = 2048
 
+TIKA_WORKERS = 4
+
+LOG_BUFFER_SIZE = 65536
+
+ZIP_SPOOL_SIZE = 16 * 1024 * 1024
+
+ZSTD_LEVEL = 3
+
+STDOUT_BUFFER_SIZE = 1024 * 1024
+
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+PLAN_SAMPLES = 100
+
+MMAP_SIZE = 64 * 1024 * 1024
+
 
 # ============================================================================
 def main(args=None):
@@ -36,15 +53,29 @@ def main(args=None):
 
     parser = ArgumentParser(description='Create WARC files from content in directories, files and zip files')
 
-    parser.add_argument('-V', '--version', action='version', version=get_version())
+    parser.add_argument('-V', '--version', action=VersionAction)
 
     parser.add_argument('url_prefix',
                         help='''The base URL for all items to be included, including
                                 protocol. Example: https://cool.website:8080/files/''')
-    parser.add_argument('inputs', nargs='+',
+    parser.add_argument('inputs', nargs='*',
                         help='''Paths of directories and/or files to be included in
                                 the WARC file.''')
 
+    parser.add_argument('--from-list',
+                        help='''File listing the files to be included, one path per line, or "-" to read
+                                the list from stdin. Can also be a CSV or TSV file with a header row,
+                                with a "file" column first and at least one of the "URL", "timestamp" and
+                                "Content-Type" columns, as for --mapfile. Directories are not walked, and URLs are the
+                                URL prefix plus the path relative to --list-root, unless given.''',
+                        metavar='<FILENAME>')
+
+    parser.add_argument('--list-root',
+                        help='''Directory the URLs of --from-list files without a URL are relative to,
+                                as for the files of a directory input. Files outside of it need a URL.
+                                Default is the current directory.''',
+                        metavar='<DIR>')
+
     parser.add_argument('-d', '--fixed-dt',
                         help='''Set resource date and time in YYYYMMDDHHMMSS format.
                                 If not given, last modified date of files is used.''',
@@ -52,9 +83,39 @@ def main(args=None):
 
     parser.add_argument('-n', '--name',
                         help='''Base name for WARC file, appropriate extension will be
-                                added automatically.''',
+                                added automatically. Use "-" to write the WARC to stdout.''',
                         metavar='name')
 
+    parser.add_argument('--stdout',
+                        help='''Write the WARC to stdout, eg. to pipe it to another tool,
+                                same as "-n -".''',
+                        action='store_true')
+
+    parser.add_argument('--stdout-buffer-size',
+                        help='''Buffer size for writing the WARC to stdout, in bytes. Default is 1MB.''',
+                        type=int, default=STDOUT_BUFFER_SIZE,
+                        metavar='<BYTES>')
+
+    parser.add_argument('--buffer-size',
+                        help='''Buffer size for writing the WARC file, in bytes. The output is written
+                                in chunks of this size rather than flushed after each record. Default is 1MB.''',
+                        type=int, default=OUTPUT_BUFFER_SIZE,
+                        metavar='<BYTES>')
+
+    parser.add_argument('--preallocate',
+                        help='''Reserve disk space for the WARC file ahead of writing, in chunks of this
+                                many MB, with posix_fallocate, to reduce fragmentation. The file is
+                                truncated to its actual size when done.''',
+                        type=int, default=0,
+                        metavar='<MB>')
+
+    parser.add_argument('--sync-every',
+                        help='''Flush the WARC file and sync it to disk with fdatasync after every this many
+                                MB, at the end of the records of a file, or after every file if 0.
+                                By default, the WARC is not synced.''',
+                        type=int,
+                        metavar='<MB>')
+
     parser.add_argument('-a', '--append', action='store_true')
     parser.add_argument('-o', '--overwrite', action='store_true')
 
@@ -99,6 +160,27 @@ def main(args=None):
                         help='''Do not compress WARC file.''',
                         action='store_true')
 
+    parser.add_argument('--zstd',
+                        help='''Write a zstd compressed .warc.zst file, with each record in its own
+                                zstd frame, instead of gzip. Requires the zstandard package.''',
+                        action='store_true')
+
+    parser.add_argument('--zstd-level',
+                        help='''zstd compression level. Default is {0}.'''.format(ZSTD_LEVEL),
+                        type=int, default=ZSTD_LEVEL,
+                        metavar='<LEVEL>')
+
+    parser.add_argument('--zstd-threads',
+                        help='''Number of threads to compress each record with. Default is 0,
+                                compressing in the main thread.''',
+                        type=int, default=0,
+                        metavar='<NUM>')
+
+    parser.add_argument('--zstd-dict',
+                        help='''With --zstd, train a compression dictionary on a sample of the inputs
+                                and store it at the start of the WARC. Helps most with many small files.''',
+                        action='store_true')
+
     parser.add_argument('-c', '--charset',
                         help='''Set charset for text/* MIME types.
                                 Use "cchardet" for guessing via cchardet,
@@ -106,6 +188,24 @@ def main(args=None):
                                 "none" (default) for not adding charset information.''',
                         metavar='{<ENCODING>, cchardet, tika, none}')
 
+    parser.add_argument('--tika-server',
+                        help='''URL of the Apache Tika server to use for "tika" Content-Type or charset detection.
+                                Default is the TIKA_SERVER_ENDPOINT environment variable, if set,
+                                or "http://localhost:9998".''',
+                        metavar='<URL>')
+
+    parser.add_argument('--tika-workers',
+                        help='''Number of concurrent requests to the Tika server. Default is {0}.'''.format(TIKA_WORKERS),
+                        type=int, default=TIKA_WORKERS,
+                        metavar='<NUM>')
+
+    parser.add_argument('--detect-workers',
+                        help='''Run "magic" Content-Type and "cchardet" charset detection ahead of writing
+                                in a pool of this many processes, caching results for repeated content.
+                                Default is 0, detecting inline.''',
+                        type=int, default=0,
+                        metavar='<NUM>')
+
     parser.add_argument('-q', '--quiet', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
 
@@ -130,15 +230,175 @@ def main(args=None):
                                 will match a second file.''',
                         metavar='<FILENAME>')
 
+    parser.add_argument('--zip-spool-size',
+                        help='''Zip file members up to this size (in bytes) are read into memory once
+                                to compute their digest and write them, larger members are read
+                                twice instead. Default is 16MB.''',
+                        type=int, default=ZIP_SPOOL_SIZE,
+                        metavar='<BYTES>')
+
+    parser.add_argument('--mmap-size',
+                        help='''Local files of at least this size (in bytes) are memory-mapped, so that
+                                they are hashed, compressed and written without copying them.
+                                0 to disable. Default is 64MB.''',
+                        type=int, default=MMAP_SIZE,
+                        metavar='<BYTES>')
+
+    parser.add_argument('--digest-manifest',
+                        help='''BagIt manifest (manifest-sha1.txt, manifest-sha256.txt, ...) or generic
+                                "<hex digest>  <path>" manifest with known digests of the input files,
+                                used instead of hashing them. May be given more than once.''',
+                        action='append',
+                        metavar='<FILENAME>')
+
+    parser.add_argument('--verify-rate',
+                        help='''Fraction of the files with a digest from --digest-manifest to hash anyway,
+                                to detect a stale manifest. Default is {0}.'''.format(VERIFY_RATE),
+                        type=float, default=VERIFY_RATE,
+                        metavar='<RATE>')
+
+    parser.add_argument('--sort-inputs',
+                        help='''Order in which files are read, to reduce seeking on spinning disks or tape-backed
+                                storage: "none" (default) for the directory listing order, "inode" to sort
+                                by inode number, or "extent" to sort by physical location on disk where
+                                available (Linux FIEMAP), otherwise by inode. Files are sorted in batches
+                                of --sort-batch-size, and zip file members by their position in the zip file.
+                                URLs are not affected.''',
+                        choices=SORT_MODES, default='none')
+
+    parser.add_argument('--sort-batch-size',
+                        help='''Number of files to sort at a time with --sort-inputs. Default is {0}.'''.format(SORT_BATCH_SIZE),
+                        type=int, default=SORT_BATCH_SIZE,
+                        metavar='<NUM>')
+
     parser.add_argument('--log',
                         help='''Write a log file in CSV format.''',
                         metavar='<FILENAME>')
 
-    parser.add_argument('--conversions')
+    parser.add_argument('--log-format',
+                        help='''Format of the --log file: "csv" (default), or "jsonl" for JSON lines,
+                                also including the WARC filename, offset and compressed length,
+                                payload digest, bytes read and processing time of each record.''',
+                        choices=('csv', 'jsonl'), default='csv')
+
+    parser.add_argument('--log-buffer-size',
+                        help='''Buffer size of the --log file, in bytes. Default is {0}.'''.format(LOG_BUFFER_SIZE),
+                        type=int, default=LOG_BUFFER_SIZE,
+                        metavar='<BYTES>')
+
+    parser.add_argument('--conversions',
+                        help='''Conversion results YAML file from warcit-converter. Successful
+                                conversions are added as conversion records.''',
+                        metavar='<FILENAME>')
+
+    parser.add_argument('--convert',
+                        help='''Run the conversion rules while writing the WARC and add the
+                                outputs directly as conversion records, without an output
+                                directory or conversion results file.''',
+                        action='store_true')
+
+    parser.add_argument('--convert-rules',
+                        help='''Conversion rules YAML file to use with --convert.
+                                If not given, the default rules are used.''',
+                        metavar='<FILENAME>')
+
+    parser.add_argument('--spool-size',
+                        help='''With --convert, conversion output written to stdout is
+                                kept in memory up to this size (in bytes), then spooled
+                                to a temp file. Default is 16MB.''',
+                        type=int,
+                        metavar='<BYTES>')
+
+    parser.add_argument('--transclusions',
+                        help='''Transclusions YAML file, mapping urls to containing pages.''',
+                        metavar='<FILENAME>')
+
+    parser.add_argument('--plan',
+                        help='''Don't write a WARC, but estimate the number of records, the output size
+                                and time from the inputs, reading only a random sample of files to
+                                estimate the compression ratio of each MIME type, and print them
+                                with a breakdown by file extension.''',
+                        action='store_true')
+
+    parser.add_argument('--plan-samples',
+                        help='''Number of files to sample with --plan. Default is {0}.'''.format(PLAN_SAMPLES),
+                        type=int, default=PLAN_SAMPLES,
+                        metavar='<NUM>')
+
+    parser.add_argument('--stats',
+                        help='''Write a JSON summary of the time spent in each stage of the run,
+                                with the slowest files, to this file.''',
+                        metavar='<FILENAME>')
+
+    parser.add_argument('--progress',
+                        help='''Count the inputs first, then report progress, throughput and
+                                estimated time remaining on stderr while writing.''',
+                        action='store_true')
+
+    parser.add_argument('--progress-interval',
+                        help='''Seconds between progress reports. Default is {0}.'''.format(PROGRESS_INTERVAL),
+                        type=float, default=PROGRESS_INTERVAL,
+                        metavar='<SECONDS>')
+
+    parser.add_argument('--profile',
+                        help='''Profile the run and write the profile to this file: a pstats file,
+                                or collapsed stacks with "--profile-mode sample".
+                                The top functions are printed to stderr.''',
+                        metavar='<FILENAME>')
+
+    parser.add_argument('--profile-mode',
+                        help='''"cprofile" (default) for the deterministic profiler, or "sample"
+                                for sampling the stack at a fixed CPU time interval, with less overhead''',
+                        choices=('cprofile', 'sample'), default='cprofile')
+
+    parser.add_argument('--profile-limit',
+                        help='''Only profile the first N input files''',
+                        type=int,
+                        metavar='<N>')
+
+    # inputs may be empty with --from-list, so they must be parsed
+    # together with options given in between
+    if hasattr(parser, 'parse_intermixed_args'):
+        r = parser.parse_intermixed_args(args=args)
+    else:  #pragma: no cover
+        r = parser.parse_args(args=args)
+
+    if not r.inputs and not r.from_list:
+        parser.error('no inputs given, add paths of directories and/or files, or use --from-list')
+
+    if r.from_list == '-' and (r.progress or r.zstd_dict):
+        parser.error('--progress and --zstd-dict read the inputs twice, and can not be used with --from-list -')
+
+    if r.from_list and r.from_list != '-':
+        try:
+            with open(r.from_list, 'r', newline='') as fh:
+                parse_list_header(fh.readline())
+        except (IOError, OSError, ValueError) as e:
+            parser.error('--from-list: {0}'.format(e))
+
+    if r.convert and r.conversions:
+        parser.error('--convert and --conversions can not be used together')
+
+    if r.zstd and r.no_gzip:
+        parser.error('--zstd and --no-gzip can not be used together')
+
+    if r.zstd_dict and not r.zstd:
+        parser.error('--zstd-dict requires --zstd')
 
-    parser.add_argument('--transclusions')
+    if r.name == '-':
+        r.stdout = True
 
-    r = parser.parse_args(args=args)
+    if r.stdout and r.append:
+        parser.error('--append can not be used when writing to stdout')
+
+    if r.preallocate and (r.stdout or r.append):
+        parser.error('--preallocate can not be used with --append or when writing to stdout')
+
+    if r.sync_every is not None and r.stdout:
+        parser.error('--sync-every can not be used when writing to stdout')
+
+    if r.zstd_dict and r.append:
+        parser.error('--zstd-dict can not be used with --append, the dictionary must be at the start of the WARC')
 
     if r.append:
         mode = 'ab'
@@ -149,11 +409,25 @@ def main(args=None):
 
     init_logging(r)
 
-    return WARCIT(r.url_prefix,
+    profiler = None
+    if r.profile:
+        from warcit.profiler import Profiler
+        profiler = Profiler(r.profile, mode=r.profile_mode, limit=r.profile_limit)
+
+    tool = WARCIT(r.url_prefix,
                   r.inputs,
                   name=r.name,
+                  stdout=r.stdout,
+                  stdout_buffer_size=r.stdout_buffer_size,
+                  buffer_size=r.buffer_size,
+                  preallocate=int(r.preallocate * MB),
+                  sync_size=int(r.sync_every * MB) if r.sync_every is not None else None,
                   fixed_dt=r.fixed_dt,
                   gzip=not r.no_gzip,
+                  zstd=r.zstd,
+                  zstd_level=r.zstd_level,
+                  zstd_threads=r.zstd_threads,
+                  zstd_dict=r.zstd_dict,
                   use_magic=r.use_magic,
                   warcinfo=not r.no_warcinfo,
                   charset=r.charset,
@@ -164,19 +438,72 @@ def main(args=None):
                   mapfile=r.mapfile,
                   include=r.include,
                   exclude=r.exclude,
+                  sort_inputs=r.sort_inputs,
+                  sort_batch_size=r.sort_batch_size,
+                  from_list=r.from_list,
+                  list_root=r.list_root,
                   logfile=r.log,
-                  args=args,
+                  zip_spool_size=r.zip_spool_size,
+                  mmap_size=r.mmap_size,
+                  digest_manifests=r.digest_manifest,
+                  verify_rate=r.verify_rate,
+                  log_format=r.log_format,
+                  log_buffer_size=r.log_buffer_size,
+                  args=sys.argv[1:] if args is None else args,
                   conversions=r.conversions,
                   transclusions=r.transclusions,
-                 ).run()
+                  convert=r.convert,
+                  convert_rules=r.convert_rules,
+                  spool_size=r.spool_size,
+                  tika_server=r.tika_server,
+                  tika_workers=r.tika_workers,
+                  detect_workers=r.detect_workers,
+                  stats=r.stats,
+                  progress=r.progress,
+                  progress_interval=r.progress_interval,
+                  profiler=profiler,
+                 )
+
+    if r.plan:
+        return tool.plan(r.plan_samples)
+
+    if profiler:
+        return profiler.run(tool.run)
+
+    return tool.run()
+
+
+# ============================================================================
+_mimetypes = None
+
+def get_mimetypes():
+    """ mimetypes module, imported and initialized on first use
+    """
+    global _mimetypes
+    if not _mimetypes:
+        import mimetypes
+        # add any custom, fixed mime types here
+        mimetypes.add_type('image/x-icon', '.ico', True)
+        _mimetypes = mimetypes
+
+    return _mimetypes
 
 
 # ============================================================================
 class WARCIT(BaseTool):
     def __init__(self, url_prefix, inputs,
                  name=None,
+                 stdout=False,
+                 stdout_buffer_size=STDOUT_BUFFER_SIZE,
+                 buffer_size=OUTPUT_BUFFER_SIZE,
+                 preallocate=0,
+                 sync_size=None,
                  fixed_dt=None,
                  gzip=True,
+                 zstd=False,
+                 zstd_level=ZSTD_LEVEL,
+                 zstd_threads=0,
+                 zstd_dict=False,
                  use_magic=False,
                  warcinfo=True,
                  charset=None,
@@ -187,34 +514,68 @@ class WARCIT(BaseTool):
                  mapfile=None,
                  include=False,
                  exclude=False,
+                 sort_inputs=None,
+                 sort_batch_size=SORT_BATCH_SIZE,
+                 from_list=None,
+                 list_root=None,
                  logfile=None,
+                 zip_spool_size=ZIP_SPOOL_SIZE,
+                 mmap_size=MMAP_SIZE,
+                 digest_manifests=None,
+                 verify_rate=VERIFY_RATE,
+                 log_format='csv',
+                 log_buffer_size=LOG_BUFFER_SIZE,
                  conversions=None,
                  transclusions=None,
+                 convert=False,
+                 convert_rules=None,
+                 spool_size=None,
+                 tika_server=None,
+                 tika_workers=TIKA_WORKERS,
+                 detect_workers=0,
+                 stats=None,
+                 progress=False,
+                 progress_interval=PROGRESS_INTERVAL,
+                 profiler=None,
                  args=None):
 
         super(WARCIT, self).__init__(
             url_prefix=url_prefix,
             inputs=inputs,
+            sort_inputs=sort_inputs,
+            sort_batch_size=sort_batch_size,
+            from_list=from_list,
+            list_root=list_root,
         )
 
         self.gzip = gzip
+
+        self.zstd = zstd
+        self.zstd_level = zstd_level
+        self.zstd_threads = zstd_threads
+        self.zstd_dict = zstd_dict
         self.count = 0
         self.mode = mode
 
         self.warcinfo = warcinfo
-        self.args = args or sys.argv
-        self.args[0] = 'warcit'
+        self.args = ['warcit'] + list(args or [])
 
         self.fixed_dt = self._set_fixed_dt(fixed_dt)
 
-        self.name = self._make_name(name)
+        self.stdout = stdout or name == '-'
+        self.stdout_buffer_size = stdout_buffer_size
+
+        self.buffer_size = buffer_size
+        self.preallocate = preallocate
+        self.sync_size = sync_size
+
+        self.name = '-' if self.stdout else self._make_name(name)
 
         if index_files:
             self.index_files = tuple(['/' + x.lower() for x in index_files.split(',')])
         else:
             self.index_files = tuple()
 
-        self._init_mimes()
         self.mime_overrides = {}
         if mime_overrides:
             for mime in mime_overrides.split(','):
@@ -234,6 +595,20 @@ class WARCIT(BaseTool):
             self.exclude = [x.lower() for x in exclude.split(',')]
 
         self.use_tika = self.use_magic == 'tika' or self.charset == 'tika'
+        self.tika_server = tika_server
+        self.tika_workers = tika_workers
+        self.tika = None
+
+        self.detect_workers = detect_workers
+        self.detector = None
+
+        self.stats_file = stats
+        self.stats = Stats() if stats else NullStats()
+
+        self.progress = progress
+        self.progress_interval = progress_interval
+
+        self.profiler = profiler
 
         self.use_mapfile = False
         if mapfile:
@@ -245,20 +620,38 @@ class WARCIT(BaseTool):
         if self.logfile:
             self.use_logfile = True
 
-        if conversions:
+        self.zip_spool_size = zip_spool_size
+        self.mmap_size = mmap_size
+
+        self.digest_manifests = digest_manifests
+        self.verify_rate = verify_rate
+        self.digest_manifest = None
+
+        self.log_jsonl = (log_format == 'jsonl')
+        self.log_buffer_size = log_buffer_size
+        self.output = None
+        self.written = []
+
+        # converter, tika and detection modules are only imported when used,
+        # to keep startup fast
+        if convert:
+            from warcit.converter import InlineConverter, SPOOL_SIZE
+            self.conversion_serializer = InlineConverter(convert_rules,
+                                                         spool_size=spool_size or SPOOL_SIZE)
+        elif conversions:
+            from warcit.converter import ConversionSerializer
             self.conversion_serializer = ConversionSerializer(conversions)
         else:
             self.conversion_serializer = None
 
         if transclusions:
+            from warcit.converter import TransclusionSerializer
             self.transclusion_serializer = TransclusionSerializer(transclusions, conversions)
+            if convert:
+                self.transclusion_serializer.conversion_serializer = self.conversion_serializer
         else:
             self.transclusion_serializer = None
 
-    def _init_mimes(self):
-        # add any custom, fixed mime types here
-        mimetypes.add_type('image/x-icon', '.ico', True)
-
     def _set_fixed_dt(self, fixed_dt):
         if not fixed_dt:
             return None
@@ -276,7 +669,12 @@ class WARCIT(BaseTool):
             self.logger.error('Mapfile {} could not be loaded.'.format(self.mapfile))
             return False
 
-        self.filemap = []
+        # rows are kept as tuples of the other columns, in parallel to the file
+        # column, instead of one dict per row, to keep large mapfiles compact
+        self.filemap_files = []
+        self.filemap_columns = ()
+        self.filemap_values = []
+        self.filemap_matched = bytearray()
 
         with closing(mapfile_h):
             try:
@@ -300,45 +698,78 @@ class WARCIT(BaseTool):
                 self.logger.error('Mapfile needs one other column in addition to "file".')
                 return False
 
+            self.filemap_columns = tuple(column for column in csvreader.fieldnames if column != 'file')
+
             for row in csvreader:
-                self.filemap.append(row)
+                self.filemap_files.append(row['file'])
+                self.filemap_values.append(tuple(row[column] for column in self.filemap_columns))
 
+            self.filemap_matched = bytearray(len(self.filemap_files))
             return True
 
     def init_logfile(self):
         try:
-            self.logfile_h = open(self.logfile, 'w', newline='')
+            self.logfile_h = open(self.logfile, 'w', newline='', buffering=self.log_buffer_size)
         except Exception as e:
             self.logger.error(e)
             self.logger.error('Logfile {} could not be opened for writing.'.format(self.logfile))
             return False
 
+        if self.log_jsonl:
+            return True
+
+        # offsets and timings are only included in the jsonl log
         self.logfile_writer = csv.DictWriter(self.logfile_h, fieldnames=['file', 'Record-Type',
                                                                          'URL', 'timestamp',
                                                                          'Content-Type', 'mime',
-                                                                         'charset'])
+                                                                         'charset'],
+                                             extrasaction='ignore')
         self.logfile_writer.writeheader()
 
         return True
 
     def write_logfile(self, row):
         if self.use_logfile:
-            self.logfile_writer.writerow(row)
+            if self.log_jsonl:
+                self.logfile_h.write(json.dumps(row) + '\n')
+            else:
+                self.logfile_writer.writerow(row)
+
+    def write_record(self, writer, record):
+        """ Write record, returning its offset and length in the WARC
+        """
+        offset = self.output.tell()
+        writer.write_record(record)
+        return offset, self.output.tell() - offset
+
+    def record_written(self, row, offset, length, start, size=0, digest=None):
+        """ Add offset and timing to the record info row, log and queue it
+        for iter_records()
+        """
+        row['warc'] = self.name
+        row['offset'] = offset
+        row['length'] = length
+        row['digest'] = digest
+        row['bytes_read'] = size
+        row['time'] = round(timer() - start, 6)
+
+        self.write_logfile(row)
+        self.written.append((row['URL'], row, offset))
 
     def close_logfile(self):
         if self.use_logfile:
             self.logfile_h.close()
 
     def _match_mapfile(self, filename):
-        for row in self.filemap:
-            if filename.endswith(row['file']):
-                if 'matched' in row:
-                    self.logger.error('Mapfile row for "{}" matched a second time on file "{}". Please ensure file names in your mapfile are unique.'.format(row['file'], filename))
+        for i, row_file in enumerate(self.filemap_files):
+            if filename.endswith(row_file):
+                if self.filemap_matched[i]:
+                    self.logger.error('Mapfile row for "{}" matched a second time on file "{}". Please ensure file names in your mapfile are unique.'.format(row_file, filename))
                     sys.exit(1)
 
-                self.logger.debug('Matching row "{}" from mapfile.'.format(row['file']))
-                row['matched'] = True
-                return row
+                self.logger.debug('Matching row "{}" from mapfile.'.format(row_file))
+                self.filemap_matched[i] = 1
+                return dict(zip(self.filemap_columns, self.filemap_values[i]))
         return None
 
     def fnmatch_list(self, filename, fnmatch_list):
@@ -359,33 +790,183 @@ class WARCIT(BaseTool):
             self.logger.error('python-magic or libmagic is not available, please install or run without --use-magic flag')
             return False
 
+    def open_stdout(self):
+        """ Output for writing to stdout, which may be a pipe, so it is not
+        seekable: the position is counted as written, for the log and progress
+        """
+        if self.mode == 'ab':
+            raise OSError(errno.ESPIPE, 'Can not append when writing to stdout')
+
+        try:
+            out = io_open(sys.stdout.fileno(), 'wb', buffering=self.stdout_buffer_size, closefd=False)
+        except (AttributeError, UnsupportedOperation):
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+
+        return CountingWriter(out)
+
+    def open_output(self):
+        """ WARC file, buffered, preallocated and synced as configured
+        """
+        if self.preallocate and self.mode == 'ab':
+            raise OSError(errno.EINVAL, 'Can not preallocate when appending')
+
+        output = warcio.utils.open(self.name, self.mode, buffering=self.buffer_size or -1)
+        return OutputFile(output, self.stats,
+                          preallocate=self.preallocate,
+                          sync_size=self.sync_size)
+
+    def load_zstd(self):
+        try:
+            import zstandard
+            from warcit import zstdwriter
+        except Exception as e:
+            self.logger.error(e)
+            self.logger.error('zstandard is not available, please install or run without --zstd flag')
+            return False
+
+        self.zstd_dict_data = None
+        if self.zstd_dict:
+            self.zstd_dict_data = self.train_zstd_dict(zstdwriter)
+
+        return True
+
+    def train_zstd_dict(self, zstdwriter):
+        """ Train zstd dictionary on records made from a sample of the inputs,
+        evenly spread over them
+        """
+        count, total_size = self.scan_inputs()
+        step = max(count // zstdwriter.DICT_SAMPLES, 1)
+
+        samples = []
+        file_infos = (file_info for file_info in self._iter_inputs()
+                      if not self.is_excluded(file_info))
+
+        for i, file_info in enumerate(file_infos):
+            if i % step:
+                continue
+
+            with file_info.open() as fh:
+                data = fh.read(zstdwriter.DICT_SAMPLE_SIZE)
+
+            content_type = get_mimetypes().guess_type(file_info.url.split('?', 1)[0], False)[0]
+            samples.append(zstdwriter.make_sample_record(file_info.url,
+                                                         content_type or 'text/html',
+                                                         data,
+                                                         file_info.full_filename))
+
+        try:
+            dict_data = zstdwriter.train_dictionary(samples)
+        except Exception as e:
+            self.logger.warning('Not using a zstd dictionary, training on {0} samples failed: {1}'.format(len(samples), e))
+            return None
+
+        self.logger.debug('Trained zstd dictionary on {0} samples'.format(len(samples)))
+        return dict_data
+
+    def load_digest_manifests(self):
+        from warcit.manifest import DigestManifest
+        self.digest_manifest = DigestManifest(self.verify_rate)
+        for filename in self.digest_manifests:
+            try:
+                self.digest_manifest.load(filename)
+            except Exception as e:
+                self.logger.error(e)
+                self.logger.error('Digest manifest {} could not be loaded.'.format(filename))
+                return False
+
+        return True
+
     def load_tika(self):
+        from warcit.tikaclient import TikaClient, TikaDetector, DEFAULT_TIKA_SERVER
+        self.tika_server = self.tika_server or DEFAULT_TIKA_SERVER
+        try:
+            client = TikaClient(self.tika_server, pool_size=self.tika_workers)
+            self.logger.debug('Using {0} at {1}'.format(client.version(), self.tika_server))
+        except Exception as e:
+            self.logger.error(e)
+            self.logger.error('Apache Tika server not available at {0}, please set up or use another method for Content-Type or encoding detection.'.format(self.tika_server))
+            return False
+
+        self.tika = TikaDetector(client,
+                                 detect_type=(self.use_magic == 'tika'),
+                                 detect_charset=(self.charset == 'tika'),
+                                 guess_type=self._guess_type,
+                                 max_workers=self.tika_workers)
+        return True
+
+    def load_detector(self):
+        detect_mime = (self.use_magic == 'magic')
+        detect_charset = (self.charset == 'cchardet')
+        if not detect_mime and not detect_charset:
+            return True
+
         try:
-            from tika import parser as tika_parser
-            self.tika_parser = tika_parser
-            self.tika_parser.from_buffer('Tika Test.')
+            from warcit.detect import DetectionPool
+            self.detector = DetectionPool(detect_mime=detect_mime,
+                                          detect_charset=detect_charset,
+                                          guess_type=self._guess_type,
+                                          max_workers=self.detect_workers)
             return True
         except Exception as e:
             self.logger.error(e)
-            self.logger.error('Apache Tika not available, please set up or use another method for Content-Type or encoding detection.')
+            self.logger.error('Unable to start detection process pool')
             return False
 
+    def iter_prefetched(self, file_infos):
+        """ Start detection for upcoming files while the current one is written,
+        keeping up to ``tika_workers`` and ``detect_workers`` files in flight.
+
+        Other inputs, eg. zip file members, are not read ahead, as their zip
+        file is closed once its last member is listed.
+        """
+        window = 0
+        if self.tika:
+            window = max(window, self.tika_workers)
+        if self.detector:
+            window = max(window, self.detect_workers)
+
+        pending = deque()
+        for file_info in file_infos:
+            if not file_info.is_local:
+                while pending:
+                    yield pending.popleft()
+
+            if not self.is_excluded(file_info):
+                if self.tika:
+                    self.tika.submit(file_info)
+                if self.detector:
+                    self.detector.submit(file_info)
+
+            if not file_info.is_local:
+                yield file_info
+                continue
+
+            pending.append(file_info)
+            if len(pending) > window:
+                yield pending.popleft()
+
+        while pending:
+            yield pending.popleft()
+
     def _make_name(self, name):
         """ Set WARC file name, use defaults when needed
         """
 
-        # if no name, use basename of first input
+        # if no name, use basename of first input, if it is a path
         if not name:
-            name = os.path.basename(self.inputs[0].replace('/', os.path.sep).rstrip(os.path.sep))
-
-        elif not name:
-            name = 'warcit'
+            first = self.inputs[0] if isinstance(self.inputs, (list, tuple)) and self.inputs else None
+            if isinstance(first, str):
+                name = os.path.basename(first.replace('/', os.path.sep).rstrip(os.path.sep))
+            else:
+                name = 'warcit'
         else:
             name = os.path.splitext(name)[0]
             name = os.path.splitext(name)[0]
 
         # auto add extension
-        if self.gzip:
+        if self.zstd:
+            name += '.warc.zst'
+        elif self.gzip:
             name += '.warc.gz'
         else:
             name += '.warc'
@@ -393,58 +974,192 @@ class WARCIT(BaseTool):
         return name
 
     def run(self):
+        if not self.load():
+            return 1
+
+        # close the detection pool, tika and logs, as in api.write_warc
+        try:
+            try:
+                if self.stdout:
+                    output = self.open_stdout()
+                else:
+                    output = self.open_output()
+            except OSError as e:
+                # ensure only file exists handling
+                if e.errno != errno.EEXIST:
+                    raise
+
+                self.logger.error(e)
+                self.logger.error('* Use -a/--append to append to an existing WARC file')
+                self.logger.error('* Use -o/--overwrite to overwrite existing WARC file')
+                return 1
+
+            with closing(output):
+                for result in self.iter_records(output):
+                    pass
+
+        finally:
+            res = self.close()
+
+        return res
+
+    def plan(self, samples=PLAN_SAMPLES):
+        """ Print an estimate of the records, output size and time of the run,
+        without writing anything
+        """
+        from warcit.plan import Planner
+        if self.use_mapfile:
+            if not self.load_mapfile():
+                return 1
+
+        return Planner(self, samples).run()
+
+    def load(self):
+        """ Load everything needed to write records, returning False on error
+        """
         if self.use_magic == 'magic':
             if not self.load_magic():
-                return 1
+                return False
+        if self.zstd:
+            if not self.load_zstd():
+                return False
         if self.use_tika:
             if not self.load_tika():
-                return 1
+                return False
+        if self.detect_workers > 0:
+            if not self.load_detector():
+                return False
         if self.use_mapfile:
             if not self.load_mapfile():
-                return 1
+                return False
+        if self.digest_manifests:
+            if not self.load_digest_manifests():
+                return False
         if self.use_logfile:
             if not self.init_logfile():
-                return 1
+                return False
 
+        return True
+
+    def iter_records(self, output):
+        """ Write records for all inputs to output, yielding a
+        (url, record info dict, offset) tuple for each record, as written
+        """
+        # count offsets if output is not seekable
         try:
-            output = warcio.utils.open(self.name, self.mode)
-        except OSError as e:
-            # ensure only file exists handling
-            if e.errno != errno.EEXIST:
-                raise
+            output.tell()
+        except (AttributeError, IOError, OSError):
+            output = CountingWriter(output)
+
+        self.output = output
+
+        if self.zstd:
+            from warcit.zstdwriter import ZstdWARCWriter
+            writer = ZstdWARCWriter(output,
+                                    level=self.zstd_level,
+                                    threads=self.zstd_threads,
+                                    dict_data=self.zstd_dict_data)
+            if self.zstd_dict_data:
+                writer.write_dictionary()
+        else:
+            writer = WARCWriter(output, gzip=self.gzip)
 
-            self.logger.error(e)
-            self.logger.error('* Use -a/--append to append to an existing WARC file')
-            self.logger.error('* Use -o/--overwrite to overwrite existing WARC file')
-            return 1
+        self.make_warcinfo(writer)
 
-        with closing(output):
-            writer = WARCWriter(output, gzip=self.gzip)
+        stats = self.stats
+        written = self.written
 
-            self.make_warcinfo(writer)
+        # sync point of the output, after the records of each file
+        group_done = getattr(output, 'group_done', None)
 
-            for file_info in self.iter_inputs():
-                result = self.make_record(writer, file_info)
-                if not result:
-                    self.logger.debug('Skipping {0}'.format(file_info.url))
-                    continue
+        progress = None
+        if self.progress:
+            total_files, total_size = self.scan_inputs()
+            progress = Progress(total_files, total_size,
+                                interval=self.progress_interval,
+                                output=output)
 
-                url, record = result
+        if self.sort_inputs:
+            self.logger.info('Reading inputs sorted by {0}, in batches of {1}'.format(self.sort_inputs,
+                                                                                   self.sort_batch_size))
 
-                # Current file serves as a directory index
-                if url.lower().endswith(self.index_files):
+        file_infos = stats.iter_stage('iter_inputs', self.iter_inputs())
+        if self.tika or self.detector:
+            file_infos = self.iter_prefetched(file_infos)
+
+        for file_info in file_infos:
+            start = timer()
+            result = self.make_record(writer, file_info)
+            if not result:
+                self.logger.debug('Skipping {0}'.format(file_info.url))
+                continue
+
+            url, record = result
+
+            # Current file serves as a directory index
+            if url.lower().endswith(self.index_files):
+                with stats.stage('index_revisit'):
                     self.make_index_revisit(writer, url, record)
 
-                if self.conversion_serializer:
-                    self.make_conversions(writer, url, record)
+            if self.conversion_serializer:
+                with stats.stage('conversions'):
+                    self.make_conversions(writer, url, record, file_info)
 
-                if self.transclusion_serializer:
+            if self.transclusion_serializer:
+                with stats.stage('transclusions'):
                     self.make_transclusion_metadata(writer, url, record)
 
+            stats.add_file(file_info.full_filename, timer() - start, file_info.size)
+
+            if progress:
+                progress.update(file_info.size)
+
+            if group_done:
+                group_done()
+
+            if self.profiler:
+                self.profiler.file_done()
+
+            for item in written:
+                yield item
+
+            del written[:]
+
+        if progress:
+            progress.report()
+
+    def close(self):
+        """ Close everything after writing, returning the exit code
+        """
         self.logger.info('Wrote {0} resources to {1}'.format(self.count, self.name))
 
+        if self.digest_manifest:
+            manifest = self.digest_manifest
+            self.logger.info('Used {0} digests from manifests ({1} verified, {2} stale)'.format(
+                             manifest.used, manifest.verified, manifest.stale))
+
+            if manifest.mismatched:
+                self.logger.error('Digest manifest did not match the files, records written before ' +
+                                  'the mismatch may have incorrect digests. Re-run without --digest-manifest, ' +
+                                  'or with --verify-rate 1')
+
         self.close_logfile()
 
+        if hasattr(self.conversion_serializer, 'close'):
+            self.conversion_serializer.close()
+
+        if self.tika:
+            self.tika.close()
+
+        if self.detector:
+            self.detector.close()
+
+        if self.stats_file:
+            self.stats.write(self.stats_file)
+
+        if self.digest_manifest and self.digest_manifest.mismatched:
+            return 1
+
         return 0
 
     def make_warcinfo(self, writer):
@@ -456,44 +1171,80 @@ class WARCIT(BaseTool):
                               ('cmdline', ' '.join(self.args))
                              ])
 
+        # for reproducing the record order
+        if self.sort_inputs:
+            params['input-order'] = '{0}, batches of {1}'.format(self.sort_inputs, self.sort_batch_size)
+
         record = writer.create_warcinfo_record(self.name, params)
         writer.write_record(record)
 
         return record
 
-    def make_record(self, writer, file_info, record_type='resource', extra_headers=None):
+    def scan_inputs(self):
+        """ Number and total size of the files to be written, for progress reporting
+        """
+        count = 0
+        total_size = 0
+        # order doesn't matter for counting
+        for file_info in self._iter_inputs():
+            if not self.is_excluded(file_info):
+                count += 1
+                total_size += file_info.size
+
+        return count, total_size
+
+    def is_excluded(self, file_info):
         # process inclue/exclude rules
         if self.include and self.exclude:
             if self.fnmatch_list(file_info.full_filename, self.include):
                 pass
             elif self.fnmatch_list(file_info.full_filename, self.exclude):
-                return False
+                return True
         elif self.include and not self.exclude:
             if not self.fnmatch_list(file_info.full_filename, self.include):
-                return False
+                return True
         elif self.exclude and not self.include:
             if self.fnmatch_list(file_info.full_filename, self.exclude):
-                return False
+                return True
+
+        return False
+
+    def make_record(self, writer, file_info, record_type='resource', extra_headers=None, match_mapfile=True):
+        if self.is_excluded(file_info):
+            return False
+
+        start = timer()
+        stats = self.stats
 
         # type and encoding
         if self.use_tika:
-            file_info.tika_results = self.tika_parser.from_file(file_info.full_filename)
+            with stats.stage('tika'):
+                file_info.tika_results = self.tika.get_results(file_info)
 
-        if self.use_mapfile:
+        if self.detector:
+            with stats.stage('detect_pool'):
+                file_info.detect_results = self.detector.get_results(file_info)
+
+        # may already be set from a --from-list row, conversion records don't
+        # match the mapfile, their source file having matched already
+        if self.use_mapfile and match_mapfile and not file_info.mapfile_results:
             file_info.mapfile_results = self._match_mapfile(file_info.full_filename)
 
-        mime_type = self._guess_type(file_info)
-        encoding = self._guess_charset(mime_type, file_info)
+        with stats.stage('guess_type'):
+            mime_type = self._guess_type(file_info)
+
+        with stats.stage('guess_charset'):
+            encoding = self._guess_charset(mime_type, file_info)
         warc_content_type = mime_type + encoding;
 
         # target URL
-        if self.use_mapfile and file_info.mapfile_results and 'URL' in file_info.mapfile_results:
+        if file_info.mapfile_results and 'URL' in file_info.mapfile_results:
                 url = file_info.mapfile_results['URL']
         else:
             url = file_info.url
 
         # timestamp
-        if self.use_mapfile and file_info.mapfile_results and 'timestamp' in file_info.mapfile_results:
+        if file_info.mapfile_results and 'timestamp' in file_info.mapfile_results:
             warc_date = self._set_fixed_dt(file_info.mapfile_results['timestamp'])
         elif self.fixed_dt:
             warc_date = self.fixed_dt
@@ -513,21 +1264,43 @@ class WARCIT(BaseTool):
         if extra_headers:
             warc_headers.update(extra_headers)
 
+        # known digest, the payload is the full block of resource records
+        if self.digest_manifest:
+            digest = self.digest_manifest.get_digest(file_info)
+            if digest:
+                warc_headers['WARC-Payload-Digest'] = digest
+                warc_headers['WARC-Block-Digest'] = digest
 
-        with file_info.open() as fh:
-            record = writer.create_warc_record(url, record_type,
-                                      payload=fh,
-                                      length=file_info.size,
-                                      warc_content_type=warc_content_type,
-                                      warc_headers_dict=warc_headers)
+
+        # zip members can't be rewound for warcio to compute the digests,
+        # so compute the digest here while reading it once
+        if isinstance(file_info, ZipFileInfo) and 'WARC-Payload-Digest' not in warc_headers:
+            with stats.stage('zip_digest', file_info.size):
+                fh, digest = file_info.open_digested(writer._create_digester(), self.zip_spool_size)
+
+            warc_headers['WARC-Payload-Digest'] = digest
+            warc_headers['WARC-Block-Digest'] = digest
+        else:
+            fh = file_info.open_mapped(self.mmap_size)
+
+        with fh:
+            # payload digest is computed when creating the record,
+            # block digest, compression and output when writing it
+            with stats.stage('digest', file_info.size):
+                record = writer.create_warc_record(url, record_type,
+                                          payload=fh,
+                                          length=file_info.size,
+                                          warc_content_type=warc_content_type,
+                                          warc_headers_dict=warc_headers)
 
             self.count += 1
-            writer.write_record(record)
+            with stats.stage('write_record', file_info.size):
+                offset, length = self.write_record(writer, record)
 
             self.logger.debug('Writing "{0}" ({1}) @ "{2}" from "{3}"'.format(url, warc_content_type, warc_date,
                                                                               file_info.full_filename))
 
-        self.write_logfile({
+        self.record_written({
             'file': file_info.full_filename,
             'Record-Type': record_type,
             'URL': url,
@@ -535,11 +1308,17 @@ class WARCIT(BaseTool):
             'Content-Type': warc_content_type,
             'mime': mime_type,
             'charset': encoding[10:] # minus '; charset='
-            })
+            }, offset, length, start, file_info.size, record.rec_headers.get('WARC-Payload-Digest'))
+
+        # no longer needed, don't keep them for as long as the file info is referenced
+        file_info.mapfile_results = None
+        file_info.tika_results = None
+        file_info.detect_results = None
 
         return url, record
 
     def make_index_revisit(self, writer, url, record):
+        start = timer()
         index_url = url.rsplit('/', 1)[0] + '/'
         digest = record.rec_headers.get('WARC-Payload-Digest')
         self.logger.debug('Adding auto-index: {0} -> {1}'.format(index_url, url))
@@ -556,17 +1335,17 @@ class WARCIT(BaseTool):
         revisit_record.rec_headers['WARC-Source-URI'] = source_uri
 
         self.count += 1
-        writer.write_record(revisit_record)
+        offset, length = self.write_record(writer, revisit_record)
 
-        self.write_logfile({
+        self.record_written({
             'file': source_uri[7:], # shave off 'file://' in beginning
             'Record-Type': 'revisit',
             'URL': index_url,
             'timestamp': warc_date,
-            })
+            }, offset, length, start, digest=digest)
 
-    def make_conversions(self, writer, url, record):
-        for file_info, type_, metadata in self.conversion_serializer.find_conversions(url):
+    def make_conversions(self, writer, url, record, source_info=None):
+        for file_info, type_, metadata in self.conversion_serializer.find_conversions(url, source_info):
             extra_headers = {'WARC-Refers-To': record.rec_headers['WARC-Record-ID'],
                              'WARC-Refers-To-Target-URI': record.rec_headers['WARC-Target-URI'],
                              'WARC-Refers-To-Target-Date': record.rec_headers['WARC-Date']
@@ -575,7 +1354,7 @@ class WARCIT(BaseTool):
             if metadata:
                 extra_headers['WARC-JSON-Metadata'] = json.dumps(metadata)
 
-            self.make_record(writer, file_info, type_, extra_headers)
+            self.make_record(writer, file_info, type_, extra_headers, match_mapfile=False)
 
     def make_transclusion_metadata(self, writer, url, record):
         content_type = record.rec_headers.get('Content-Type')
@@ -584,6 +1363,7 @@ class WARCIT(BaseTool):
             #    url = url.replace('http://', 'metadata://')
             #elif url.startswith('https://'):
             #    url = url.replace('https://', 'metadata://')
+            start = timer()
             embeds_url = 'urn:embeds:' + url
 
             content = json.dumps(metadata, indent=2, sort_keys=True).encode('utf-8')
@@ -605,23 +1385,22 @@ class WARCIT(BaseTool):
 
             logging.debug('Writing transclusion metadata at {0}'.format(embeds_url))
 
-            writer.write_record(record)
+            offset, length = self.write_record(writer, record)
             self.count += 1
 
             self.logger.debug('Writing "{0}" ({1}) @ "{2}" from "{3}"'.format(embeds_url, warc_content_type, warc_date, '-'))
 
-            self.write_logfile({
+            self.record_written({
                 'file': '-',
                 'Record-Type': 'metadata',
                 'URL': embeds_url,
                 'timestamp': warc_date,
-                })
+                }, offset, length, start, len(content), record.rec_headers.get('WARC-Payload-Digest'))
 
     def _guess_type(self, file_info):
-        if self.use_mapfile:
-            if file_info.mapfile_results:
-                if 'Content-Type' in file_info.mapfile_results:
-                    return file_info.mapfile_results['Content-Type'].split(';')[0]
+        if file_info.mapfile_results:
+            if 'Content-Type' in file_info.mapfile_results:
+                return file_info.mapfile_results['Content-Type'].split(';')[0]
 
         if self.mime_overrides:
             for pattern in self.mime_overrides:
@@ -631,13 +1410,16 @@ class WARCIT(BaseTool):
         mime = None
 
         if self.use_magic == 'filename':
-            mime = mimetypes.guess_type(file_info.url.split('?', 1)[0], False)
+            mime = get_mimetypes().guess_type(file_info.url.split('?', 1)[0], False)
             if len(mime) == 2:
                 mime = mime[0]
 
         elif self.use_magic == 'magic':
-            with file_info.open() as fh:
-                mime = self.magic.from_buffer(fh.read(BUFF_SIZE))
+            if file_info.detect_results and 'mime' in file_info.detect_results:
+                mime = file_info.detect_results['mime']
+            else:
+                with file_info.open() as fh:
+                    mime = self.magic.from_buffer(fh.read(BUFF_SIZE))
 
         elif self.use_magic == 'tika':
             # Tika might not return a Content-Type, a string, or a list.
@@ -659,21 +1441,21 @@ class WARCIT(BaseTool):
         return mime
 
     def _guess_charset(self, content_type, file_info):
-        if self.use_mapfile:
-            if file_info.mapfile_results:
-                if 'Content-Type' in file_info.mapfile_results and ';' in file_info.mapfile_results['Content-Type']:
-                    return ';' + file_info.mapfile_results['Content-Type'].split(';')[1]
+        if file_info.mapfile_results:
+            if 'Content-Type' in file_info.mapfile_results and ';' in file_info.mapfile_results['Content-Type']:
+                return ';' + file_info.mapfile_results['Content-Type'].split(';')[1]
 
         charset = ''
         if not content_type.startswith('text/') or not self.charset:
             return ''
 
         if self.charset == 'cchardet':
-            with file_info.open() as fh:
-                result = cchardet.detect(fh.read())
-
-            if result:
-                charset = result['encoding']
+            if file_info.detect_results and 'charset' in file_info.detect_results:
+                charset = file_info.detect_results['charset']
+            else:
+                with file_info.open() as fh:
+                    from warcit.detect import detect_charset_buffer
+                    charset = detect_charset_buffer(fh.read())
 
             # cchardet is detecting ascii on many basic English
             # language resources, which usually
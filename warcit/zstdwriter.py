@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+
+import struct
+
+from io import BytesIO
+
+from warcio.warcwriter import WARCWriter
+
+
+# skippable frame holding the dictionary, at the start of a .warc.zst file
+DICT_FRAME_MAGIC = 0x184D2A5D
+
+DICT_SIZE = 112640
+
+DICT_SAMPLES = 1000
+
+DICT_SAMPLE_SIZE = 16384
+
+LEVEL = 3
+
+
+# ============================================================================
+# zstandard is an optional dependency, imported only when used
+class ZstdWrapper(object):
+    """ Compresses everything written until flush() into a single zstd frame,
+    like warcio's GzippingWrapper for gzip members
+    """
+    def __init__(self, out, compressor):
+        self.out = out
+        self.compobj = compressor.compressobj()
+
+    def write(self, buff):
+        data = self.compobj.compress(buff)
+        if data:
+            self.out.write(data)
+
+    def flush(self):
+        import zstandard
+        self.out.write(self.compobj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH))
+        self.out.flush()
+
+
+# ============================================================================
+class ZstdWARCWriter(WARCWriter):
+    """ WARCWriter writing each record as its own zstd frame, for .warc.zst files.
+
+    If a dictionary is used, write_dictionary() must be called before writing
+    any records, to store it in a skippable frame at the start of the file.
+    """
+    def __init__(self, filebuf, level=LEVEL, threads=0, dict_data=None, *args, **kwargs):
+        import zstandard
+        kwargs['gzip'] = False
+        super(ZstdWARCWriter, self).__init__(filebuf, *args, **kwargs)
+
+        self.dict_data = dict_data
+        self.compressor = zstandard.ZstdCompressor(level=level,
+                                                   threads=threads,
+                                                   dict_data=dict_data,
+                                                   write_checksum=True)
+
+    def write_dictionary(self):
+        write_dictionary_frame(self.out, self.dict_data.as_bytes())
+
+    def _write_warc_record(self, out, record):
+        super(ZstdWARCWriter, self)._write_warc_record(ZstdWrapper(out, self.compressor), record)
+
+
+# ============================================================================
+def write_dictionary_frame(out, dict_bytes):
+    """ Write dictionary as a zstd skippable frame. The dictionary itself is
+    compressed, as readers expect a zstd frame unless it starts with the
+    dictionary magic number.
+    """
+    import zstandard
+    data = zstandard.ZstdCompressor(level=19).compress(dict_bytes)
+    out.write(struct.pack('<II', DICT_FRAME_MAGIC, len(data)))
+    out.write(data)
+
+
+def read_dictionary_frame(fh):
+    """ Read dictionary from the start of a .warc.zst file, if any,
+    leaving the file positioned at the first record
+    """
+    import zstandard
+    header = fh.read(8)
+    if len(header) < 8 or struct.unpack('<I', header[:4])[0] != DICT_FRAME_MAGIC:
+        fh.seek(-len(header), 1)
+        return None
+
+    size = struct.unpack('<I', header[4:])[0]
+    data = fh.read(size)
+    if not data.startswith(b'\x37\xa4\x30\xec'):
+        data = zstandard.ZstdDecompressor().decompress(data)
+
+    return zstandard.ZstdCompressionDict(data)
+
+
+def train_dictionary(samples, dict_size=DICT_SIZE):
+    import zstandard
+    return zstandard.train_dictionary(dict_size, samples)
+
+
+def make_sample_record(url, content_type, data, filename):
+    """ Uncompressed record for dictionary training, with the same
+    headers as the records that will be written
+    """
+    buff = BytesIO()
+    writer = WARCWriter(buff, gzip=False)
+    record = writer.create_warc_record(url, 'resource',
+                                       payload=BytesIO(data),
+                                       length=len(data),
+                                       warc_content_type=content_type,
+                                       warc_headers_dict={'WARC-Date': writer._make_warc_date(),
+                                                          'WARC-Creation-Date': writer._make_warc_date(),
+                                                          'WARC-Source-URI': 'file://' + filename})
+    writer.write_record(record)
+    return buff.getvalue()